@@ -0,0 +1,244 @@
+#!/usr/bin/env python3.6
+
+"""
+benchmark_bundle_tools.py - Measure the hot paths of a stager/storer run on synthetic inputs.
+
+Each benchmark is run repeatedly for at least --min-time seconds, reporting operations per second and
+(where it processes data) MB/s.  It is then run once more under tracemalloc to find its peak memory use.
+Nothing touches the network: bundle trees are generated in a temporary folder and S3 is not contacted.
+
+Results can be saved with --output, and a previous run's results given with --compare, e.g.
+
+    git checkout old-revision  && bin/benchmark_bundle_tools.py --output old.json
+    git checkout new-revision  && bin/benchmark_bundle_tools.py --compare old.json
+
+Benchmarks are only comparable between runs made on the same machine with the same options.
+"""
+
+import argparse, io, json, os, platform, shutil, sys, tempfile, time, tracemalloc
+
+from bundle_tools import LocalBundle, MetadataFile, DataFile, SubmissionInfo
+from bundle_tools.checksumming import S3EtagHasher, PipelinedChecksummingReader, LocalFileChecksummer
+from bundle_tools.crc32c import Crc32c
+from bundle_tools.s3 import S3Agent
+from bundle_tools.utils import sizeof_fmt, MB
+
+
+class Benchmark:
+    """ setup() returns the function to be timed, and how many bytes each call processes (or None) """
+
+    def __init__(self, name, setup):
+        self.name = name
+        self.setup = setup
+
+    def run(self, min_time: float) -> dict:
+        operation, bytes_per_op = self.setup()
+        operation()  # warm up
+        ops = 0
+        start = time.perf_counter()
+        while True:
+            operation()
+            ops += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+        tracemalloc.start()
+        operation()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return dict(ops_per_second=ops / elapsed,
+                    mb_per_second=(bytes_per_op * ops / elapsed / MB) if bytes_per_op else None,
+                    peak_memory_bytes=peak_memory)
+
+
+class Main:
+
+    def __init__(self):
+        self._parse_args()
+        self.workdir = tempfile.mkdtemp(prefix='benchmark_bundle_tools-')
+        try:
+            self.results = self.run_benchmarks()
+        finally:
+            shutil.rmtree(self.workdir)
+        if self.args.compare:
+            self.compare_with(self.args.compare)
+        if self.args.output:
+            with open(self.args.output, 'w') as fh:
+                json.dump(dict(host=platform.node(), python=platform.python_version(), options=vars(self.args),
+                               results=self.results), fh, indent=2)
+            print(f"\nResults saved to {self.args.output}")
+
+    def run_benchmarks(self) -> dict:
+        results = {}
+        print(f"\n{'benchmark':48} {'ops/s':>10} {'MB/s':>10} {'peak mem':>12}")
+        for benchmark in self.benchmarks():
+            if self.args.only and not any(pattern in benchmark.name for pattern in self.args.only):
+                continue
+            result = benchmark.run(self.args.min_time)
+            results[benchmark.name] = result
+            rate = f"{result['mb_per_second']:10.1f}" if result['mb_per_second'] else f"{'':10}"
+            print(f"{benchmark.name:48} {result['ops_per_second']:10.2f} {rate} "
+                  f"{sizeof_fmt(result['peak_memory_bytes']):>12}")
+        return results
+
+    def benchmarks(self) -> list:
+        return [
+            Benchmark("S3EtagHasher.update", self.setup_s3_etag),
+            Benchmark("Crc32c.update", self.setup_crc32c),
+            Benchmark("PipelinedChecksummingReader.read", self.setup_checksumming_reader),
+            Benchmark("LocalFileChecksummer.checksums", self.setup_local_file_checksummer),
+            Benchmark("LocalBundle.bundles_under", self.setup_bundles_under),
+            Benchmark("LocalBundle.enumerate_local_metadata_files", self.setup_enumerate_metadata),
+            Benchmark("SubmissionInfo.extract_bundle_info", self.setup_extract_bundle_info),
+            Benchmark("S3Agent._decode_tags", self.setup_decode_tags),
+        ]
+
+    # Checksumming
+
+    def _data(self) -> bytes:
+        if not hasattr(self, '_sample'):
+            self._sample = os.urandom(self.args.data_mb * MB)
+        return self._sample
+
+    def _chunks(self) -> list:
+        data = self._data()
+        chunk_size = self.args.chunk_kb * 1024
+        return [data[start:start + chunk_size] for start in range(0, len(data), chunk_size)]
+
+    def setup_s3_etag(self):
+        chunks = self._chunks()
+
+        def operation():
+            hasher = S3EtagHasher()
+            for chunk in chunks:
+                hasher.update(chunk)
+            hasher.hexdigest()
+        return operation, len(self._data())
+
+    def setup_crc32c(self):
+        chunks = self._chunks()
+
+        def operation():
+            hasher = Crc32c()
+            for chunk in chunks:
+                hasher.update(chunk)
+            hasher.hexdigest()
+        return operation, len(self._data())
+
+    def setup_checksumming_reader(self):
+        data = self._data()
+        read_size = self.args.chunk_kb * 1024
+
+        def operation():
+            with PipelinedChecksummingReader(io.BytesIO(data)) as reader:
+                while reader.read(read_size):
+                    pass
+                reader.get_checksums()
+        return operation, len(data)
+
+    def setup_local_file_checksummer(self):
+        path = os.path.join(self.workdir, 'data.bin')
+        with open(path, 'wb') as fh:
+            fh.write(self._data())
+        part_size = S3Agent._s3_chunk_size(len(self._data()))
+
+        def operation():
+            LocalFileChecksummer(path, part_size=part_size).checksums()
+        return operation, len(self._data())
+
+    # Bundle discovery
+
+    def _bundle_tree(self) -> str:
+        """ import/project<n>/bundles/bundle<m>/{manifest.json, <k>.json} """
+        root = os.path.join(self.workdir, 'import')
+        if not os.path.isdir(root):
+            for bundle_number in range(self.args.bundles):
+                project = f"project{bundle_number % self.args.projects}"
+                bundle_path = os.path.join(root, project, 'bundles', f"bundle{bundle_number}")
+                os.makedirs(bundle_path)
+                for file_number in range(self.args.files_per_bundle):
+                    with open(os.path.join(bundle_path, f"metadata{file_number}.json"), 'w') as fh:
+                        json.dump(dict(file=file_number), fh)
+                with open(os.path.join(bundle_path, LocalBundle.MANIFEST_FILENAME), 'w') as fh:
+                    json.dump(dict(dir='file:///nonexistent', files=[]), fh)
+        return root
+
+    def setup_bundles_under(self):
+        root = self._bundle_tree()
+
+        def operation():
+            for _ in LocalBundle.bundles_under(root):
+                pass
+        return operation, None
+
+    def setup_enumerate_metadata(self):
+        bundles = list(LocalBundle.bundles_under(self._bundle_tree()))[:100]
+
+        def operation():
+            for bundle in bundles:
+                LocalBundle(bundle.path).enumerate_local_metadata_files()
+        return operation, None
+
+    # Submission and tags
+
+    def setup_extract_bundle_info(self):
+        bundle = LocalBundle('import/project/bundles/bundle')
+        for number in range(self.args.submission_files):
+            file_class = MetadataFile if number % 2 else DataFile
+            extension = 'json' if number % 2 else 'fastq.gz'
+            bundle.add_file(file_class(name=f"file{number}.{extension}", size=number, uuid=f"uuid-{number}",
+                                       staged_url=f"s3://bucket/import/project/bundles/bundle/file{number}"))
+        submission = SubmissionInfo('bucket', bundle)
+
+        def operation():
+            submission.info = {}
+            submission.extract_bundle_info()  # entries are created
+            submission.extract_bundle_info()  # entries are found and updated
+        return operation, None
+
+    def setup_decode_tags(self):
+        tag_set = [dict(Key=f"hca-dss-tag{number}", Value=f"value{number}") for number in range(self.args.tags)]
+
+        def operation():
+            S3Agent._decode_tags(tag_set)
+        return operation, None
+
+    def compare_with(self, path: str):
+        with open(path) as fh:
+            baseline = json.load(fh)['results']
+        print(f"\nCompared with {path} (ratio of ops/s, peak memory):\n")
+        for name, result in self.results.items():
+            if name in baseline:
+                speedup = result['ops_per_second'] / baseline[name]['ops_per_second']
+                memory = result['peak_memory_bytes'] / max(1, baseline[name]['peak_memory_bytes'])
+                print(f"    {name:48} {speedup:6.2f}x {memory:6.2f}x")
+
+    def _parse_args(self):
+        parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+        parser.add_argument('--data-mb', type=int, default=64, metavar="N",
+                            help="checksum N MB of data per operation (default %(default)s)")
+        parser.add_argument('--chunk-kb', type=int, default=8192, metavar="N",
+                            help="feed checksummers N KB at a time (default %(default)s)")
+        parser.add_argument('--bundles', type=int, default=2000, metavar="N",
+                            help="number of synthetic bundles (default %(default)s)")
+        parser.add_argument('--projects', type=int, default=20, metavar="N",
+                            help="spread the bundles over N projects (default %(default)s)")
+        parser.add_argument('--files-per-bundle', type=int, default=10, metavar="N",
+                            help="metadata files in each synthetic bundle (default %(default)s)")
+        parser.add_argument('--submission-files', type=int, default=1000, metavar="N",
+                            help="files in the synthetic submission (default %(default)s)")
+        parser.add_argument('--tags', type=int, default=10, metavar="N",
+                            help="tags in the synthetic tag set (default %(default)s)")
+        parser.add_argument('--min-time', type=float, default=2.0, metavar="SECONDS",
+                            help="run each benchmark for at least this long (default %(default)s)")
+        parser.add_argument('--only', nargs='+', metavar="NAME",
+                            help="only run benchmarks whose names contain one of these strings")
+        parser.add_argument('-o', '--output', metavar="results.json",
+                            help="save results to this file")
+        parser.add_argument('--compare', metavar="results.json",
+                            help="compare with results previously saved with --output")
+        self.args = parser.parse_args()
+
+
+if __name__ == '__main__':
+    runner = Main()
@@ -1,5 +1,21 @@
 from .bundle import Bundle, LocalBundle, StagedBundle, File, MetadataFile, DataFile
 from .submission import SubmissionInfo
 from .staging import BundleStager
+from .file_scheduling import FileLevelScheduler
+from .verification import BundleVerifier
+from .dispatch import BoundedDispatcher, RunSummary
+from .staged_index import StagedBundleIndex
 from .storage import StagedBundleFinder, BundleStorer, DataStoreAPI
 from .parallel_logger import logger
+from .clients import clients
+from .scheduling import origin_scheduler
+from .catalog import staged_catalog
+from .checksum_cache import checksum_cache
+from .discovery import bundle_discovery
+from .sizes import file_size_resolver
+from .ftp import ftp_sessions
+from .crc32c import crc32c_registry
+from .tuning import transfer_tuner
+from .bandwidth import bandwidth_limiter
+from .governor import resource_governor
+from .checksumming import checksum_selftest
@@ -0,0 +1,199 @@
+import fcntl, io, json, os, tempfile, threading, time
+from contextlib import contextmanager
+
+MB = 1024 * 1024
+
+
+class BandwidthLimiter:
+    """
+    Run-wide token bucket limits on ingress (downloads from origin servers) and egress (uploads to S3) bandwidth.
+
+    Like OriginHostScheduler, state is kept in flock()ed files under a shared folder, so the limits apply
+    to the total across all ProcessPoolExecutor workers.  Each direction's file holds the time at which its
+    bucket will next be empty (the "theoretical arrival time" of GCRA, an equivalent of a token bucket).
+    To save a locked file update per read or callback, each process takes tokens GRANT_SECONDS (and at least
+    GRANT_BYTES) at a time, and hands them out itself.
+
+    Limits are kept in "limits.json" in the same folder, which is re-read whenever it changes, so they can
+    be adjusted while a run is in progress: use stager.py --adjust-bandwidth.  Limits belong to the runs that
+    set them (their "owners", by pid), and are dropped once none of those is still alive, whether it exited
+    or crashed, so they never outlive the run.  The folder is per user, so other users' runs on the same
+    machine neither see nor change these limits.
+    """
+
+    DEFAULT_STATE_DIR = os.path.join(tempfile.gettempdir(), f"bundle_tools-bandwidth-{os.getuid()}")
+    DIRECTIONS = ('ingress', 'egress')
+    LIMITS_FILENAME = 'limits.json'
+    LIMITS_CHECK_INTERVAL = 1.0  # seconds
+    BURST = 1.0  # seconds' worth of tokens the bucket holds
+    GRANT_SECONDS = 0.1
+    GRANT_BYTES = 1 * MB
+
+    def __init__(self):
+        self.state_dir = self.DEFAULT_STATE_DIR
+        self._owner = None  # this process's pid, once it has set limits
+        self._state = {}
+        self._limits_checked_at = 0
+        self._limits_mtime = None
+        self._allowances = {}  # direction: bytes granted to this process and not yet used
+        self._allowances_pid = None
+        self._lock = threading.Lock()
+
+    def configure(self, state_dir: str=None):
+        self.state_dir = state_dir or self.DEFAULT_STATE_DIR
+
+    def set_limits(self, ingress_mb_per_second: float=None, egress_mb_per_second: float=None,
+                   owner: int=None) -> dict:
+        """
+        Change the limits (in MB/s, 0 for unlimited) for every process using this state folder.
+        A limit given as None is left as it is.  A run passes its pid as `owner`, and should release() the
+        limits when it ends.  Without an owner (e.g. --adjust-bandwidth), only limits of runs still in progress
+        are changed.  Returns the limits now in force.
+        """
+        changes = {direction: limit for direction, limit in zip(self.DIRECTIONS,
+                                                                (ingress_mb_per_second, egress_mb_per_second))
+                   if limit is not None}
+        with self._limits_lock():
+            state = self._read_state()
+            if owner and not state:
+                self._remove_state()  # whatever is left by runs that have died
+            if owner:
+                state['owners'] = sorted(set(state.get('owners', [])) | {owner})
+                self._owner = owner
+            if state.get('owners'):
+                state.update(changes)
+                state = {key: value for key, value in state.items() if value}
+                self._write_state(state)
+            else:
+                self._remove_state()
+        self._limits_checked_at = 0
+        return self._limits_of(state)
+
+    def release(self):
+        """ Drop this run's claim on the limits it set; they go once no run that set them remains """
+        if self._owner != os.getpid():
+            return
+        with self._limits_lock():
+            state = self._read_state()
+            state['owners'] = [pid for pid in state.get('owners', []) if pid != self._owner]
+            if state['owners']:
+                self._write_state(state)
+            else:
+                self._remove_state()
+        self._owner = None
+
+    def limits(self) -> dict:
+        now = time.time()
+        if now - self._limits_checked_at >= self.LIMITS_CHECK_INTERVAL:
+            self._limits_checked_at = now
+            try:
+                mtime = os.stat(self._state_file(self.LIMITS_FILENAME)).st_mtime
+                if mtime != self._limits_mtime:
+                    with open(self._state_file(self.LIMITS_FILENAME)) as fh:
+                        self._state = json.load(fh)
+                    self._limits_mtime = mtime
+            except (OSError, ValueError):
+                self._state, self._limits_mtime = {}, None
+            if not any(self._is_alive(pid) for pid in self._state.get('owners', [])):
+                self._state = {}  # left by runs that died without release()ing them
+        return self._limits_of(self._state)
+
+    def consume(self, direction: str, byte_count: int):
+        """ Wait until `byte_count` bytes may be transferred in this direction """
+        mb_per_second = self.limits().get(direction)
+        if not mb_per_second or byte_count <= 0:
+            return
+        bytes_per_second = mb_per_second * MB
+        with self._lock:
+            if self._allowances_pid != os.getpid():
+                self._allowances, self._allowances_pid = {}, os.getpid()
+            allowance = self._allowances.get(direction, 0)
+            if allowance >= byte_count:
+                self._allowances[direction] = allowance - byte_count
+                return
+            grant = max(byte_count - allowance, self.GRANT_BYTES, int(bytes_per_second * self.GRANT_SECONDS))
+            self._allowances[direction] = allowance + grant - byte_count
+        with open(self._state_file(direction), 'a+') as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            fh.seek(0)
+            now = time.time()
+            empty_at = max(now, float(fh.read() or 0)) + grant / bytes_per_second
+            fh.seek(0)
+            fh.truncate()
+            fh.write(str(empty_at))
+            fh.flush()
+        time.sleep(max(0.0, empty_at - now - self.BURST))
+
+    def ingress(self, byte_count: int):
+        self.consume('ingress', byte_count)
+
+    def egress(self, byte_count: int):
+        self.consume('egress', byte_count)
+
+    def _read_state(self) -> dict:
+        """ The limits and their live owners; nothing, if no owner is alive (stale limits are dropped) """
+        try:
+            with open(self._state_file(self.LIMITS_FILENAME)) as fh:
+                state = json.load(fh)
+        except (OSError, ValueError):
+            return {}
+        state['owners'] = [pid for pid in state.get('owners', []) if self._is_alive(pid)]
+        return state if state['owners'] else {}
+
+    def _write_state(self, state: dict):
+        path = self._state_file(self.LIMITS_FILENAME)
+        with open(f"{path}.tmp", 'w') as fh:
+            json.dump(state, fh)
+        os.replace(f"{path}.tmp", path)
+
+    def _remove_state(self):
+        for name in (self.LIMITS_FILENAME,) + self.DIRECTIONS:
+            try:
+                os.remove(self._state_file(name))
+            except FileNotFoundError:
+                pass
+
+    @contextmanager
+    def _limits_lock(self):
+        with open(self._state_file(f"{self.LIMITS_FILENAME}.lock"), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    @classmethod
+    def _limits_of(cls, state: dict) -> dict:
+        return {direction: state[direction] for direction in cls.DIRECTIONS if state.get(direction)}
+
+    @staticmethod
+    def _is_alive(pid: int) -> bool:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def _state_file(self, name: str) -> str:
+        os.makedirs(self.state_dir, mode=0o700, exist_ok=True)
+        return os.path.join(self.state_dir, name)
+
+
+class ThrottledReader(io.RawIOBase):
+    """ Wraps a raw stream, e.g. an HTTP response, counting what is read from it against a direction's budget """
+
+    def __init__(self, raw, direction: str, limiter: BandwidthLimiter):
+        self.raw = raw
+        self.direction = direction
+        self.limiter = limiter
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        byte_count = self.raw.readinto(buffer)
+        if byte_count:
+            self.limiter.consume(self.direction, byte_count)
+        return byte_count
+
+
+bandwidth_limiter = BandwidthLimiter()
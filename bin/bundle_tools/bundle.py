@@ -1,8 +1,10 @@
-import glob, json, os
+import glob, hashlib, json, os
 
 from urllib3.util import Url
 
-from .utils import file_size, MB
+from .utils import MB
+from .sizes import file_size_resolver
+from .discovery import bundle_discovery
 import bundle_tools.submission
 
 
@@ -45,6 +47,8 @@ class Bundle:
         self.path = path
         self.files = dict()  # 'file name': File
         self.submission_info = None
+        self.fingerprint = None
+        self.verified_files = set()  # names of files already found to be correctly staged, see BundleVerifier
 
     def __lt__(self, other):
         return self.path < other.path
@@ -57,15 +61,13 @@ class Bundle:
 class LocalBundle(Bundle):
 
     MANIFEST_FILENAME = 'manifest.json'
-    BUNDLE_HOME_DIRNAME = 'bundles'  # Folders containing bundles
+    BUNDLE_HOME_DIRNAME = bundle_discovery.BUNDLE_HOME_DIRNAME  # Folders containing bundles
 
     @classmethod
     def bundles_under(cls, folder):
-        for bundle_home in glob.glob(f"{folder}/**/{cls.BUNDLE_HOME_DIRNAME}", recursive=True):
-            bundle_dirs = os.listdir(bundle_home)
-            for bundle_dir in bundle_dirs:
-                bundle_path = os.path.join(bundle_home, bundle_dir)
-                yield cls(bundle_path)
+        """ Yields the bundles under folder, in path order, see BundleDiscovery """
+        for bundle_path in bundle_discovery.bundle_paths(folder):
+            yield cls(bundle_path)
 
     def __init__(self, local_path):
         super().__init__(path=local_path)
@@ -80,28 +82,40 @@ class LocalBundle(Bundle):
                 if name not in self.files:
                     self.add_file(MetadataFile(name=name, size=os.stat(path).st_size))
 
+    def compute_fingerprint(self) -> str:
+        """ A cheap digest of the names, sizes and mtimes of the bundle's JSON files, and its manifest's entries """
+        digest = hashlib.sha256()
+        for path in sorted(glob.glob(f"{self.path}/*.json")):
+            stat = os.stat(path)
+            digest.update(f"{os.path.basename(path)}\t{stat.st_size}\t{stat.st_mtime}\n".encode('utf8'))
+        if self.manifest is not None:
+            with open(self.manifest, 'r') as data:
+                manifest = json.load(data)
+            for fileinfo in manifest['files']:
+                digest.update(f"{manifest['dir']}/{fileinfo['name']}\n".encode('utf8'))
+        return digest.hexdigest()
+
     def enumerate_data_files_using_manifest(self):
         if self.manifest is None:
             raise RuntimeError(f"Bundle {self.path} has no {self.MANIFEST_FILENAME}")
         with open(self.manifest, 'r') as data:
             manifest = json.load(data)
-            for fileinfo in manifest['files']:
-                if fileinfo['name'] not in self.files:
-                    self.add_file(
-                        DataFile(name=fileinfo['name'],
-                                 size=(file_size(f"{manifest['dir']}/{fileinfo['name']}")),
-                                 origin_url=f"{manifest['dir']}/{fileinfo['name']}")
-                    )
+        new_files = [fileinfo['name'] for fileinfo in manifest['files'] if fileinfo['name'] not in self.files]
+        sizes = file_size_resolver.sizes([f"{manifest['dir']}/{name}" for name in new_files])
+        for name in new_files:
+            origin_url = f"{manifest['dir']}/{name}"
+            self.add_file(DataFile(name=name, size=sizes[origin_url], origin_url=origin_url))
 
 
 class StagedBundle(Bundle):
 
-    def __init__(self, location: Url):
+    def __init__(self, location: Url, info: dict=None, etag: str=None):
+        """ info: the bundle's submission info as of submission.json ETag etag, if known, see SubmissionInfo.load() """
         self.bucket = location.netloc
         self.uuid = None
         super().__init__(location.path.rstrip('/'))
         self.submission_info = bundle_tools.submission.SubmissionInfo(self.bucket, self)
-        self.submission_info.load()
+        self.submission_info.load(info, etag)
 
     def all_files_are_smaller_than(self, this_many_mb):
         f = filter(lambda file: file.size > (this_many_mb * MB), self.files.values())
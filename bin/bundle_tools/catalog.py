@@ -0,0 +1,104 @@
+import json, os, sqlite3, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+from .clients import clients
+from .s3 import S3ObjectTagger
+
+
+class StagedStateCatalog:
+    """
+    A local SQLite record of objects that were found to be correctly staged, keyed by target URL.
+
+    Re-runs consult the catalog before checking S3.  An entry is trusted for `ttl` seconds.  Once it is
+    more than half way through its life, it is still trusted, but is also re-validated against S3 in
+    a background thread, which refreshes or drops it.  The database may be shared by many processes.
+    """
+
+    DEFAULT_TTL_HOURS = 24
+    SCHEMA = """CREATE TABLE IF NOT EXISTS staged_objects (
+                    url TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    etag TEXT NOT NULL,
+                    tags TEXT NOT NULL,
+                    local_mtime REAL,
+                    checked_at REAL NOT NULL)"""
+
+    def __init__(self):
+        self.path = None
+        self.ttl = self.DEFAULT_TTL_HOURS * 3600
+        self._local = threading.local()
+        self._revalidator = None
+        self._revalidator_pid = None
+
+    def configure(self, path: str=None, ttl_hours: float=DEFAULT_TTL_HOURS):
+        self.path = path
+        self.ttl = ttl_hours * 3600
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    def is_staged(self, url: str, size: int, local_mtime: float=None) -> bool:
+        if not self.enabled:
+            return False
+        row = self._db().execute("SELECT size, local_mtime, checked_at FROM staged_objects WHERE url = ?",
+                                 (url,)).fetchone()
+        if row is None:
+            return False
+        entry_size, entry_mtime, checked_at = row
+        if entry_size != size or (local_mtime is not None and entry_mtime != local_mtime):
+            return False
+        age = time.time() - checked_at
+        if age >= self.ttl:
+            return False
+        if age >= self.ttl / 2:
+            self._background().submit(self._revalidate, url)
+        return True
+
+    def record(self, url: str, size: int, etag: str, tags: dict, local_mtime: float=None):
+        if not self.enabled:
+            return
+        with self._db() as db:
+            db.execute("INSERT OR REPLACE INTO staged_objects VALUES (?, ?, ?, ?, ?, ?)",
+                       (url, size, etag, json.dumps(tags), local_mtime, time.time()))
+
+    def forget(self, url: str):
+        if not self.enabled:
+            return
+        with self._db() as db:
+            db.execute("DELETE FROM staged_objects WHERE url = ?", (url,))
+
+    def _revalidate(self, url: str):
+        s3 = clients.s3_agent()
+        row = self._db().execute("SELECT size, etag FROM staged_objects WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            return
+        size, etag = row
+        obj = s3.get_object(url)
+        if obj and obj.content_length == size and obj.e_tag.strip('"') == etag:
+            tags = s3.get_tagging(url)
+            if all(tag in tags for tag in S3ObjectTagger.ALL_TAGS) and tags['hca-dss-s3_etag'] == etag:
+                with self._db() as db:
+                    db.execute("UPDATE staged_objects SET tags = ?, checked_at = ? WHERE url = ?",
+                               (json.dumps(tags), time.time(), url))
+                return
+        self.forget(url)
+
+    def _background(self) -> ThreadPoolExecutor:
+        if self._revalidator_pid != os.getpid():
+            self._revalidator = ThreadPoolExecutor(max_workers=2)
+            self._revalidator_pid = os.getpid()
+        return self._revalidator
+
+    def _db(self) -> sqlite3.Connection:
+        """ One connection per process and thread, as SQLite connections must not cross either boundary """
+        if getattr(self._local, 'pid', None) != os.getpid():
+            db = sqlite3.connect(self.path, timeout=60)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(self.SCHEMA)
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return self._local.db
+
+
+staged_catalog = StagedStateCatalog()
@@ -0,0 +1,110 @@
+import hashlib, json, os, sqlite3, threading, time
+
+
+class ChecksumCache:
+    """
+    A persistent cache of the checksums of local files.
+
+    Files are looked up by (path, size, mtime, inode).  If that misses, the file is fingerprinted with
+    a single fast digest and looked up by content, so byte-identical files (e.g. the same project.json
+    in hundreds of bundles) are only ever run through the full set of checksummers once.
+    The least recently used entries are evicted once the cache holds more than `max_entries`.
+    """
+
+    DEFAULT_MAX_ENTRIES = 1000000
+    EVICTION_CHECK_INTERVAL = 1000  # inserts
+    BUFFER_SIZE = 1024 * 1024
+    SCHEMA = ("""CREATE TABLE IF NOT EXISTS file_stats (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    inode INTEGER NOT NULL,
+                    digest TEXT NOT NULL,
+                    last_used REAL NOT NULL)""",
+              """CREATE TABLE IF NOT EXISTS content_checksums (
+                    digest TEXT PRIMARY KEY,
+                    checksums TEXT NOT NULL,
+                    last_used REAL NOT NULL)""",
+              "CREATE INDEX IF NOT EXISTS file_stats_lru ON file_stats (last_used)",
+              "CREATE INDEX IF NOT EXISTS content_checksums_lru ON content_checksums (last_used)")
+
+    def __init__(self):
+        self.path = None
+        self.max_entries = self.DEFAULT_MAX_ENTRIES
+        self._local = threading.local()
+        self._inserts = 0
+
+    def configure(self, path: str=None, max_entries: int=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    def checksums(self, path: str, compute) -> dict:
+        """ Return the checksums of the file at `path`, calling compute(path) only if they are not cached """
+        if not self.enabled:
+            return compute(path)
+        stat = os.stat(path)
+        now = time.time()
+        key = os.path.abspath(path)
+        with self._db() as db:
+            row = db.execute("""SELECT content_checksums.digest, checksums FROM file_stats
+                                JOIN content_checksums ON file_stats.digest = content_checksums.digest
+                                WHERE path = ? AND size = ? AND mtime_ns = ? AND inode = ?""",
+                             (key, stat.st_size, stat.st_mtime_ns, stat.st_ino)).fetchone()
+            if row:
+                digest, checksums = row
+                self._touch(db, key, digest, now)
+                return json.loads(checksums)
+        digest = self._content_digest(path)
+        with self._db() as db:
+            row = db.execute("SELECT checksums FROM content_checksums WHERE digest = ?", (digest,)).fetchone()
+        if row:
+            checksums = json.loads(row[0])
+        else:
+            checksums = compute(path)
+        with self._db() as db:
+            db.execute("INSERT OR REPLACE INTO content_checksums VALUES (?, ?, ?)",
+                       (digest, json.dumps(checksums), now))
+            db.execute("INSERT OR REPLACE INTO file_stats VALUES (?, ?, ?, ?, ?, ?)",
+                       (key, stat.st_size, stat.st_mtime_ns, stat.st_ino, digest, now))
+            self._evict_if_necessary(db)
+        return checksums
+
+    @staticmethod
+    def _touch(db, path: str, digest: str, now: float):
+        db.execute("UPDATE file_stats SET last_used = ? WHERE path = ?", (now, path))
+        db.execute("UPDATE content_checksums SET last_used = ? WHERE digest = ?", (now, digest))
+
+    def _content_digest(self, path: str) -> str:
+        hasher = hashlib.blake2b()
+        with open(path, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(self.BUFFER_SIZE), b''):
+                hasher.update(chunk)
+        return hasher.hexdigest()
+
+    def _evict_if_necessary(self, db):
+        self._inserts += 1
+        if self._inserts % self.EVICTION_CHECK_INTERVAL:
+            return
+        for table in ('file_stats', 'content_checksums'):
+            excess = db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] - self.max_entries
+            if excess > 0:
+                db.execute(f"""DELETE FROM {table} WHERE rowid IN
+                               (SELECT rowid FROM {table} ORDER BY last_used LIMIT ?)""", (excess,))
+
+    def _db(self) -> sqlite3.Connection:
+        """ One connection per process and thread, as SQLite connections must not cross either boundary """
+        if getattr(self._local, 'pid', None) != os.getpid():
+            db = sqlite3.connect(self.path, timeout=60)
+            db.execute("PRAGMA journal_mode=WAL")
+            for statement in self.SCHEMA:
+                db.execute(statement)
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return self._local.db
+
+
+checksum_cache = ChecksumCache()
@@ -0,0 +1,344 @@
+import hashlib, mmap, os, queue, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from io import BufferedReader
+
+from .crc32c import Crc32c, crc32c_registry, crc32c_combine
+
+KB = 1024
+MB = KB * KB
+
+
+class ChecksummingAborted(Exception):
+    pass
+
+
+class S3EtagHasher:
+    """
+    Computes the ETag S3 gives an object uploaded in parts of `part_size` bytes, if it is at least
+    `multipart_threshold` (by default `part_size`) bytes long, or in a single PUT otherwise.
+    """
+
+    def __init__(self, part_size: int=64 * MB, multipart_threshold: int=None):
+        self.part_size = part_size
+        self.multipart_threshold = multipart_threshold or part_size
+        self._total_bytes = 0
+        self._part_bytes = 0
+        self._part_digests = []
+        self._md5 = hashlib.md5()
+
+    def update(self, chunk: bytes):
+        view = memoryview(chunk)
+        self._total_bytes += len(view)
+        while len(view):
+            take = min(len(view), self.part_size - self._part_bytes)
+            self._md5.update(view[:take])
+            self._part_bytes += take
+            view = view[take:]
+            if self._part_bytes == self.part_size:
+                self._part_digests.append(self._md5.digest())
+                self._md5 = hashlib.md5()
+                self._part_bytes = 0
+
+    def hexdigest(self) -> str:
+        part_digests = self._part_digests + ([self._md5.digest()] if self._part_bytes else [])
+        return S3RangedChecksummer._s3_etag(part_digests, multipart=self._total_bytes >= self.multipart_threshold)
+
+
+class PipelinedChecksummer:
+    """
+    Runs each checksum algorithm in its own worker thread, fed from its own bounded queue.
+
+    hashlib releases the GIL while hashing, so the algorithms run in parallel with each other and with
+    whatever is producing the data.  update() blocks once any algorithm is `queue_depth` chunks behind.
+    Chunks must be immutable (bytes), as they are shared between the workers without copying.
+    """
+
+    DEFAULT_QUEUE_DEPTH = 4
+    _END = None
+
+    def __init__(self, part_size: int=64 * MB, queue_depth: int=DEFAULT_QUEUE_DEPTH, multipart_threshold: int=None):
+        self._hashers = dict(crc32c=Crc32c(),
+                             sha1=hashlib.sha1(),
+                             sha256=hashlib.sha256(),
+                             s3_etag=S3EtagHasher(part_size, multipart_threshold))
+        self._queues = {name: queue.Queue(maxsize=queue_depth) for name in self._hashers}
+        self._errors = []
+        self._checksums = None
+        self._workers = [threading.Thread(target=self._hash, args=(name,), daemon=True) for name in self._hashers]
+        for worker in self._workers:
+            worker.start()
+
+    def update(self, chunk: bytes):
+        if self._errors:
+            raise self._errors[0]
+        for chunk_queue in self._queues.values():
+            chunk_queue.put(chunk)
+
+    def get_checksums(self) -> dict:
+        if self._checksums is None:
+            self.close()
+            if self._errors:
+                raise self._errors[0]
+            self._checksums = {name: hasher.hexdigest() for name, hasher in self._hashers.items()}
+        return dict(self._checksums)
+
+    def close(self):
+        if any(worker.is_alive() for worker in self._workers):
+            for chunk_queue in self._queues.values():
+                chunk_queue.put(self._END)
+            for worker in self._workers:
+                worker.join()
+
+    def _hash(self, name: str):
+        hasher = self._hashers[name]
+        chunk_queue = self._queues[name]
+        failed = False
+        for chunk in iter(chunk_queue.get, self._END):
+            if failed:
+                continue  # Keep draining, so update() never blocks on a dead worker.
+            try:
+                hasher.update(chunk)
+            except Exception as e:
+                self._errors.append(e)
+                failed = True
+
+
+class PipelinedChecksummingReader:
+    """
+    A drop-in replacement for checksumming_io's ChecksummingBufferedReader that checksums what is read
+    with a PipelinedChecksummer, so reading never waits for more than the slowest single algorithm.
+    """
+
+    def __init__(self, raw, part_size: int=64 * MB, queue_depth: int=PipelinedChecksummer.DEFAULT_QUEUE_DEPTH,
+                 multipart_threshold: int=None):
+        self._reader = BufferedReader(raw)
+        self.raw = self._reader.raw
+        self._checksummer = PipelinedChecksummer(part_size=part_size, queue_depth=queue_depth,
+                                                 multipart_threshold=multipart_threshold)
+
+    def read(self, size=None):
+        chunk = self._reader.read(size)
+        if chunk:
+            self._checksummer.update(bytes(chunk))
+        return chunk
+
+    def get_checksums(self) -> dict:
+        return self._checksummer.get_checksums()
+
+    def close(self):
+        self._checksummer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
+
+
+class LocalFileChecksummer:
+    """
+    Computes the checksums of a local file, in the same form as PipelinedChecksummer, from a memory map of it.
+
+    The file is divided into parts of `part_size` (which must be the part size it is, or will be, uploaded
+    with, above `multipart_threshold`, by default `part_size`).  Each part's MD5 (for the S3 ETag) and CRC32C
+    are computed on a pool of `workers` threads, and the part CRCs are combined.  Meanwhile sha1 and sha256
+    each run over the whole mapping in a thread of their own.  No data is copied.  hashlib and the crc32c
+    package release the GIL, so this scales with cores.  The crcmod and pure-python CRC32C backends hold it,
+    so with those the part CRCs run one at a time (alongside the hashes).
+    """
+
+    def __init__(self, path: str, part_size: int, workers: int=None, multipart_threshold: int=None):
+        self.path = path
+        self.part_size = part_size
+        self.workers = workers or os.cpu_count() or 1
+        self.multipart_threshold = multipart_threshold or part_size
+
+    def checksums(self) -> dict:
+        size = os.path.getsize(self.path)
+        if size == 0:
+            return self._checksum(memoryview(b''), size)
+        with open(self.path, 'rb') as fh:
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+                view = memoryview(mapping)
+                try:
+                    return self._checksum(view, size)
+                finally:
+                    view.release()
+
+    def _checksum(self, view: memoryview, size: int) -> dict:
+        parts = [(start, min(start + self.part_size, size)) for start in range(0, size, self.part_size)]
+        if len(parts) <= 1 or self.workers == 1:
+            sha1, sha256 = hashlib.sha1(view), hashlib.sha256(view)
+            part_checksums = [self._checksum_part(view, start, end) for start, end in parts]
+        else:
+            with ThreadPoolExecutor(max_workers=self.workers + 2) as executor:
+                sha1 = executor.submit(hashlib.sha1, view)
+                sha256 = executor.submit(hashlib.sha256, view)
+                part_futures = [executor.submit(self._checksum_part, view, start, end) for start, end in parts]
+                sha1, sha256 = sha1.result(), sha256.result()
+                part_checksums = [future.result() for future in part_futures]
+        crc = 0
+        for (start, end), (md5, part_crc) in zip(parts, part_checksums):
+            crc = crc32c_combine(crc, part_crc, end - start)
+        return dict(crc32c='%08X' % crc,
+                    sha1=sha1.hexdigest(),
+                    sha256=sha256.hexdigest(),
+                    s3_etag=S3RangedChecksummer._s3_etag([md5 for md5, part_crc in part_checksums],
+                                                         multipart=size >= self.multipart_threshold))
+
+    @staticmethod
+    def _checksum_part(view: memoryview, start: int, end: int) -> tuple:
+        part = view[start:end]
+        try:
+            return hashlib.md5(part).digest(), crc32c_registry.backend().extend(0, part)
+        finally:
+            part.release()
+
+
+def checksum_selftest(sample_size: int=32 * MB, time_limit: float=1.0) -> list:
+    """
+    Measure the speed of each checksum algorithm, and of each CRC32C backend, on this host.
+    Returns a list of (name, MB/s, note) tuples.  A CRC32C backend that disagrees with the others is noted.
+    """
+    sample = os.urandom(sample_size)
+    chosen = crc32c_registry.backend()
+    expected = Crc32c(sample[:MB + 3], backend=chosen).hexdigest()
+    candidates = [(f"crc32c ({backend.name})", lambda backend=backend: Crc32c(backend=backend),
+                   "in use" if backend.name == chosen.name else
+                   "" if Crc32c(sample[:MB + 3], backend=backend).hexdigest() == expected else "MISMATCH")
+                  for backend in crc32c_registry.available_backends()]
+    candidates += [("sha1", hashlib.sha1, ""), ("sha256", hashlib.sha256, ""), ("s3_etag", S3EtagHasher, "")]
+    results = []
+    for name, make_hasher, note in candidates:
+        hasher = make_hasher()
+        bytes_hashed = 0
+        start = time.perf_counter()
+        while bytes_hashed < sample_size and time.perf_counter() - start < time_limit:
+            hasher.update(sample[bytes_hashed:bytes_hashed + MB])
+            bytes_hashed += MB
+        results.append((name, bytes_hashed / MB / (time.perf_counter() - start), note))
+    return results
+
+
+class ReorderBuffer:
+    """
+    Collects blocks of a file that arrive out of order, and hands them out in order.
+
+    Holds at most `max_bytes`, except that the block that is next in line is always accepted,
+    so the producer of the earliest outstanding part can never be starved of space.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._blocks = {}
+        self._next_offset = 0
+        self._buffered_bytes = 0
+        self._failed = False
+        self._condition = threading.Condition()
+
+    def put(self, offset: int, block: bytes):
+        with self._condition:
+            while not self._failed and offset != self._next_offset \
+                    and self._buffered_bytes + len(block) > self.max_bytes:
+                self._condition.wait()
+            if self._failed:
+                raise ChecksummingAborted()
+            self._blocks[offset] = block
+            self._buffered_bytes += len(block)
+            self._condition.notify_all()
+
+    def get(self) -> bytes:
+        with self._condition:
+            while not self._failed and self._next_offset not in self._blocks:
+                self._condition.wait()
+            if self._failed:
+                raise ChecksummingAborted()
+            block = self._blocks.pop(self._next_offset)
+            self._buffered_bytes -= len(block)
+            self._next_offset += len(block)
+            self._condition.notify_all()
+            return block
+
+    def fail(self):
+        with self._condition:
+            self._failed = True
+            self._condition.notify_all()
+
+
+class S3RangedChecksummer:
+    """
+    Computes the checksums of an S3 object, in the same form as checksumming_io's ChecksummingSink,
+    by fetching it as concurrent ranged GETs.
+
+    Ranges are aligned with the object's ETag parts, so each part's MD5 is computed independently by the
+    thread that fetched it.  Like s3transfer, objects of at least `multipart_threshold` bytes (by default
+    `part_size`) are taken to have been uploaded in parts, so an object of exactly one part has a "-1" ETag.
+    Checksums that need the bytes in order (crc32c, sha1, sha256) are fed from a ReorderBuffer,
+    which bounds how far ahead of them the fetching threads may get.
+    """
+
+    BLOCK_SIZE = 8 * MB
+    DEFAULT_CONCURRENCY = 8
+
+    def __init__(self, s3client, part_size: int, concurrency: int=DEFAULT_CONCURRENCY,
+                 multipart_threshold: int=None):
+        self.s3client = s3client
+        self.part_size = part_size
+        self.concurrency = concurrency
+        self.multipart_threshold = multipart_threshold or part_size
+
+    def checksums(self, bucket: str, key: str, size: int, etag: str) -> dict:
+        ordered_hashers = dict(crc32c=Crc32c(), sha1=hashlib.sha1(), sha256=hashlib.sha256())
+        buffer = ReorderBuffer(max_bytes=2 * self.concurrency * self.BLOCK_SIZE)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = [executor.submit(self._fetch_part, bucket, key, etag, start, min(start + self.part_size, size),
+                                       buffer)
+                       for start in range(0, size, self.part_size)]
+            try:
+                bytes_hashed = 0
+                while bytes_hashed < size:
+                    block = buffer.get()
+                    for hasher in ordered_hashers.values():
+                        hasher.update(block)
+                    bytes_hashed += len(block)
+            except ChecksummingAborted:
+                pass  # A part failed; its exception is re-raised below.
+            except Exception:
+                buffer.fail()
+                raise
+        errors = [future.exception() for future in futures
+                  if future.exception() and not isinstance(future.exception(), ChecksummingAborted)]
+        if errors:
+            raise errors[0]
+        part_digests = [future.result() for future in futures]
+        checksums = {name: hasher.hexdigest() for name, hasher in ordered_hashers.items()}
+        checksums['s3_etag'] = self._s3_etag(part_digests, multipart=size >= self.multipart_threshold)
+        return checksums
+
+    def _fetch_part(self, bucket: str, key: str, etag: str, start: int, end: int, buffer: ReorderBuffer) -> bytes:
+        try:
+            response = self.s3client.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{end - 1}",
+                                                IfMatch=etag)
+            md5 = hashlib.md5()
+            offset = start
+            for block in iter(lambda: response['Body'].read(self.BLOCK_SIZE), b''):
+                md5.update(block)
+                buffer.put(offset, block)
+                offset += len(block)
+            if offset != end:
+                raise RuntimeError(f"s3://{bucket}/{key}: received bytes {start}-{offset}, expected {start}-{end}")
+            return md5.digest()
+        except ChecksummingAborted:
+            raise
+        except Exception:
+            buffer.fail()
+            raise
+
+    @staticmethod
+    def _s3_etag(part_digests: list, multipart: bool=False) -> str:
+        """ The ETag of an object made of these parts: a multipart upload's if `multipart` or there are several """
+        if multipart or len(part_digests) > 1:
+            return f"{hashlib.md5(b''.join(part_digests)).hexdigest()}-{len(part_digests)}"
+        elif part_digests:
+            return part_digests[0].hex()
+        return hashlib.md5().hexdigest()
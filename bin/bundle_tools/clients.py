@@ -0,0 +1,79 @@
+import os, threading
+
+import boto3
+import urllib3
+from botocore.config import Config
+
+from .s3 import S3Agent, S3ObjectStateCache
+
+
+class ClientFactory:
+    """
+    The one place bundle_tools gets its boto3 and urllib3 clients from.
+
+    Clients are created lazily, once per process, so ProcessPoolExecutor workers never use connections
+    inherited from their parent, and connection pools are reused across files and bundles.  boto3
+    clients are thread-safe and shared by all threads of a process; boto3 resources are not, so each
+    thread gets its own S3Agent (all of them sharing the process's client and S3ObjectStateCache).
+
+    HTTP requests time out if the server stalls, and failed connections and reads are retried.
+    """
+
+    DEFAULT_MAX_POOL_CONNECTIONS = 10
+    HTTP_TIMEOUT = urllib3.Timeout(connect=10.0, read=60.0)
+    HTTP_RETRIES = urllib3.Retry(connect=3, read=2, redirect=5, status=0, backoff_factor=1.0, raise_on_status=False)
+
+    def __init__(self):
+        self.max_pool_connections = self.DEFAULT_MAX_POOL_CONNECTIONS
+        self._lock = None
+        self._lock_pid = None
+        self._pid = None
+        self._thread_local = threading.local()
+
+    def configure(self, max_pool_connections: int=DEFAULT_MAX_POOL_CONNECTIONS):
+        self.max_pool_connections = max_pool_connections
+
+    def s3_agent(self) -> S3Agent:
+        self._check_process()
+        if getattr(self._thread_local, 'pid', None) != self._pid:
+            with self._process_lock():
+                resource = self._session.resource('s3', config=self._botocore_config())
+            self._thread_local.s3_agent = S3Agent(resource=resource, client=self._s3client,
+                                                  state_cache=self._s3_state_cache)
+            self._thread_local.pid = self._pid
+        return self._thread_local.s3_agent
+
+    def s3client(self):
+        self._check_process()
+        return self._s3client
+
+    def http(self) -> urllib3.PoolManager:
+        self._check_process()
+        return self._http
+
+    def _check_process(self):
+        if self._pid != os.getpid():
+            with self._process_lock():
+                if self._pid != os.getpid():
+                    self._session = boto3.session.Session()
+                    self._s3client = self._session.client('s3', config=self._botocore_config())
+                    self._s3_state_cache = S3ObjectStateCache()
+                    self._http = urllib3.PoolManager(maxsize=self.max_pool_connections,
+                                                     timeout=self.HTTP_TIMEOUT, retries=self.HTTP_RETRIES)
+                    self._pid = os.getpid()
+
+    def _process_lock(self) -> threading.Lock:
+        """
+        A lock that another thread held when this process was forked stays held in the child for ever,
+        so, like the clients themselves, each process gets its own.
+        """
+        if self._lock_pid != os.getpid():
+            self._lock = threading.Lock()
+            self._lock_pid = os.getpid()
+        return self._lock
+
+    def _botocore_config(self) -> Config:
+        return Config(max_pool_connections=self.max_pool_connections)
+
+
+clients = ClientFactory()
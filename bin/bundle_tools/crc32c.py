@@ -0,0 +1,287 @@
+"""
+CRC32C (Castagnoli) implementations, and a registry that picks the fastest one available on this host.
+
+Every backend computes the same function as crcmod.predefined.Crc("crc-32c"), and Crc32c.hexdigest()
+formats it the same way ('%08X'), so hca-dss-crc32c tags never depend on which backend produced them.
+Backends extend a finished CRC with more data, as zlib.crc32 does: extend(extend(0, a), b) == extend(0, a + b).
+"""
+
+import os, time
+
+POLYNOMIAL = 0x82F63B78  # bit-reflected
+CHECK_INPUT = b"123456789"
+CHECK_VALUE = 0xE3069283
+
+
+def _make_table() -> list:
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ (POLYNOMIAL if crc & 1 else 0)
+        table.append(crc)
+    return table
+
+
+TABLE = _make_table()
+
+
+# GF(2) matrix arithmetic, as in zlib's crc32_combine().  A matrix is a list of 32 columns, column i
+# being the image of bit i.  Appending n zero bytes to a message transforms its CRC register linearly.
+
+def _gf2_times(matrix: list, vector: int) -> int:
+    result = 0
+    column = 0
+    while vector:
+        if vector & 1:
+            result ^= matrix[column]
+        vector >>= 1
+        column += 1
+    return result
+
+
+def _gf2_multiply(a: list, b: list) -> list:
+    return [_gf2_times(a, column) for column in b]
+
+
+def _gf2_one_zero_byte() -> list:
+    return [TABLE[(1 << bit) & 0xFF] ^ ((1 << bit) >> 8) for bit in range(32)]
+
+
+_ZERO_BYTE_POWERS = [_gf2_one_zero_byte()]  # _ZERO_BYTE_POWERS[k] appends 2**k zero bytes
+
+
+def zeros_operator(length: int) -> list:
+    """ Returns the matrix that shifts a CRC register over `length` zero bytes """
+    result = [1 << bit for bit in range(32)]
+    power = 0
+    while length:
+        if power == len(_ZERO_BYTE_POWERS):
+            _ZERO_BYTE_POWERS.append(_gf2_multiply(_ZERO_BYTE_POWERS[-1], _ZERO_BYTE_POWERS[-1]))
+        if length & 1:
+            result = _gf2_multiply(_ZERO_BYTE_POWERS[power], result)
+        length >>= 1
+        power += 1
+    return result
+
+
+def crc32c_combine(crc1: int, crc2: int, length2: int) -> int:
+    """ Returns the CRC32C of A + B, given crc1 of A, and crc2 of B which is length2 bytes long """
+    return _gf2_times(zeros_operator(length2), crc1) ^ crc2
+
+
+class Crc32cBackend:
+
+    name = None
+
+    @classmethod
+    def available(cls) -> bool:
+        return True
+
+    def extend(self, crc: int, data) -> int:
+        raise NotImplementedError()
+
+
+class Crc32cPackageBackend(Crc32cBackend):
+    """ The crc32c package, which uses the CPU's CRC32 instructions where it can """
+
+    name = 'crc32c'
+
+    @classmethod
+    def available(cls) -> bool:
+        try:
+            import crc32c
+            return hasattr(crc32c, 'crc32c')
+        except ImportError:
+            return False
+
+    def __init__(self):
+        import crc32c
+        self._crc32c = crc32c.crc32c
+
+    def extend(self, crc: int, data) -> int:
+        return self._crc32c(data, crc)
+
+
+class CrcmodBackend(Crc32cBackend):
+    """ crcmod, but only when its C extension is built; the pure Python fallback is slower than ours """
+
+    name = 'crcmod'
+
+    @classmethod
+    def available(cls) -> bool:
+        try:
+            import crcmod._crcfunext
+            return True
+        except ImportError:
+            return False
+
+    def __init__(self):
+        import crcmod.predefined
+        self._crcfun = crcmod.predefined.mkCrcFun('crc-32c')
+
+    def extend(self, crc: int, data) -> int:
+        return self._crcfun(data, crc)
+
+
+class NumpyBackend(Crc32cBackend):
+    """
+    Table-driven CRC32C vectorized across lanes with numpy.
+
+    The data is split into 2**k equal lanes, whose CRCs are computed side by side, four bytes per step
+    ("slicing-by-4").  Lane CRCs are then merged pairwise with GF(2) shift-combine, which is linear and so
+    also vectorizes.  Whatever is left over after the last whole lane is handled by recursion.
+    """
+
+    name = 'numpy'
+    MAX_LANES = 8192
+    MIN_LANE_LENGTH = 256
+    SMALL_INPUT = 1024  # bytes; below this the pure Python loop is quicker
+
+    @classmethod
+    def available(cls) -> bool:
+        try:
+            import numpy
+            return True
+        except ImportError:
+            return False
+
+    def __init__(self):
+        import numpy
+        self.np = numpy
+        tables = [numpy.array(TABLE, dtype=numpy.uint32)]
+        for _ in range(3):
+            previous = tables[-1]
+            tables.append((previous >> numpy.uint32(8)) ^ tables[0][previous & numpy.uint32(0xFF)])
+        self._slice_tables = tables
+        self._shift_tables = {}
+
+    def extend(self, crc: int, data) -> int:
+        return self._register(crc ^ 0xFFFFFFFF, memoryview(data).cast('B')) ^ 0xFFFFFFFF
+
+    def _register(self, register: int, data: memoryview) -> int:
+        """ Returns the CRC register after feeding it data """
+        if len(data) < self.SMALL_INPUT:
+            return PythonBackend.register(register, data)
+        lanes = self.MAX_LANES
+        while lanes > 1 and len(data) // lanes < self.MIN_LANE_LENGTH:
+            lanes //= 2
+        lane_length = len(data) // lanes // 4 * 4
+        body_length = lanes * lane_length
+        body = self._lanes_register(data[:body_length], lanes, lane_length)
+        register = self._shift(register, body_length) ^ body
+        return self._register(register, data[body_length:])
+
+    def _lanes_register(self, body: memoryview, lanes: int, lane_length: int) -> int:
+        np = self.np
+        t0, t1, t2, t3 = self._slice_tables
+        byte = np.uint32(0xFF)
+        words = np.frombuffer(body, dtype='<u4').reshape(lanes, lane_length // 4).T.copy()
+        registers = np.zeros(lanes, dtype=np.uint32)
+        for word in words:
+            x = registers ^ word
+            registers = t3[x & byte] ^ t2[(x >> np.uint32(8)) & byte] ^ \
+                t1[(x >> np.uint32(16)) & byte] ^ t0[x >> np.uint32(24)]
+        width = lane_length
+        while len(registers) > 1:
+            registers = self._shift_array(registers[0::2], width) ^ registers[1::2]
+            width *= 2
+        return int(registers[0])
+
+    def _shift(self, register: int, length: int) -> int:
+        return int(self._shift_array(self.np.array([register], dtype=self.np.uint32), length)[0])
+
+    def _shift_array(self, registers, length: int):
+        np = self.np
+        tables = self._shift_tables.get(length)
+        if tables is None:
+            operator = zeros_operator(length)
+            tables = [np.array([_gf2_times(operator, value << (8 * position)) for value in range(256)],
+                               dtype=np.uint32)
+                      for position in range(4)]
+            if len(self._shift_tables) > 64:
+                self._shift_tables.clear()
+            self._shift_tables[length] = tables
+        byte = np.uint32(0xFF)
+        return tables[0][registers & byte] ^ tables[1][(registers >> np.uint32(8)) & byte] ^ \
+            tables[2][(registers >> np.uint32(16)) & byte] ^ tables[3][registers >> np.uint32(24)]
+
+
+class PythonBackend(Crc32cBackend):
+    """ Byte-at-a-time table lookup.  Slow, but always available """
+
+    name = 'python'
+
+    def extend(self, crc: int, data) -> int:
+        return self.register(crc ^ 0xFFFFFFFF, memoryview(data).cast('B')) ^ 0xFFFFFFFF
+
+    @staticmethod
+    def register(register: int, data) -> int:
+        table = TABLE
+        for byte in data:
+            register = table[(register ^ byte) & 0xFF] ^ (register >> 8)
+        return register
+
+
+BACKENDS = [Crc32cPackageBackend, CrcmodBackend, NumpyBackend, PythonBackend]
+
+
+class Crc32cRegistry:
+    """
+    Chooses the fastest working CRC32C backend on this host, by timing each available one on a small
+    sample the first time a backend is needed.  The pure Python backend is only used if nothing else works.
+    """
+
+    SAMPLE_SIZE = 1024 * 1024
+
+    def __init__(self):
+        self._backend = None
+
+    def available_backends(self) -> list:
+        backends = []
+        for backend_class in BACKENDS:
+            if backend_class.available():
+                backend = backend_class()
+                if backend.extend(0, CHECK_INPUT) == CHECK_VALUE:
+                    backends.append(backend)
+        return backends
+
+    def backend(self) -> Crc32cBackend:
+        if self._backend is None:
+            candidates = self.available_backends()
+            fast = [backend for backend in candidates if not isinstance(backend, PythonBackend)]
+            if len(fast) > 1:
+                sample = os.urandom(self.SAMPLE_SIZE)
+                fast.sort(key=lambda backend: self._time(backend, sample))
+            self._backend = (fast or candidates)[0]
+        return self._backend
+
+    def use(self, name: str):
+        self._backend = next(backend for backend in self.available_backends() if backend.name == name)
+
+    @staticmethod
+    def _time(backend: Crc32cBackend, data: bytes) -> float:
+        start = time.perf_counter()
+        backend.extend(0, data)
+        return time.perf_counter() - start
+
+
+crc32c_registry = Crc32cRegistry()
+
+
+class Crc32c:
+    """
+    A hashlib-style CRC32C hasher, using the registry's choice of backend.
+    """
+
+    def __init__(self, data=b'', backend: Crc32cBackend=None):
+        self._backend = backend or crc32c_registry.backend()
+        self.crc = 0
+        if data:
+            self.update(data)
+
+    def update(self, data):
+        self.crc = self._backend.extend(self.crc, data)
+
+    def hexdigest(self) -> str:
+        return '%08X' % self.crc
@@ -0,0 +1,103 @@
+import json, os
+from concurrent.futures import ThreadPoolExecutor
+
+
+class BundleDiscovery:
+    """
+    Finds bundle folders, i.e. the sub-folders of every folder named "bundles", in an import tree.
+
+    Folders are listed with os.scandir(), never descending into "bundles" folders, and separate branches
+    of the tree are listed concurrently on a pool of threads.  Bundle paths are yielded as soon as the
+    branches before them are done, in the same (sorted) order as a complete listing would give.
+
+    With an index file configured, the sub-folders of each folder are remembered along with its mtime.
+    Later runs reuse them for folders whose mtime is unchanged, so an unchanged tree costs a stat() per folder.
+    """
+
+    BUNDLE_HOME_DIRNAME = 'bundles'
+    DEFAULT_WORKERS = 8
+
+    def __init__(self):
+        self.index_path = None
+        self.workers = self.DEFAULT_WORKERS
+
+    def configure(self, index_path: str=None, workers: int=DEFAULT_WORKERS):
+        self.index_path = index_path
+        self.workers = workers
+
+    def bundle_paths(self, folder: str):
+        index = self._load_index()
+        updated_index = {}
+        branches = self._branches(folder, index, updated_index)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(self._walk, branch, index) for branch in branches]
+            for future in futures:
+                bundle_paths, branch_index = future.result()
+                updated_index.update(branch_index)
+                yield from bundle_paths
+        self._save_index(updated_index)
+
+    def _branches(self, folder: str, index: dict, updated_index: dict) -> list:
+        """ Split the tree into about as many branches as there are workers, keeping them in sorted order """
+        branches = self._subfolders(folder, index, updated_index)
+        while len(branches) < self.workers:
+            expanded = []
+            for branch in branches:
+                if self._is_bundle_home(branch):
+                    expanded.append(branch)
+                else:
+                    expanded.extend(self._subfolders(branch, index, updated_index))
+            if expanded == branches:
+                break
+            branches = expanded
+        return branches
+
+    def _walk(self, branch: str, index: dict) -> tuple:
+        """ Returns the sorted paths of the bundles in this branch, and the index entries of its folders """
+        branch_index = {}
+        bundle_paths = []
+        pending = [branch]
+        while pending:
+            path = pending.pop()
+            subfolders = self._subfolders(path, index, branch_index)
+            if self._is_bundle_home(path):
+                bundle_paths.extend(subfolders)
+            else:
+                pending.extend(subfolders)
+        return sorted(bundle_paths), branch_index
+
+    def _is_bundle_home(self, path: str) -> bool:
+        return os.path.basename(path) == self.BUNDLE_HOME_DIRNAME
+
+    @staticmethod
+    def _subfolders(path: str, index: dict, updated_index: dict) -> list:
+        mtime = os.stat(path).st_mtime
+        entry = index.get(path)
+        if entry and entry[0] == mtime:
+            names = entry[1]
+        else:
+            with os.scandir(path) as entries:
+                names = [entry.name for entry in entries if entry.is_dir() and not entry.name.startswith('.')]
+            # Sorting "name/" puts sub-folders in the order their contents' paths sort in.
+            names.sort(key=lambda name: name + '/')
+        updated_index[path] = [mtime, names]
+        return [os.path.join(path, name) for name in names]
+
+    def _load_index(self) -> dict:
+        if not self.index_path:
+            return {}
+        try:
+            with open(self.index_path) as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_index(self, index: dict):
+        if not self.index_path:
+            return
+        with open(f"{self.index_path}.tmp", 'w') as fh:
+            json.dump(index, fh)
+        os.replace(f"{self.index_path}.tmp", self.index_path)
+
+
+bundle_discovery = BundleDiscovery()
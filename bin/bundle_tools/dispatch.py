@@ -0,0 +1,124 @@
+import itertools, signal, time
+from concurrent.futures import wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+
+def run_batch(task, items: list, task_args: tuple) -> list:
+    """
+    Runs task(item, *task_args) on each item of a batch, in a worker process.
+    Returns (succeeded, duration, error, result) for each item.  A task that returns False has failed.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    outcomes = []
+    for item in items:
+        start = time.time()
+        result, error = None, None
+        try:
+            result = task(item, *task_args)
+            succeeded = result is not False
+        except (Exception, SystemExit) as e:
+            succeeded, error = False, f"{type(e).__name__}: {str(e)}"
+        outcomes.append((succeeded, time.time() - start, error, result))
+    return outcomes
+
+
+class RunSummary:
+    """ The outcome and duration of every task of a run """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.outcomes = []  # (name, succeeded, duration, error)
+
+    def record(self, name: str, succeeded: bool, duration: float, error: str=None):
+        self.outcomes.append((name, succeeded, duration, error))
+
+    def failures(self) -> list:
+        return [outcome for outcome in self.outcomes if not outcome[1]]
+
+    def report(self) -> str:
+        failures = self.failures()
+        lines = [f"\n{len(self.outcomes) - len(failures)} succeeded, {len(failures)} failed, "
+                 f"in {time.time() - self.started_at:.1f} sec"]
+        if self.outcomes:
+            durations = [outcome[2] for outcome in self.outcomes]
+            slowest = max(self.outcomes, key=lambda outcome: outcome[2])
+            lines.append(f"Task time: total {sum(durations):.1f} sec, mean {sum(durations) / len(durations):.1f} sec, "
+                         f"max {slowest[2]:.1f} sec ({slowest[0]})")
+        if failures:
+            lines.append("Failures:")
+            lines += [f"    {name} ({duration:.1f} sec): {error or 'failed'}" for name, _, duration, error in failures]
+        return "\n".join(lines)
+
+
+class BoundedDispatcher:
+    """
+    Runs a task on each of a stream of items on an executor, with no more than max_in_flight tasks pending.
+
+    Items are taken from their iterable only as room becomes free, so work starts as soon as the first items
+    are found, and a huge run never holds a future per item.  Quick items are batched into one task to save
+    per-task overhead: batches grow or shrink so that they take about TARGET_BATCH_SECONDS.
+    The outcome of every item, including worker exceptions, is recorded in a RunSummary, and the result of
+    each successful item is passed to on_result(item, result), if given, in this process.  Likewise the
+    error of each failed item is passed to on_failure(item, error).  Should a worker process die, taking the
+    executor with it, the items in flight are recorded as failed, and no more are taken.
+    """
+
+    TARGET_BATCH_SECONDS = 2.0
+    MAX_BATCH_SIZE = 64
+
+    def __init__(self, executor, task, task_args: tuple=(), max_in_flight: int=2, name_of=str, on_result=None,
+                 on_failure=None):
+        """ task must be a module-level function, so it can be pickled """
+        self.executor = executor
+        self.task = task
+        self.task_args = task_args
+        self.max_in_flight = max_in_flight
+        self.name_of = name_of
+        self.on_result = on_result
+        self.on_failure = on_failure
+        self.batch_size = 1
+        self.summary = RunSummary()
+
+    def run(self, items) -> RunSummary:
+        items = iter(items)
+        in_flight = {}  # future: batch of items
+        items_remain = True
+        while True:
+            while items_remain and len(in_flight) < self.max_in_flight:
+                batch = list(itertools.islice(items, self.batch_size))
+                if not batch:
+                    items_remain = False
+                    break
+                try:
+                    in_flight[self.executor.submit(run_batch, self.task, batch, self.task_args)] = batch
+                except BrokenProcessPool as e:
+                    self._record(batch, self._failed_outcomes(batch, e))
+                    items_remain = False
+            if not in_flight:
+                return self.summary
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                self._collect(future, in_flight.pop(future))
+
+    def _collect(self, future, batch: list):
+        try:
+            outcomes = future.result()
+        except Exception as e:  # e.g. the worker died
+            outcomes = self._failed_outcomes(batch, e)
+        self._record(batch, outcomes)
+        batch_duration = sum(outcome[1] for outcome in outcomes)
+        if batch_duration > 0:
+            ideal_size = len(batch) * self.TARGET_BATCH_SECONDS / batch_duration
+            self.batch_size = max(1, min(self.MAX_BATCH_SIZE, int(ideal_size), self.batch_size * 2))
+
+    def _record(self, batch: list, outcomes: list):
+        for item, (succeeded, duration, error, result) in zip(batch, outcomes):
+            self.summary.record(self.name_of(item), succeeded, duration, error)
+            if succeeded and self.on_result:
+                self.on_result(item, result)
+            elif not succeeded and self.on_failure:
+                self.on_failure(item, error or "failed")
+
+    @staticmethod
+    def _failed_outcomes(batch: list, e: Exception) -> list:
+        return [(False, 0.0, f"{type(e).__name__}: {str(e)}", None)] * len(batch)
@@ -0,0 +1,352 @@
+import ftplib, json, os, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+from urllib3.util import parse_url
+
+from .parallel_logger import logger
+from .bandwidth import bandwidth_limiter
+from .scheduling import origin_scheduler
+from .governor import resource_governor
+from .clients import clients
+from .ftp import ftp_sessions, FTPReader
+from .utils import sizeof_fmt, MB
+
+
+class RangesNotSupported(Exception):
+    pass
+
+
+class PermanentDownloadError(RuntimeError):
+    pass
+
+
+class DownloadCheckpoint:
+    """
+    Sidecar file recording how much of each byte range of a partial download has been received,
+    and the validator (ETag, Last-Modified or MDTM time) of the origin file it came from.
+    """
+
+    def __init__(self, partial_path: str, src_url: str, size: int, validator: str, ranges: list):
+        self.partial_path = partial_path
+        self.src_url = src_url
+        self.size = size
+        self.validator = validator
+        self.ranges = ranges  # [[start, end, bytes_received], ...]
+        self._lock = threading.Lock()
+
+    @classmethod
+    def path_for(cls, partial_path: str) -> str:
+        return f"{partial_path}.checkpoint"
+
+    @classmethod
+    def load(cls, partial_path: str):
+        try:
+            with open(cls.path_for(partial_path)) as fh:
+                state = json.load(fh)
+            return cls(partial_path, state['src_url'], state['size'], state['validator'], state['ranges'])
+        except (OSError, ValueError, KeyError):
+            return None
+
+    @classmethod
+    def remove(cls, partial_path: str):
+        if os.path.exists(cls.path_for(partial_path)):
+            os.remove(cls.path_for(partial_path))
+
+    def matches(self, src_url: str, size: int, validator: str) -> bool:
+        return (self.src_url, self.size, self.validator) == (src_url, size, validator) \
+            and os.path.exists(self.partial_path)
+
+    def bytes_received(self) -> int:
+        return sum(received for start, end, received in self.ranges)
+
+    def incomplete_ranges(self) -> list:
+        """ Returns (range index, next byte needed, end) for each range not yet complete """
+        return [(index, start + received, end) for index, (start, end, received) in enumerate(self.ranges)
+                if start + received <= end]
+
+    def record(self, range_index: int, bytes_received: int):
+        with self._lock:
+            self.ranges[range_index][2] = bytes_received
+            self.save()
+
+    def save(self):
+        path = self.path_for(self.partial_path)
+        with open(f"{path}.tmp", 'w') as fh:
+            json.dump(dict(src_url=self.src_url, size=self.size, validator=self.validator, ranges=self.ranges), fh)
+        os.replace(f"{path}.tmp", path)
+
+
+class Downloader:
+    """
+    Downloads are written into a "<dest>.partial" file which is renamed into place once complete, so an
+    interrupted download is never mistaken for a complete one.  Failed attempts are retried after a backoff.
+    Once retries are exhausted, a resumable download is left for a later run to resume, unless there is a
+    disk budget (see ResourceGovernor), which would not account for the space it takes.
+    Subclasses implement _attempt_download().
+    """
+
+    BUFFER_SIZE = 1 * MB
+    CHECKPOINT_INTERVAL = 16 * MB
+    MAX_ATTEMPTS = 5
+    BACKOFF_FACTOR = 1.618
+    INITIAL_BACKOFF = 2.0
+    MAX_BACKOFF = 60.0
+
+    def download(self, src_url: str, dest_path: str, size: int):
+        partial_path = f"{dest_path}.partial"
+        wait = self.INITIAL_BACKOFF
+        attempt = 1
+        while True:
+            try:
+                with origin_scheduler.connection(src_url):
+                    self._attempt_download(src_url, partial_path, size)
+                os.rename(partial_path, dest_path)
+                DownloadCheckpoint.remove(partial_path)
+                return
+            except Exception as e:
+                if isinstance(e, PermanentDownloadError) or attempt == self.MAX_ATTEMPTS:
+                    if resource_governor.disk_budget or not DownloadCheckpoint.load(partial_path):
+                        self._remove_partial_download(partial_path)
+                    raise
+                logger.output(f" (attempt {attempt} failed: {str(e)}, retrying in {wait:.0f}s)")
+                time.sleep(wait)
+                wait = min(self.MAX_BACKOFF, wait * self.BACKOFF_FACTOR)
+                attempt += 1
+
+    def _attempt_download(self, src_url: str, partial_path: str, size: int):
+        raise NotImplementedError()
+
+    @staticmethod
+    def _remove_partial_download(partial_path: str):
+        DownloadCheckpoint.remove(partial_path)
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+
+
+class HTTPDownloader(Downloader):
+    """
+    Download a file from an origin web server, over several connections at once if the server supports it.
+
+    When the server supports byte ranges, a DownloadCheckpoint is kept alongside the partial file, and failed
+    downloads are resumed (within this run, after a backoff, or in a later run) using Range requests
+    validated with If-Range.
+
+    Every connection to the origin host is counted against origin_scheduler's per-host limits,
+    and every byte received against bandwidth_limiter's ingress budget.
+    """
+
+    MIN_RANGE_SIZE = 64 * MB  # Don't bother splitting files into ranges smaller than this.
+    RETRYABLE_CLIENT_ERRORS = (408, 429)
+
+    def __init__(self, connections: int=1):
+        self.connections = connections
+
+    def _attempt_download(self, src_url: str, partial_path: str, size: int):
+        headers = self._head(src_url)
+        validator = self._validator(headers)
+        if size and validator and headers.get('Accept-Ranges') == 'bytes' \
+                and int(headers.get('Content-Length', -1)) == size:
+            checkpoint = DownloadCheckpoint.load(partial_path)
+            if checkpoint and validator is not None and checkpoint.matches(src_url, size, validator):
+                logger.output(f" (resuming after {sizeof_fmt(checkpoint.bytes_received())})")
+            else:
+                checkpoint = self._start_ranged_download(src_url, partial_path, size, validator)
+            try:
+                self._ranged_download(src_url, partial_path, checkpoint)
+                return
+            except RangesNotSupported as e:
+                logger.output(f" ({str(e)}, using a single stream)")
+        DownloadCheckpoint.remove(partial_path)
+        self._single_stream_download(src_url, partial_path)
+
+    def _number_of_ranges(self, size: int) -> int:
+        return max(1, min(self.connections, size // self.MIN_RANGE_SIZE))
+
+    def _head(self, src_url: str):
+        """ The origin file's headers.  If the server refuses HEAD (e.g. with 405), they are probed with a GET. """
+        origin_scheduler.throttle(src_url)
+        response = clients.http().request('HEAD', src_url)
+        if response.status == 200:
+            return response.headers
+        if (400 <= response.status < 500 and response.status not in self.RETRYABLE_CLIENT_ERRORS) \
+                or response.status == 501:
+            return self._probe(src_url)
+        self._check_status(src_url, response.status, 200)
+
+    def _probe(self, src_url: str):
+        """
+        Asks for just the first byte of the file.  A 206 answer carries the file's size and validator;
+        a 200 answer means ranges aren't supported, so its headers are returned without reading the body.
+        """
+        origin_scheduler.throttle(src_url)
+        with clients.http().request('GET', src_url, headers={'Range': 'bytes=0-0'},
+                                    preload_content=False) as response:
+            if response.status == 206:
+                headers = response.headers.copy()
+                total_size = headers.get('Content-Range', '').rpartition('/')[2]
+                headers['Content-Length'] = total_size if total_size.isdigit() else '-1'
+                headers['Accept-Ranges'] = 'bytes'
+                return headers
+            self._check_status(src_url, response.status, 200)
+            headers = response.headers.copy()
+            headers.discard('Accept-Ranges')
+            return headers
+
+    @staticmethod
+    def _validator(headers):
+        etag = headers.get('ETag')
+        if etag and not etag.startswith('W/'):  # Weak ETags may not be used with If-Range
+            return etag
+        return headers.get('Last-Modified')
+
+    def _check_status(self, src_url: str, status: int, expected: int):
+        if status == expected:
+            return
+        message = f"{src_url} returned status {status}"
+        if 400 <= status < 500 and status not in self.RETRYABLE_CLIENT_ERRORS:
+            raise PermanentDownloadError(message)
+        raise RuntimeError(message)
+
+    def _single_stream_download(self, src_url: str, dest_path: str):
+        with open(dest_path, 'wb') as out_file:
+            origin_scheduler.throttle(src_url)
+            with clients.http().request('GET', src_url, preload_content=False) as in_stream:
+                self._check_status(src_url, in_stream.status, 200)
+                for chunk in in_stream.stream(self.BUFFER_SIZE, decode_content=False):
+                    bandwidth_limiter.ingress(len(chunk))
+                    out_file.write(chunk)
+
+    def _start_ranged_download(self, src_url: str, partial_path: str, size: int, validator: str):
+        self._preallocate(partial_path, size)
+        ranges = [[start, end, 0] for start, end in self._split_into_ranges(size, self._number_of_ranges(size))]
+        checkpoint = DownloadCheckpoint(partial_path, src_url, size, validator, ranges)
+        checkpoint.save()
+        return checkpoint
+
+    def _ranged_download(self, src_url: str, dest_path: str, checkpoint: DownloadCheckpoint):
+        ranges = checkpoint.incomplete_ranges()
+        # We already hold one connection slot; use as many more as the host's limit allows right now.
+        with origin_scheduler.extra_connections(src_url, len(ranges) - 1) as extra_connections:
+            with ThreadPoolExecutor(max_workers=1 + extra_connections) as executor:
+                futures = [executor.submit(self._download_range, src_url, dest_path, checkpoint, *byte_range)
+                           for byte_range in ranges]
+        for future in futures:
+            future.result()
+
+    @staticmethod
+    def _preallocate(path: str, size: int):
+        with open(path, 'wb') as fh:
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(fh.fileno(), 0, size)
+            else:
+                fh.truncate(size)
+
+    @staticmethod
+    def _split_into_ranges(size: int, count: int) -> list:
+        """ Returns a list of inclusive (start, end) byte ranges """
+        range_size = -(-size // count)
+        return [(start, min(start + range_size, size) - 1) for start in range(0, size, range_size)]
+
+    def _download_range(self, src_url: str, dest_path: str, checkpoint: DownloadCheckpoint,
+                        range_index: int, start: int, end: int):
+        range_start = checkpoint.ranges[range_index][0]
+        headers = {'Range': f"bytes={start}-{end}", 'If-Range': checkpoint.validator}
+        origin_scheduler.throttle(src_url)
+        with clients.http().request('GET', src_url, headers=headers, preload_content=False) as in_stream:
+            if in_stream.status == 200:
+                # Either ranges aren't honoured, or If-Range failed because the origin file has changed.
+                raise RangesNotSupported(f"server answered range request with status {in_stream.status}")
+            self._check_status(src_url, in_stream.status, 206)
+            received = start - range_start
+            unsaved = 0
+            with open(dest_path, 'r+b') as out_file:
+                out_file.seek(start)
+                for chunk in in_stream.stream(self.BUFFER_SIZE, decode_content=False):
+                    bandwidth_limiter.ingress(len(chunk))
+                    out_file.write(chunk)
+                    received += len(chunk)
+                    unsaved += len(chunk)
+                    if unsaved >= self.CHECKPOINT_INTERVAL:
+                        out_file.flush()
+                        checkpoint.record(range_index, received)
+                        unsaved = 0
+            checkpoint.record(range_index, received)
+        expected = end - range_start + 1
+        if received != expected:
+            raise RuntimeError(f"received {received} of {expected} bytes of range starting at {range_start}")
+
+
+class FTPDownloader(Downloader):
+    """
+    Download a file from an origin FTP server, over a pooled, logged-in session (see FTPSessionPool).
+
+    A DownloadCheckpoint records how much has been received, validated with the file's MDTM time, and failed
+    downloads are resumed from there using REST (within this run, after a backoff, or in a later run).
+    Downloader does the retrying, so FTPReader is told not to.
+    Servers that don't support MDTM give no validator, so downloads from them start again from the beginning.
+    Connections count against origin_scheduler's per-host limits, and bytes against the ingress budget.
+    """
+
+    def _attempt_download(self, src_url: str, partial_path: str, size: int):
+        try:
+            validator = self._validator(src_url)
+            checkpoint = DownloadCheckpoint.load(partial_path)
+            if checkpoint and validator is not None and checkpoint.matches(src_url, size, validator):
+                start = checkpoint.bytes_received()
+                logger.output(f" (resuming after {sizeof_fmt(start)})")
+            else:
+                checkpoint = DownloadCheckpoint(partial_path, src_url, size, validator, [[0, size - 1, 0]])
+                open(partial_path, 'wb').close()
+                checkpoint.save()
+                start = 0
+            try:
+                self._download_from(src_url, partial_path, checkpoint, start)
+            except ftplib.error_perm:
+                if not start:
+                    raise
+                logger.output(" (server cannot resume, starting again)")
+                self._download_from(src_url, partial_path, checkpoint, 0)
+        except ftplib.error_perm as e:
+            DownloadCheckpoint.remove(partial_path)
+            raise PermanentDownloadError(f"{src_url}: {str(e)}")
+
+    @staticmethod
+    def _validator(src_url: str):
+        urlbits = parse_url(src_url)
+        origin_scheduler.throttle(src_url)
+        try:
+            return ftp_sessions.call(urlbits.netloc, lambda ftp: ftp.sendcmd(f"MDTM {urlbits.path}"))
+        except ftplib.error_perm:
+            return None  # MDTM is not supported, or there's no such file (which RETR will report)
+
+    def _download_from(self, src_url: str, partial_path: str, checkpoint: DownloadCheckpoint, start: int):
+        received = start
+        unsaved = 0
+        origin_scheduler.throttle(src_url)
+        try:
+            with open(partial_path, 'r+b') as out_file, \
+                    FTPReader(src_url, checkpoint.size, start=start, max_attempts=1) as in_stream:
+                out_file.truncate(start)
+                out_file.seek(start)
+                while True:
+                    chunk = in_stream.read(self.BUFFER_SIZE)
+                    if not chunk:
+                        break
+                    bandwidth_limiter.ingress(len(chunk))
+                    out_file.write(chunk)
+                    received += len(chunk)
+                    unsaved += len(chunk)
+                    if unsaved >= self.CHECKPOINT_INTERVAL:
+                        out_file.flush()
+                        checkpoint.record(0, received)
+                        unsaved = 0
+        finally:
+            # The file has been closed, so all that was received is there for the next attempt to resume from.
+            checkpoint.record(0, received)
+
+
+def downloader_for(url: str, connections: int=1):
+    """ Returns a downloader for the scheme of this URL """
+    if parse_url(url).scheme == 'ftp':
+        return FTPDownloader()
+    return HTTPDownloader(connections=connections)
@@ -0,0 +1,157 @@
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+from .bundle import Bundle
+from .dispatch import BoundedDispatcher
+from .parallel_logger import logger
+from .staging import BundleStager
+from .submission import SubmissionChanged
+
+
+# Tasks run in ProcessPoolExecutor workers, so they are module-level functions.
+
+def stage_bundle(bundle, target_bucket: str, stager_options: dict):
+    """ Returns (submission info, submission.json ETag) once the bundle is staged, or False """
+    if BundleStager(bundle, target_bucket, **stager_options).stage():
+        return bundle.submission_info.info, bundle.submission_info.etag
+    return False
+
+
+def prepare_bundle(bundle, target_bucket: str, stager_options: dict):
+    """ Returns the prepared bundle, or None if it is unchanged since it was last staged """
+    if BundleStager(bundle, target_bucket, **stager_options).prepare():
+        return bundle
+    return None
+
+
+def stage_file(file_task: tuple, target_bucket: str, stager_options: dict) -> tuple:
+    """
+    file_task is (file class, bundle path, file name, size, origin URL, whether already verified): all that
+    staging one file needs.  Sending a File itself would pickle its whole bundle along with it.
+    Returns (staged URL, checksums).
+    """
+    file_class, bundle_path, name, size, origin_url, verified = file_task
+    bundle = Bundle(bundle_path)
+    file = file_class(name=name, size=size, origin_url=origin_url)
+    bundle.add_file(file)
+    if verified:
+        bundle.verified_files.add(name)
+    try:
+        BundleStager(bundle, target_bucket, **stager_options).stage_file(file)
+        return file.staged_url, file.checksums
+    finally:
+        logger.flush()
+
+
+class FileLevelScheduler:
+    """
+    Stages many bundles as one pool of file-level tasks, instead of one task per bundle.
+
+    Bundles are taken WINDOW_SIZE at a time.  The bundles of a window are prepared (their files enumerated
+    and sized), then their files are staged, largest first, so the biggest data files start early and idle
+    workers pick up whatever remains.  This keeps a few huge bundles from holding up the end of a run.
+    The next window is prepared as soon as the last files of the one before have been handed out, so workers
+    stay busy, and only a window or two of bundles is held in memory at once.  All tasks go through
+    BoundedDispatchers, so no more than max_in_flight tasks are queued at once.
+    Each bundle's submission.json is written by this (the main) process, on a few threads of its own, once all
+    of its files are staged, and the bundle is recorded in staged_index, if given.
+    """
+
+    WINDOW_SIZE = 256  # bundles
+    FINISHING_THREADS = 4
+
+    def __init__(self, executor, target_bucket: str, stager_options: dict, staged_index=None, max_in_flight: int=2,
+                 window_size: int=WINDOW_SIZE):
+        self.executor = executor
+        self.target_bucket = target_bucket
+        self.stager_options = stager_options
+        self.staged_index = staged_index
+        self.max_in_flight = max_in_flight
+        self.window_size = window_size
+        self._bundles = {}  # bundle path: prepared bundle, until all of its files are done
+        self._remaining = {}  # bundle path: number of files not yet staged
+        self._failed = set()  # paths of bundles with a file that could not be staged, or that cannot be finished
+        self._prepared_bundles = []
+        self._finishers = None
+
+    def stage(self, bundles):
+        with ThreadPoolExecutor(max_workers=self.FINISHING_THREADS) as self._finishers:
+            BoundedDispatcher(self.executor, stage_file, (self.target_bucket, self.stager_options),
+                              max_in_flight=self.max_in_flight,
+                              name_of=lambda file_task: f"{file_task[1]}/{file_task[2]}",
+                              on_result=self._file_staged, on_failure=self._file_failed).run(self._file_tasks(bundles))
+        logger.flush()
+
+    def _file_tasks(self, bundles):
+        """ Yields the file tasks of each window of bundles in turn, largest file first """
+        bundles = iter(bundles)
+        while True:
+            window = list(itertools.islice(bundles, self.window_size))
+            if not window:
+                return
+            prepared_bundles = self._prepare(window)
+            files = [file for bundle in prepared_bundles for file in bundle.files.values()]
+            files.sort(key=lambda file: file.size or 0, reverse=True)
+            for bundle in prepared_bundles:
+                self._bundles[bundle.path] = bundle
+                self._remaining[bundle.path] = len(bundle.files)
+                if not bundle.files:
+                    self._bundle_done(bundle)
+            yield from ((type(file), file.bundle.path, file.name, file.size, file.origin_url,
+                         file.name in file.bundle.verified_files) for file in files)
+
+    def _file_staged(self, file_task: tuple, result: tuple):
+        bundle = self._bundles[file_task[1]]
+        file = bundle.files[file_task[2]]
+        file.staged_url, file.checksums = result
+        self._file_done(bundle)
+
+    def _file_failed(self, file_task: tuple, error: str):
+        bundle = self._bundles[file_task[1]]
+        logger.output(f"\nBundle: {bundle.path}: error staging {file_task[2]}: {error}\n", "!")
+        self._failed.add(bundle.path)
+        self._file_done(bundle)
+
+    def _file_done(self, bundle):
+        self._remaining[bundle.path] -= 1
+        if self._remaining[bundle.path] == 0:
+            self._bundle_done(bundle)
+
+    def _bundle_done(self, bundle):
+        del self._bundles[bundle.path], self._remaining[bundle.path]
+        if bundle.path not in self._failed:
+            self._finishers.submit(self._finish, bundle)
+
+    def _prepare(self, bundles: list) -> list:
+        self._prepared_bundles = []
+        BoundedDispatcher(self.executor, prepare_bundle, (self.target_bucket, self.stager_options),
+                          max_in_flight=self.max_in_flight, name_of=lambda bundle: bundle.path,
+                          on_result=self._bundle_prepared, on_failure=self._bundle_not_prepared).run(bundles)
+        logger.flush()
+        return self._prepared_bundles
+
+    def _bundle_prepared(self, bundle, prepared_bundle):
+        if prepared_bundle:
+            self._prepared_bundles.append(prepared_bundle)
+            logger.output(f"\nBundle: {bundle.path} prepared", "B")
+        else:
+            logger.output(f"\nBundle: {bundle.path} =unchanged", "=")
+
+    def _bundle_not_prepared(self, bundle, error: str):
+        logger.output(f"\nBundle: {bundle.path}: cannot enumerate files: {error}\n", "!")
+
+    def _finish(self, bundle):
+        """ Runs on a finishing thread """
+        try:
+            BundleStager(bundle, self.target_bucket, **self.stager_options).finish()
+            if self.staged_index:
+                self.staged_index.record(bundle.path, bundle.submission_info.info, bundle.submission_info.etag)
+        except (SubmissionChanged, ClientError) as e:
+            logger.output(f"\nBundle: {bundle.path}: cannot write submission.json: {str(e)}\n", "!")
+            self._failed.add(bundle.path)
+        except Exception as e:  # Nothing else would hear of it, on this thread.
+            logger.output(f"\nBundle: {bundle.path}: cannot finish: {type(e).__name__}: {str(e)}\n", "!")
+            self._failed.add(bundle.path)
+        logger.flush()
@@ -0,0 +1,197 @@
+import ftplib, io, os, sys, threading, time
+from contextlib import contextmanager
+
+from urllib3.util import parse_url
+
+
+class FTPSessionPool:
+    """
+    Logged-in FTP control connections, kept open for reuse, per origin host.
+
+    Logging in costs several round trips, so rather than connecting for every file, sessions are returned
+    to the pool when done with and handed out again.  At most `max_sessions_per_host` are open to a host
+    at once (per process); further users wait for one to be returned.  Like clients, the pool is per process,
+    so ProcessPoolExecutor workers never share a connection with their parent.
+    """
+
+    DEFAULT_MAX_SESSIONS_PER_HOST = 4
+    TIMEOUT = 60  # seconds
+
+    def __init__(self):
+        self.max_sessions_per_host = self.DEFAULT_MAX_SESSIONS_PER_HOST
+        self._lock = threading.Lock()
+        self._pid = None
+        self._idle = {}  # host: [FTP]
+        self._slots = {}  # host: BoundedSemaphore
+
+    def configure(self, max_sessions_per_host: int=DEFAULT_MAX_SESSIONS_PER_HOST):
+        self.max_sessions_per_host = max_sessions_per_host
+
+    @contextmanager
+    def session(self, host: str):
+        """ Yields a logged-in FTP session (in binary mode), which is closed rather than reused if it fails """
+        slots = self._host_slots(host)
+        with slots:
+            ftp = self._checkout(host)
+            try:
+                yield ftp
+            except ftplib.error_perm:
+                self._checkin(host, ftp)  # e.g. no such file: the session itself is still good
+                raise
+            except BaseException:
+                self._close(ftp)
+                raise
+            self._checkin(host, ftp)
+
+    def call(self, host: str, operation):
+        """ Returns operation(ftp), retrying once if the session turns out to have gone stale (e.g. timed out) """
+        try:
+            with self.session(host) as ftp:
+                return operation(ftp)
+        except (EOFError, ConnectionError, ftplib.error_temp):
+            with self.session(host) as ftp:
+                return operation(ftp)
+
+    def size(self, host: str, path: str) -> int:
+        return self.call(host, lambda ftp: ftp.size(path))
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for sessions in idle.values():
+            for ftp in sessions:
+                self._close(ftp)
+
+    def _host_slots(self, host: str) -> threading.BoundedSemaphore:
+        with self._lock:
+            if self._pid != os.getpid():
+                self._idle, self._slots, self._pid = {}, {}, os.getpid()
+            if host not in self._slots:
+                self._slots[host] = threading.BoundedSemaphore(self.max_sessions_per_host)
+            return self._slots[host]
+
+    def _checkout(self, host: str) -> ftplib.FTP:
+        with self._lock:
+            sessions = self._idle.get(host)
+            if sessions:
+                return sessions.pop()
+        hostname, _, port = host.partition(':')
+        ftp = ftplib.FTP(timeout=self.TIMEOUT)
+        ftp.connect(hostname, int(port or ftplib.FTP_PORT))
+        ftp.login()
+        ftp.voidcmd('TYPE I')  # SIZE is refused in ASCII mode by many servers
+        return ftp
+
+    def _checkin(self, host: str, ftp: ftplib.FTP):
+        with self._lock:
+            self._idle.setdefault(host, []).append(ftp)
+
+    @staticmethod
+    def _close(ftp: ftplib.FTP):
+        try:
+            ftp.close()
+        except ftplib.all_errors:
+            pass
+
+
+class FTPReader(io.RawIOBase):
+    """
+    A binary stream of a file on an FTP server, read over a pooled session, starting at byte `start`.
+
+    If the transfer fails part way through (e.g. the data connection drops), it is restarted, after a
+    backoff, from the byte the reader had got to (using REST), so that the reader sees one unbroken stream.
+    Callers that retry failed transfers themselves (e.g. FTPDownloader) pass max_attempts=1, so there is
+    only one layer of retries.  A pooled session that turns out to have gone stale is replaced at once.
+    """
+
+    MAX_ATTEMPTS = 5
+    BACKOFF_FACTOR = 1.618
+    INITIAL_BACKOFF = 2.0
+    MAX_BACKOFF = 60.0
+    RETRYABLE_ERRORS = (OSError, EOFError, ftplib.error_temp, ftplib.error_reply)
+
+    def __init__(self, url: str, size: int=None, start: int=0, sessions: FTPSessionPool=None,
+                 max_attempts: int=MAX_ATTEMPTS):
+        urlbits = parse_url(url)
+        self.host = urlbits.netloc
+        self.path = urlbits.path
+        self.size = size
+        self.position = start
+        self.sessions = sessions or ftp_sessions
+        self.max_attempts = max_attempts
+        self._session = None  # the session() context of the current transfer
+        self._ftp = None
+        self._conn = None
+        self._finished = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer) -> int:
+        wait = self.INITIAL_BACKOFF
+        attempt = 1
+        while not self._finished:
+            try:
+                if self._conn is None:
+                    self._open()
+                byte_count = self._conn.recv_into(buffer)
+                if byte_count:
+                    self.position += byte_count
+                    return byte_count
+                self._finish()
+            except self.RETRYABLE_ERRORS:
+                self._abandon(sys.exc_info())
+                if attempt >= self.max_attempts:
+                    raise
+                time.sleep(wait)
+                wait = min(self.MAX_BACKOFF, wait * self.BACKOFF_FACTOR)
+                attempt += 1
+            except BaseException:
+                self._abandon(sys.exc_info())
+                raise
+        return 0
+
+    def close(self):
+        if self._session is not None:
+            self._abandon((ConnectionAbortedError, ConnectionAbortedError("closed mid-transfer"), None))
+        super().close()
+
+    def _open(self):
+        try:
+            self._start_transfer()
+        except (EOFError, ConnectionError, ftplib.error_temp):
+            # As in FTPSessionPool.call(): the session may have been closed by the server while in the pool.
+            self._abandon(sys.exc_info())
+            self._start_transfer()
+
+    def _start_transfer(self):
+        session = self.sessions.session(self.host)
+        self._ftp = session.__enter__()
+        self._session = session
+        self._conn = self._ftp.transfercmd(f"RETR {self.path}", rest=self.position or None)
+
+    def _finish(self):
+        """ The server has closed the data connection: check the transfer succeeded and return the session """
+        self._conn.close()
+        self._conn = None
+        self._ftp.voidresp()
+        if self.size is not None and self.position != self.size:
+            raise EOFError(f"transfer ended after {self.position} of {self.size} bytes")
+        self._finished = True
+        session, self._session = self._session, None
+        session.__exit__(None, None, None)
+
+    def _abandon(self, exc_info: tuple):
+        """ Give up on the current transfer, passing its error to its session (which closes it, if need be) """
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        session, self._session = self._session, None
+        if session is not None:
+            try:
+                session.__exit__(*exc_info)
+            except BaseException:
+                pass
+
+
+ftp_sessions = FTPSessionPool()
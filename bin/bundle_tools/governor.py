@@ -0,0 +1,103 @@
+import fcntl, json, os, tempfile, time, uuid
+from contextlib import contextmanager
+
+from .parallel_logger import logger
+
+
+class ResourceGovernor:
+    """
+    Limits the local disk space and memory that data file transfers may hold at once.
+
+    A transfer reserves what it needs before starting, waiting (not failing) until the reservation fits within
+    the budgets, and releases it when done, i.e. once its downloaded file has been deleted or its stream has
+    been uploaded.  A transfer bigger than a whole budget is admitted only when nothing else holds any of it.
+
+    Reservations are kept in a flock()ed file under a folder per user, so budgets hold across all
+    ProcessPoolExecutor workers, and all of that user's runs on this machine.  Reservations of processes
+    that no longer exist (e.g. killed workers, or runs that crashed) are dropped whenever the file is read.
+    Partial downloads kept for a later run to resume would hold disk that no reservation accounts for,
+    so Downloader deletes them instead when there is a disk budget.
+    """
+
+    DEFAULT_STATE_DIR = os.path.join(tempfile.gettempdir(), f"bundle_tools-resources-{os.getuid()}")
+    POLL_INTERVAL = 1.0
+
+    def __init__(self):
+        self.disk_budget = None
+        self.memory_budget = None
+        self.state_dir = self.DEFAULT_STATE_DIR
+
+    def configure(self, disk_budget: int=None, memory_budget: int=None, state_dir: str=None):
+        """ Budgets are in bytes, None for unlimited """
+        self.disk_budget = disk_budget
+        self.memory_budget = memory_budget
+        self.state_dir = state_dir or self.DEFAULT_STATE_DIR
+
+    @contextmanager
+    def reserved(self, disk: int=0, memory: int=0):
+        disk = disk if self.disk_budget else 0
+        memory = memory if self.memory_budget else 0
+        if not disk and not memory:
+            yield
+            return
+        reservation_id = self._acquire(disk, memory)
+        try:
+            yield
+        finally:
+            self._release(reservation_id)
+
+    def _acquire(self, disk: int, memory: int) -> str:
+        reservation_id = uuid.uuid4().hex
+        waiting_since = None
+        while True:
+            with self._reservations() as reservations:
+                if self._fits(reservations, 'disk', disk, self.disk_budget) and \
+                        self._fits(reservations, 'memory', memory, self.memory_budget):
+                    reservations.append(dict(id=reservation_id, pid=os.getpid(), disk=disk, memory=memory))
+                    if waiting_since:
+                        logger.output(f" (waited {time.time() - waiting_since:.0f}s for disk/memory budget)")
+                    return reservation_id
+            waiting_since = waiting_since or time.time()
+            time.sleep(self.POLL_INTERVAL)
+
+    def _release(self, reservation_id: str):
+        with self._reservations() as reservations:
+            reservations[:] = [reservation for reservation in reservations if reservation['id'] != reservation_id]
+
+    @staticmethod
+    def _fits(reservations: list, resource: str, wanted: int, budget: int) -> bool:
+        if not wanted:
+            return True
+        held = sum(reservation[resource] for reservation in reservations)
+        return held + wanted <= budget or held == 0
+
+    @contextmanager
+    def _reservations(self):
+        """ Yields the list of current reservations, which may be modified, under an exclusive lock """
+        os.makedirs(self.state_dir, mode=0o700, exist_ok=True)
+        with open(os.path.join(self.state_dir, 'reservations.json'), 'a+') as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            fh.seek(0)
+            try:
+                reservations = json.loads(fh.read() or '[]')
+            except ValueError:
+                reservations = []
+            reservations = [reservation for reservation in reservations if self._process_exists(reservation['pid'])]
+            yield reservations
+            fh.seek(0)
+            fh.truncate()
+            json.dump(reservations, fh)
+            fh.flush()
+
+    @staticmethod
+    def _process_exists(pid: int) -> bool:
+        try:
+            os.kill(pid, 0)
+            return True
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+
+
+resource_governor = ResourceGovernor()
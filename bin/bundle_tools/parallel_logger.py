@@ -1,4 +1,4 @@
-import io, sys
+import io, sys, threading
 
 
 class ParallelLogger:
@@ -15,6 +15,7 @@ class ParallelLogger:
         self.terse = False
         self.quiet = False
         self.logfile = None
+        self._lock = threading.RLock()
 
     def configure(self, logfile=None, terse=False, quiet=False):
         self.terse = terse
@@ -23,27 +24,30 @@ class ParallelLogger:
             self.logfile = io.TextIOWrapper(open(logfile, 'wb'))
 
     def output(self, msg, progress_char=None, flush=False):
-        if not self.quiet:
-            sys.stdout.write(msg)
-        if self.logfile:
-            self.logfile.write(msg)
-        if progress_char:
-            self.progress(progress_char)
-        if flush:
-            self.flush()
+        with self._lock:
+            if not self.quiet:
+                sys.stdout.write(msg)
+            if self.logfile:
+                self.logfile.write(msg)
+            if progress_char:
+                self.progress(progress_char)
+            if flush:
+                self.flush()
 
     def progress(self, char, flush=False):
-        self.progress_string.append(char)
-        if flush:
-            self.flush()
+        with self._lock:
+            self.progress_string.append(char)
+            if flush:
+                self.flush()
 
     def flush(self):
-        if self.terse:
-            sys.stdout.write("".join(self.progress_string))
-        self.progress_string = list()
-        sys.stdout.flush()
-        if self.logfile:
-            self.logfile.flush()
+        with self._lock:
+            if self.terse:
+                sys.stdout.write("".join(self.progress_string))
+            self.progress_string = list()
+            sys.stdout.flush()
+            if self.logfile:
+                self.logfile.flush()
 
 
 logger = ParallelLogger()
@@ -1,4 +1,5 @@
-import mimetypes
+import mimetypes, threading
+from collections import OrderedDict
 from functools import reduce
 
 from dotmap import DotMap
@@ -7,8 +8,10 @@ import boto3
 from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
 
-from checksumming_io.checksumming_io import ChecksummingBufferedReader, ChecksummingSink
+from .checksumming import PipelinedChecksummingReader, S3RangedChecksummer
 from .parallel_logger import logger
+from .bandwidth import bandwidth_limiter
+from .tuning import transfer_tuner
 
 
 KB = 1024
@@ -27,55 +30,194 @@ class S3Location(DotMap):
         return f"s3://{self.Bucket}/{self.Key}"
 
 
+class S3ObjectStateCache:
+    """
+    Remembers the objects (HEAD results, including absent objects) and tag sets that have been looked up,
+    keyed by URL, so that the several steps of staging a file don't each ask S3 the same questions.
+    S3Agent keeps it up to date when it changes objects itself.  May be shared between threads.
+    """
+
+    MAX_ENTRIES = 10000
+
+    def __init__(self):
+        self._objects = OrderedDict()
+        self._tags = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup_object(self, s3url: str) -> tuple:
+        """ Returns (found, object), where object is None if the object is known not to exist """
+        return self._lookup(self._objects, s3url)
+
+    def remember_object(self, s3url: str, obj):
+        self._remember(self._objects, s3url, obj)
+
+    def lookup_tags(self, s3url: str) -> tuple:
+        found, tags = self._lookup(self._tags, s3url)
+        return found, dict(tags) if found else None
+
+    def remember_tags(self, s3url: str, tags: dict):
+        self._remember(self._tags, s3url, dict(tags))
+
+    def invalidate(self, s3url: str):
+        with self._lock:
+            self._objects.pop(s3url, None)
+            self._tags.pop(s3url, None)
+
+    def _lookup(self, entries: OrderedDict, s3url: str) -> tuple:
+        with self._lock:
+            if s3url in entries:
+                entries.move_to_end(s3url)
+                return True, entries[s3url]
+            return False, None
+
+    def _remember(self, entries: OrderedDict, s3url: str, value):
+        with self._lock:
+            entries[s3url] = value
+            entries.move_to_end(s3url)
+            while len(entries) > self.MAX_ENTRIES:
+                entries.popitem(last=False)
+
+
 class S3Agent:
+    """
+    S3 operations used in staging, through a boto3 resource and client, keeping state_cache up to date.
 
-    def __init__(self, credentials={}):
-        session = boto3.session.Session(**credentials)
-        self.s3 = session.resource('s3')
-        self.s3client = session.client('s3')
+    The ETag S3 gives each object this agent uploads is taken from the PutObject or CompleteMultipartUpload
+    response, by hooking the resource's client's events, as s3transfer doesn't return it.
+    """
+
+    STREAMING_PARTS_IN_FLIGHT = 4
+    UPLOAD_OPERATIONS = ('PutObject', 'CompleteMultipartUpload')
+
+    def __init__(self, credentials={}, state_cache: S3ObjectStateCache=None, resource=None, client=None):
+        if resource is None or client is None:
+            session = boto3.session.Session(**credentials)
+            resource = resource or session.resource('s3')
+            client = client or session.client('s3')
+        self.s3 = resource
+        self.s3client = client
+        self.state_cache = state_cache or S3ObjectStateCache()
+        self._uploaded_etags = {}  # (bucket, key): ETag of the object this agent last uploaded there
+        self._uploaded_etags_lock = threading.Lock()
+        events = self.s3.meta.client.meta.events
+        for operation in self.UPLOAD_OPERATIONS:
+            events.register(f"before-parameter-build.s3.{operation}", self._note_upload_target)
+            events.register(f"after-call.s3.{operation}", self._note_uploaded_etag)
 
     def copy_between_buckets(self, src_url: str, dest_url: str, file_size: int):
         src = S3Location(src_url)
         dest = S3Location(dest_url)
         src_tags = self.get_tagging(src_url)
         dest_obj = self.s3.Bucket(dest.Bucket).Object(dest.Key)
-        dest_obj.copy(src.toDict(),
-                      Config=self.transfer_config(file_size),
-                      ExtraArgs={'ACL': 'bucket-owner-full-control'})
+        self.state_cache.invalidate(dest_url)
+        with transfer_tuner.tuned('copy', self.transfer_config(file_size), file_size) as config:
+            dest_obj.copy(src.toDict(),
+                          Config=config,
+                          ExtraArgs={'ACL': 'bucket-owner-full-control'})
         self.add_tagging(dest_url, src_tags)
 
     def upload_and_checksum(self, local_path: str, target_url: str, file_size: int) -> dict:
+        """
+        Upload a local file, checksumming it as it is read (see PipelinedChecksummer), so it is read only once.
+        Should S3 give the object a different ETag than the one computed, its checksums are instead computed
+        from the object itself.
+        """
+        with transfer_tuner.tuned('upload', self.transfer_config(file_size), file_size) as config:
+            with open(local_path, 'rb') as fh:
+                checksums = self._upload_and_checksum(fh, target_url, config)
+        etag = self._pop_uploaded_etag(target_url)
+        if etag is None:
+            raise RuntimeError(f"upload of {local_path} to {target_url} did not report an ETag")
+        if etag.strip('"') != checksums['s3_etag']:
+            logger.output(f"\n      {target_url} has ETag {etag}, expected {checksums['s3_etag']}, "
+                          f"checksumming it from S3 ")
+            checksums = self.checksum_object(target_url)
+        return checksums
+
+    def stream_upload_and_checksum(self, stream, target_url: str, file_size: int) -> dict:
+        """
+        Upload from a non-seekable stream, e.g. an HTTP response, holding only a few parts in memory at once.
+        """
+        config = self.transfer_config(file_size)
+        config.max_concurrency = self.STREAMING_PARTS_IN_FLIGHT
+        config.max_in_memory_upload_chunks = self.STREAMING_PARTS_IN_FLIGHT
+        checksums = self._upload_and_checksum(stream, target_url, config)
+        self._pop_uploaded_etag(target_url)
+        return checksums
+
+    @classmethod
+    def streaming_memory(cls, file_size: int) -> int:
+        """ Roughly the most memory stream_upload_and_checksum() holds at once """
+        return min(file_size, (cls.STREAMING_PARTS_IN_FLIGHT + 1) * cls._s3_chunk_size(file_size))
+
+    def _upload_and_checksum(self, stream, target_url: str, config: TransferConfig) -> dict:
         target = S3Location(target_url)
         bucket = self.s3.Bucket(target.Bucket)
-        with open(local_path, 'rb') as fh:
-            reader = ChecksummingBufferedReader(fh)
-            obj = bucket.Object(target.Key)
+        obj = bucket.Object(target.Key)
+        self.state_cache.invalidate(target_url)
+        self._pop_uploaded_etag(target_url)
+        with PipelinedChecksummingReader(stream, part_size=config.multipart_chunksize,
+                                         multipart_threshold=config.multipart_threshold) as reader:
             obj.upload_fileobj(reader,
-                               Config=self.transfer_config(file_size),
-                               ExtraArgs={'ACL': 'bucket-owner-full-control'})
-        return reader.get_checksums()
+                               Config=config,
+                               ExtraArgs={'ACL': 'bucket-owner-full-control'},
+                               Callback=bandwidth_limiter.egress)
+            return reader.get_checksums()
+
+    @staticmethod
+    def _note_upload_target(params: dict, context: dict, **kwargs):
+        context['upload_target'] = (params.get('Bucket'), params.get('Key'))
+
+    def _note_uploaded_etag(self, parsed: dict, context: dict, **kwargs):
+        if 'upload_target' in context and parsed.get('ETag'):
+            with self._uploaded_etags_lock:
+                self._uploaded_etags[context['upload_target']] = parsed['ETag']
+
+    def _pop_uploaded_etag(self, s3url: str):
+        s3loc = S3Location(s3url)
+        with self._uploaded_etags_lock:
+            return self._uploaded_etags.pop((s3loc.Bucket, s3loc.Key), None)
 
     def copy_object_tagging(self, src_url: str, dest_url: str):
         tags = self.get_tagging(src_url)
         self.add_tagging(dest_url, tags)
 
     def get_tagging(self, s3url: str) -> dict:
+        found, tags = self.state_cache.lookup_tags(s3url)
+        if found:
+            return tags
         s3loc = S3Location(s3url)
         response = self.s3client.get_object_tagging(Bucket=s3loc.Bucket, Key=s3loc.Key)
-        return self._decode_tags(response['TagSet'])
+        tags = self._decode_tags(response['TagSet'])
+        self.state_cache.remember_tags(s3url, tags)
+        return tags
 
     def add_tagging(self, s3url: str, tags: dict):
         s3loc = S3Location(s3url)
         tagging = dict(TagSet=self._encode_tags(tags))
         self.s3client.put_object_tagging(Bucket=s3loc.Bucket, Key=s3loc.Key, Tagging=tagging)
+        self.state_cache.remember_tags(s3url, tags)
 
     def get_object(self, s3url: str):
+        found, obj = self.state_cache.lookup_object(s3url)
+        if found:
+            return obj
         try:
             obj = self.object(s3url)
             obj.load()
-            return obj
         except ClientError:
-            return None
+            obj = None
+        self.state_cache.remember_object(s3url, obj)
+        return obj
+
+    def checksum_object(self, s3url: str) -> dict:
+        """ Compute the checksums of an S3 object, by reading it back from S3 """
+        obj = self.get_object(s3url)
+        s3loc = S3Location(s3url)
+        config = self.transfer_config(obj.content_length)
+        checksummer = S3RangedChecksummer(self.s3client, part_size=config.multipart_chunksize,
+                                          multipart_threshold=config.multipart_threshold)
+        return checksummer.checksums(s3loc.Bucket, s3loc.Key, obj.content_length, obj.e_tag)
 
     def object(self, s3url: str):
         s3loc = S3Location(s3url)
@@ -84,6 +226,7 @@ class S3Agent:
     def delete_object(self, s3url: str):
         s3loc = S3Location(s3url)
         self.s3.Bucket(s3loc.Bucket).Object(s3loc.Key).delete()
+        self.state_cache.invalidate(s3url)
 
     @staticmethod
     def _decode_tags(tags: list) -> dict:
@@ -122,9 +265,9 @@ class S3ObjectTagger:
     MIME_TAG = 'hca-dss-content-type'
     ALL_TAGS = CHECKSUM_TAGS + (MIME_TAG,)
 
-    def __init__(self, target_url: str, credentials={}):
+    def __init__(self, target_url: str, credentials={}, s3agent: S3Agent=None):
         self.target_url = target_url
-        self.s3 = S3Agent(credentials)
+        self.s3 = s3agent or S3Agent(credentials)
 
     def copy_tags_from_object(self, s3url: str):
         self.s3.copy_object_tagging(s3url, self.target_url)
@@ -162,11 +305,7 @@ class S3ObjectTagger:
         return {self.MIME_TAG: mime_type}
 
     def _compute_checksums_from_s3(self, s3url: str) -> dict:
-        file_size = self.s3.get_object(s3url).content_length
-        s3loc = S3Location(s3url)
-        with ChecksummingSink() as sink:
-            self.s3.s3client.download_fileobj(s3loc.Bucket, s3loc.Key, sink, Config=S3Agent.transfer_config(file_size))
-            return sink.get_checksums()
+        return self.s3.checksum_object(s3url)
 
     @staticmethod
     def _hca_checksum_tags(checksums: dict) -> dict:
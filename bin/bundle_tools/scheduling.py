@@ -0,0 +1,136 @@
+import fcntl, os, shutil, tempfile, time
+from contextlib import contextmanager
+
+from urllib3.util import parse_url
+
+
+class OriginHostScheduler:
+    """
+    Limits the number of concurrent downloads from, and the rate of requests to, each origin host.
+
+    State is kept in lock files under a folder of the run's own, so limits hold across all of its
+    ProcessPoolExecutor workers.  The kernel drops a process's locks when it exits, so a crashed worker
+    never leaks a connection slot.  Each run's folder is named after the pid of the process that
+    configure()d it, under a folder per user, and is removed by release() at the end of the run,
+    or by the next run to configure() if the run died without doing so.
+    """
+
+    DEFAULT_STATE_DIR = os.path.join(tempfile.gettempdir(), f"bundle_tools-origin-hosts-{os.getuid()}")
+    THROTTLED_SCHEMES = ('http', 'https', 'ftp')
+    POLL_INTERVAL = 0.25
+
+    def __init__(self):
+        self.max_connections = None
+        self.requests_per_second = None
+        self.state_dir = os.path.join(self.DEFAULT_STATE_DIR, str(os.getpid()))
+        self._owner = None  # pid of the process that configure()d this run's state folder
+
+    def configure(self, max_connections: int=None, requests_per_second: float=None, state_dir: str=None):
+        self.max_connections = max_connections
+        self.requests_per_second = requests_per_second
+        runs_dir = state_dir or self.DEFAULT_STATE_DIR
+        self._remove_stale_runs(runs_dir)
+        self._owner = os.getpid()
+        self.state_dir = os.path.join(runs_dir, str(self._owner))
+
+    def release(self):
+        """ Remove this run's state.  Only the process that configure()d it does so, not its workers. """
+        if self._owner == os.getpid():
+            shutil.rmtree(self.state_dir, ignore_errors=True)
+            self._owner = None
+
+    @contextmanager
+    def connection(self, url: str):
+        """ Wait for a free connection slot for this URL's host and hold it for the duration of the context """
+        slot = self._acquire_slot(url, blocking=True)
+        try:
+            yield
+        finally:
+            self._release_slot(slot)
+
+    @contextmanager
+    def extra_connections(self, url: str, wanted: int):
+        """ Grab up to `wanted` further slots without waiting.  Yields the number obtained. """
+        slots = []
+        try:
+            while len(slots) < wanted:
+                slot = self._acquire_slot(url, blocking=False)
+                if slot is None:
+                    break
+                slots.append(slot)
+            yield len(slots)
+        finally:
+            for slot in slots:
+                self._release_slot(slot)
+
+    def throttle(self, url: str):
+        """ Call before each request to an origin host, to respect --origin-requests-per-second """
+        host = self._host(url)
+        if not host or not self.requests_per_second:
+            return
+        with open(self._state_file(host, 'next_request_time'), 'a+') as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            fh.seek(0)
+            now = time.time()
+            next_request_time = max(now, float(fh.read() or 0))
+            fh.seek(0)
+            fh.truncate()
+            fh.write(str(next_request_time + 1.0 / self.requests_per_second))
+            fh.flush()
+        time.sleep(next_request_time - now)
+
+    def _acquire_slot(self, url: str, blocking: bool):
+        host = self._host(url)
+        if not host or not self.max_connections:
+            return -1 if blocking else None
+        while True:
+            for slot_number in range(self.max_connections):
+                fd = os.open(self._state_file(host, f"slot{slot_number}"), os.O_RDWR | os.O_CREAT)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return fd
+                except BlockingIOError:
+                    os.close(fd)
+            if not blocking:
+                return None
+            time.sleep(self.POLL_INTERVAL)
+
+    @staticmethod
+    def _release_slot(fd: int):
+        if fd is not None and fd >= 0:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def _state_file(self, host: str, name: str) -> str:
+        host_dir = os.path.join(self.state_dir, host.replace(':', '_'))
+        os.makedirs(host_dir, mode=0o700, exist_ok=True)
+        return os.path.join(host_dir, name)
+
+    def _remove_stale_runs(self, runs_dir: str):
+        """ Remove the state folders of runs that died without release()ing them """
+        try:
+            run_ids = os.listdir(runs_dir)
+        except FileNotFoundError:
+            return
+        for run_id in run_ids:
+            if run_id.isdigit() and not self._is_alive(int(run_id)):
+                shutil.rmtree(os.path.join(runs_dir, run_id), ignore_errors=True)
+
+    @staticmethod
+    def _is_alive(pid: int) -> bool:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def _host(self, url: str):
+        urlbits = parse_url(url)
+        if urlbits.scheme not in self.THROTTLED_SCHEMES:
+            return None
+        return urlbits.netloc
+
+
+origin_scheduler = OriginHostScheduler()
@@ -0,0 +1,100 @@
+import os, sqlite3, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+from .utils import file_size
+
+
+class FileSizeResolver:
+    """
+    Finds the sizes of many origin files at once, with a pool of threads, remembering them by URL.
+
+    Sizes are remembered for the life of the process and, if a path is configured, in a SQLite database
+    that may be shared by many processes and later runs.  Database entries are trusted for `ttl` seconds.
+    FTP sizes are fetched over pooled sessions (see FTPSessionPool), so each needs one round trip, not a login.
+    """
+
+    DEFAULT_TTL_HOURS = 24
+    DEFAULT_WORKERS = 8
+    SCHEMA = """CREATE TABLE IF NOT EXISTS file_sizes (
+                    url TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    resolved_at REAL NOT NULL)"""
+
+    def __init__(self):
+        self.path = None
+        self.ttl = self.DEFAULT_TTL_HOURS * 3600
+        self.workers = self.DEFAULT_WORKERS
+        self._sizes = {}
+        self._local = threading.local()
+        self._executor = None
+        self._executor_pid = None
+        self._lock = threading.Lock()
+
+    def configure(self, path: str=None, ttl_hours: float=DEFAULT_TTL_HOURS, workers: int=DEFAULT_WORKERS):
+        self.path = path
+        self.ttl = ttl_hours * 3600
+        self.workers = workers
+
+    def size(self, url: str) -> int:
+        return self.sizes([url])[url]
+
+    def sizes(self, urls: list) -> dict:
+        """ Returns {url: size}.  If some can't be sized, raises the error of the first of those (in urls order). """
+        sizes = {}
+        unknown = []
+        for url in urls:
+            size = self._remembered_size(url)
+            if size is None:
+                unknown.append(url)
+            else:
+                sizes[url] = size
+        if len(unknown) == 1:
+            sizes[unknown[0]] = self._resolve(unknown[0])
+        elif unknown:
+            futures = [(url, self._pool().submit(self._resolve, url)) for url in unknown]
+            for url, future in futures:
+                sizes[url] = future.result()
+        return sizes
+
+    def _resolve(self, url: str) -> int:
+        size = file_size(url)
+        with self._lock:
+            self._sizes[url] = size
+        if self.path:
+            with self._db() as db:
+                db.execute("INSERT OR REPLACE INTO file_sizes VALUES (?, ?, ?)", (url, size, time.time()))
+        return size
+
+    def _remembered_size(self, url: str):
+        with self._lock:
+            if url in self._sizes:
+                return self._sizes[url]
+        if not self.path:
+            return None
+        row = self._db().execute("SELECT size FROM file_sizes WHERE url = ? AND resolved_at > ?",
+                                 (url, time.time() - self.ttl)).fetchone()
+        if row is None:
+            return None
+        with self._lock:
+            self._sizes[url] = row[0]
+        return row[0]
+
+    def _pool(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor_pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.workers)
+                self._executor_pid = os.getpid()
+            return self._executor
+
+    def _db(self) -> sqlite3.Connection:
+        """ One connection per process and thread, as SQLite connections must not cross either boundary """
+        if getattr(self._local, 'pid', None) != os.getpid():
+            db = sqlite3.connect(self.path, timeout=60)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(self.SCHEMA)
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return self._local.db
+
+
+file_size_resolver = FileSizeResolver()
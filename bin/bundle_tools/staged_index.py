@@ -0,0 +1,123 @@
+import json, os, threading, time
+
+from botocore.exceptions import ClientError
+
+from .clients import clients
+from .submission import SubmissionInfo
+from .utils import MB
+
+
+class StagedBundleIndex:
+    """
+    A consolidated record of the staged bundles of each bundle home (a folder named "bundles").
+
+    Each bundle home has one S3 object, <bundle home>/staged_bundles.json, mapping the name of each of its bundles
+    to the content of that bundle's submission.json (its files' names, sizes, staged URLs and UUIDs) and the
+    ETag submission.json had then.  submission.json remains the source of truth: an entry is only a cache of it,
+    returned by entry() while submission.json still has that ETag.  The current ETags of all the submission.json
+    files of a bundle home are found by listing it once, when its index is first read.
+    stager.py records the bundles it stages, from its main process, and storer.py uses the index to filter and
+    load bundles without fetching each submission.json, recording the UUIDs it assigns.
+
+    Updates are written every SAVE_EVERY records or SAVE_INTERVAL seconds, and by save(), so a run that dies
+    loses few of them.  S3 has no rename or lock, so each write merges updates into the latest copy of the index
+    and puts it conditionally (If-Match the ETag it was read with), starting again should another run have
+    written it in between.  Within a process, writes are serialized by a lock.
+    """
+
+    FILENAME = 'staged_bundles.json'
+    SAVE_EVERY = 100  # records
+    SAVE_INTERVAL = 60.0  # seconds
+    MAX_SAVE_ATTEMPTS = 10
+
+    def __init__(self, bucket: str):
+        self.bucket = bucket
+        self._indexes = {}  # bundle home: {bundle name: {'etag': submission.json ETag, 'info': submission info}}
+        self._submission_etags = {}  # bundle home: {bundle name: current submission.json ETag}
+        self._updates = {}  # bundle home: {bundle name: {'etag': submission.json ETag, 'info': submission info}}
+        self._unsaved = 0
+        self._last_save = time.time()
+        self._lock = threading.RLock()
+
+    def entry(self, bundle_path: str) -> tuple:
+        """
+        Returns (submission info, ETag of the submission.json it came from) of this bundle,
+        or (None, None) if it is not in the index, or its submission.json has changed since
+        """
+        home, name = self._home_and_name(bundle_path)
+        with self._lock:
+            if home not in self._submission_etags:
+                self._indexes[home], _ = self._load(home)
+                self._submission_etags[home] = self._list_submission_etags(home)
+            entry = self._indexes[home].get(name)
+            current_etag = self._submission_etags[home].get(name)
+        if not isinstance(entry, dict) or not entry.get('etag') or entry['etag'] != current_etag:
+            return None, None
+        return entry['info'], entry['etag']
+
+    def record(self, bundle_path: str, info: dict, submission_etag: str):
+        """ Record a bundle's submission info, as it is in its submission.json with ETag submission_etag """
+        if not submission_etag:
+            return
+        home, name = self._home_and_name(bundle_path)
+        with self._lock:
+            self._updates.setdefault(home, {})[name] = {'etag': submission_etag, 'info': info}
+            self._unsaved += 1
+            if self._unsaved >= self.SAVE_EVERY or time.time() - self._last_save >= self.SAVE_INTERVAL:
+                self.save()
+
+    def save(self) -> int:
+        """ Write recorded updates to S3.  Returns the number of bundles updated. """
+        with self._lock:
+            updated = 0
+            for home in list(self._updates):
+                self._save(home, self._updates[home])
+                updated += len(self._updates.pop(home))
+            self._unsaved = 0
+            self._last_save = time.time()
+            return updated
+
+    def _save(self, home: str, updates: dict):
+        for attempt in range(1, self.MAX_SAVE_ATTEMPTS + 1):
+            index, etag = self._load(home)
+            index.update(updates)
+            condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+            try:
+                clients.s3client().put_object(Bucket=self.bucket, Key=f"{home}/{self.FILENAME}",
+                                              Body=json.dumps(index, sort_keys=True).encode('utf8'),
+                                              ContentType='application/json', **condition)
+                self._indexes[home] = index
+                return
+            except ClientError as e:
+                # Another run wrote the index since it was read: merge into its copy instead.
+                if e.response['Error']['Code'] not in ('PreconditionFailed', 'ConditionalRequestConflict') \
+                        or attempt == self.MAX_SAVE_ATTEMPTS:
+                    raise
+
+    @staticmethod
+    def all_files_are_smaller_than(info: dict, this_many_mb: int) -> bool:
+        return all((entry.get('size') or 0) <= this_many_mb * MB for entry in info.get('files', []))
+
+    def _list_submission_etags(self, home: str) -> dict:
+        etags = {}
+        paginator = clients.s3client().get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=f"{home}/"):
+            for obj in page.get('Contents', []):
+                name, _, filename = obj['Key'][len(home) + 1:].partition('/')
+                if filename == SubmissionInfo.SUBMISSION_FILENAME:
+                    etags[name] = obj['ETag']
+        return etags
+
+    def _load(self, home: str) -> tuple:
+        """ Returns (index, its ETag), or ({}, None) if there is no index yet """
+        try:
+            response = clients.s3client().get_object(Bucket=self.bucket, Key=f"{home}/{self.FILENAME}")
+            return json.loads(response['Body'].read()), response['ETag']
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return {}, None
+            raise
+
+    @staticmethod
+    def _home_and_name(bundle_path: str) -> tuple:
+        return os.path.split(bundle_path.strip('/'))
@@ -1,14 +1,23 @@
 import os
-from shutil import copyfileobj
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
-import urllib3
 from urllib3.util import parse_url
-from checksumming_io.checksumming_io import ChecksummingSink
 
 from .parallel_logger import logger
 from .utils import sizeof_fmt, measure_duration_and_rate
-from .s3 import S3Location, S3Agent, S3ObjectTagger
+from .s3 import S3Agent, S3Location, S3ObjectTagger
+from .clients import clients
+from .download import downloader_for
+from .ftp import FTPReader
+from .scheduling import origin_scheduler
+from .catalog import staged_catalog
+from .checksum_cache import checksum_cache
+from .bandwidth import bandwidth_limiter, ThrottledReader
+from .checksumming import LocalFileChecksummer
+from .governor import resource_governor
 from bundle_tools import LocalBundle, File, DataFile, MetadataFile, SubmissionInfo
+from .submission import SubmissionChanged
 
 
 class BundleMissingDataFile(Exception):
@@ -21,63 +30,132 @@ def report_duration_and_rate(func,  *args, size):
     return retval
 
 
-s3 = S3Agent()
-http = urllib3.PoolManager()
+def record_in_catalog(target_url: str, local_mtime: float=None):
+    if staged_catalog.enabled:
+        obj = clients.s3_agent().get_object(target_url)
+        tags = clients.s3_agent().get_tagging(target_url)
+        staged_catalog.record(target_url, obj.content_length, obj.e_tag.strip('"'), tags, local_mtime)
 
 
 class BundleStager:
 
-    def __init__(self, bundle: LocalBundle, target_bucket: str):
+    def __init__(self, bundle: LocalBundle, target_bucket: str, file_jobs: int=1, stream: bool=False,
+                 connections_per_file: int=1, full: bool=False):
         self.bundle = bundle
         self.target_bucket = target_bucket
+        self.file_jobs = file_jobs
+        self.stream = stream
+        self.connections_per_file = connections_per_file
+        self.full = full
 
-    def stage(self, comment=""):
+    def stage(self, comment="") -> bool:
+        """ Returns False if the bundle could not be staged for want of a data file, or its submission.json changed """
         logger.output(f"\nBundle: {self.bundle.path} {comment}", "B")
         try:
-            self.bundle.submission_info = SubmissionInfo(self.target_bucket, self.bundle)
-            self.bundle.submission_info.load()
-            self.bundle.enumerate_local_metadata_files()
-            self.bundle.enumerate_data_files_using_manifest()
-            self._stage_files_of_type(DataFile)
-            self._stage_files_of_type(MetadataFile)
-            if self.bundle.submission_info.save():
-                logger.output("\n  Writing submission.json", progress_char='*')
-
-        except BundleMissingDataFile as e:
+            if self.prepare():
+                self._stage_files_of_type(DataFile)
+                self._stage_files_of_type(MetadataFile)
+                self.finish()
+            else:
+                logger.output("=unchanged ", "=")
+        except (BundleMissingDataFile, SubmissionChanged) as e:
             logger.output(f" -> {str(e)}\n", "!")
-        logger.flush()
+            return False
+        finally:
+            logger.flush()
+        return True
+
+    def prepare(self) -> bool:
+        """
+        Load the bundle's submission.json and find all of its files, and their sizes.
+        Returns False, having done no more, if the bundle is unchanged since it was last completely staged.
+        """
+        self.bundle.submission_info = SubmissionInfo(self.target_bucket, self.bundle)
+        self.bundle.submission_info.load()
+        self.bundle.enumerate_local_metadata_files()
+        self.bundle.fingerprint = self.bundle.compute_fingerprint()
+        if self._is_unchanged():
+            return False
+        self.bundle.enumerate_data_files_using_manifest()
+        return True
+
+    def _is_unchanged(self) -> bool:
+        """ The fingerprint covers the bundle's file names, so if it matches no file can be new """
+        if self.full or self.bundle.submission_info.info.get('bundle_fingerprint') != self.bundle.fingerprint:
+            return False
+        return all(file.staged_url for file in self.bundle.files.values())
+
+    def finish(self):
+        """ Once all of the bundle's files are staged, record them in its submission.json """
+        if self.bundle.submission_info.save():
+            logger.output("\n  Writing submission.json", progress_char='*')
+
+    def stage_file(self, file):
+        """ Stage one file of a prepared bundle """
+        self._stage_file(file)
 
     def _stage_files_of_type(self, file_class):
         files = [file for file in self.bundle.files.values() if type(file) == file_class]
         logger.output(f"\n  {file_class.__name__}s ({len(files)}):")
-        for file in files:
-            logger.output(f"\n    {file.name} ({sizeof_fmt(file.size)}) ")
-            if type(file) == DataFile:
-                DataFileStager(file).stage_file(self.target_bucket)
-            else:
-                MetadataFileStager(file).stage(self.target_bucket)
+        if self.file_jobs > 1:
+            self._stage_files_in_parallel(files)
+        else:
+            for file in files:
+                self._stage_file(file)
+
+    def _stage_files_in_parallel(self, files):
+        with ThreadPoolExecutor(max_workers=self.file_jobs) as executor:
+            futures = [executor.submit(self._stage_file, file) for file in files]
+        # Every file has finished by now; re-raise the first failure (e.g. BundleMissingDataFile), if any.
+        for future in futures:
+            future.result()
+
+    def _stage_file(self, file):
+        logger.output(f"\n    {file.name} ({sizeof_fmt(file.size)}) ")
+        if file.name in self.bundle.verified_files:
+            logger.output("=present (verified) ", progress_char="✔︎" if type(file) == DataFile else "✓")
+            file.staged_url = f"s3://{self.target_bucket}/{file.path()}"
+        elif type(file) == DataFile:
+            DataFileStager(file, stream=self.stream,
+                           connections=self.connections_per_file).stage_file(self.target_bucket)
+        else:
+            MetadataFileStager(file).stage(self.target_bucket)
 
 
 class DataFileStager:
 
-    def __init__(self, file):
+    STREAMABLE_SCHEMES = ('http', 'https', 'ftp')
+
+    def __init__(self, file, stream=False, connections=1):
         self.file = file
         self.bundle = file.bundle
         self.target_url = None
+        self.stream = stream
+        self.connections = connections
 
     def stage_file(self, target_bucket):
         self.target_url = f"s3://{target_bucket}/{self.file.path()}"
+        if staged_catalog.is_staged(self.target_url, self.file.size):
+            logger.output("=present (catalogued) ", progress_char="✔︎")
+            self.file.staged_url = self.target_url
+            return
         if self._obj_is_at_target_location():
             logger.output("=present ", progress_char="✔︎")
+        elif self.stream and self._can_stream_from_origin():
+            with resource_governor.reserved(memory=S3Agent.streaming_memory(self.file.size)):
+                self.stream_origin_file_to_target_location()
         else:
-            src_location = self.source_data_file()
-            self.copy_file_to_target_location(src_location)
-            self._delete_downloaded_file(src_location)
+            # Reserve room for the download (if there will be one) until it is deleted again.
+            with resource_governor.reserved(disk=0 if self._find_locally() else self.file.size):
+                src_location = self.source_data_file()
+                self.copy_file_to_target_location(src_location)
+                self._delete_downloaded_file(src_location)
         self.file.staged_url = self.target_url
         self._ensure_checksum_tags()
+        record_in_catalog(self.target_url)
 
     def _obj_is_at_target_location(self):
-        obj = s3.get_object(self.target_url)
+        obj = clients.s3_agent().get_object(self.target_url)
         if obj:
             if obj.content_length == self.file.size:
                 return self.etag_matches_or_not_present(obj)
@@ -88,7 +166,7 @@ class DataFileStager:
 
     def etag_matches_or_not_present(self, obj):
         s3_etag = obj.e_tag.strip('"')
-        tags = s3.get_tagging(self.target_url)
+        tags = clients.s3_agent().get_tagging(self.target_url)
         if tags.get('hca-dss-s3_etag'):
             if s3_etag == tags['hca-dss-s3_etag']:
                 return True
@@ -96,7 +174,7 @@ class DataFileStager:
                 logger.output("\n      exists at target but has wrong etag: %s / %s" %
                               (s3_etag, tags['hca-dss-s3_etag']))
                 logger.output("\n      copy to itself to correct etag... ", progress_char='↻︎')
-                report_duration_and_rate(s3.copy_between_buckets,
+                report_duration_and_rate(clients.s3_agent().copy_between_buckets,
                                          self.target_url, self.target_url, self.file.size,
                                          size=self.file.size)
                 return True
@@ -122,24 +200,65 @@ class DataFileStager:
 
     def copy_s3_file_to_target_location(self, source_location):
         logger.output(f"\n      copy to {self.target_url} ", "C")
-        report_duration_and_rate(s3.copy_between_buckets,
+        report_duration_and_rate(clients.s3_agent().copy_between_buckets,
                                  source_location,
                                  self.target_url,
                                  self.file.size,
                                  size=self.file.size)
-        S3ObjectTagger(self.target_url).complete_tags()
+        S3ObjectTagger(self.target_url, s3agent=clients.s3_agent()).complete_tags()
 
     def copy_local_file_to_target_location(self, source_location):
         local_path = parse_url(source_location).path.lstrip('/')
         logger.output(f"\n      upload to {self.target_url} ", "⬆︎")
-        self.file.checksums = report_duration_and_rate(s3.upload_and_checksum,
+        self.file.checksums = report_duration_and_rate(clients.s3_agent().upload_and_checksum,
                                                        local_path,
                                                        self.target_url,
                                                        self.file.size,
                                                        size=self.file.size)
-        S3ObjectTagger(self.target_url).tag_using_these_checksums(self.file.checksums)
+        S3ObjectTagger(self.target_url, s3agent=clients.s3_agent()).tag_using_these_checksums(self.file.checksums)
         logger.output("+tagging ")
 
+    def stream_origin_file_to_target_location(self):
+        logger.output(f"\n      streaming {self.file.origin_url} to {self.target_url} ", "⇣")
+        try:
+            self.file.checksums = report_duration_and_rate(self._stream_from_origin, size=self.file.size)
+        except Exception as e:
+            logger.output(f"      error streaming ({str(e)})", "!")
+            raise BundleMissingDataFile(f"Cannot stream {self.file.name} from {self.file.origin_url}")
+        S3ObjectTagger(self.target_url, s3agent=clients.s3_agent()).tag_using_these_checksums(self.file.checksums)
+        logger.output("+tagging ")
+
+    def _stream_from_origin(self):
+        with origin_scheduler.connection(self.file.origin_url):
+            origin_scheduler.throttle(self.file.origin_url)
+            with self._origin_stream() as in_stream:
+                checksums = clients.s3_agent().stream_upload_and_checksum(
+                    ThrottledReader(in_stream, 'ingress', bandwidth_limiter), self.target_url, self.file.size)
+        obj = clients.s3_agent().get_object(self.target_url)
+        if obj.content_length != self.file.size:
+            clients.s3_agent().delete_object(self.target_url)
+            raise RuntimeError(f"streamed {obj.content_length} bytes, expected {self.file.size}")
+        return checksums
+
+    @contextmanager
+    def _origin_stream(self):
+        """ Yields a raw binary stream of the file, from its origin server """
+        if parse_url(self.file.origin_url).scheme == 'ftp':
+            with FTPReader(self.file.origin_url, self.file.size) as in_stream:
+                yield in_stream
+        else:
+            with clients.http().request('GET', self.file.origin_url, preload_content=False,
+                                        decode_content=False, enforce_content_length=True) as in_stream:
+                if not 200 <= in_stream.status < 300:
+                    # Don't store an error page as the data file.
+                    raise RuntimeError(f"{self.file.origin_url} returned status {in_stream.status}")
+                # Keep the response usable by the io.BufferedReader inside ChecksummingBufferedReader.
+                in_stream.auto_close = False
+                yield in_stream
+
+    def _can_stream_from_origin(self):
+        return not self._find_locally() and parse_url(self.file.origin_url).scheme in self.STREAMABLE_SCHEMES
+
     def _find_locally(self):
         local_path = self.file.path()
         if os.path.isfile(local_path) and os.stat(local_path).st_size == self.file.size:
@@ -150,16 +269,17 @@ class DataFileStager:
         logger.output(f"\n      downloading {self.file.origin_url}", "↓")
         dest_path = self.file.path()
         try:
-            report_duration_and_rate(self._download, self.file.origin_url, dest_path, size=self.file.size)
+            downloader = downloader_for(self.file.origin_url, connections=self.connections)
+            report_duration_and_rate(downloader.download, self.file.origin_url, dest_path, self.file.size,
+                                     size=self.file.size)
             return f"file:///{dest_path}"
         # except urllib.error.HTTPError:
         except Exception as e:
             logger.output(f"      error downloading ({str(e)})", "!")
-            os.remove(dest_path)
             return None
 
     def _ensure_checksum_tags(self):
-        if S3ObjectTagger(self.target_url).complete_tags():
+        if S3ObjectTagger(self.target_url, s3agent=clients.s3_agent()).complete_tags():
             logger.progress("+")
 
     @staticmethod
@@ -169,13 +289,6 @@ class DataFileStager:
             logger.output(f"\n      Deleting {location}")
             os.remove(urlbits.path.lstrip('/'))
 
-    @staticmethod
-    def _download(src_url: str, dest_path: str):
-        with open(dest_path, 'wb') as out_file:
-            # TODO now that we switched from urlopen(), this will fail with FTP files
-            with http.request('GET', src_url, preload_content=False) as in_stream:
-                copyfileobj(in_stream, out_file)
-
 
 class MetadataFileStager:
 
@@ -185,18 +298,24 @@ class MetadataFileStager:
 
     def stage(self, bucket):
         self.target = f"s3://{bucket}/{self.file.path()}"
+        local_mtime = os.stat(self.file.path()).st_mtime
+        if staged_catalog.is_staged(self.target, self.file.size, local_mtime):
+            logger.output("=present (catalogued) ", progress_char="✓")
+            self.file.staged_url = self.target
+            return
         if self._obj_is_at_target_location():
             logger.output("=present ", progress_char="✓")
-            S3ObjectTagger(self.target).complete_tags()
+            S3ObjectTagger(self.target, s3agent=clients.s3_agent()).complete_tags()
         else:
             logger.output("+uploading ", progress_char="↑")
-            checksums = s3.upload_and_checksum(self.file.path(), self.target, self.file.size)
-            S3ObjectTagger(self.target).tag_using_these_checksums(checksums)
+            checksums = clients.s3_agent().upload_and_checksum(self.file.path(), self.target, self.file.size)
+            S3ObjectTagger(self.target, s3agent=clients.s3_agent()).tag_using_these_checksums(checksums)
             logger.output("+tagging ")
         self.file.staged_url = self.target
+        record_in_catalog(self.target, local_mtime)
 
     def _obj_is_at_target_location(self):
-        obj = s3.get_object(self.target)
+        obj = clients.s3_agent().get_object(self.target)
         if obj:
             local_checksums = self._checksum_local_file()
             if local_checksums['s3_etag'] == obj.e_tag.strip('"'):
@@ -206,8 +325,9 @@ class MetadataFileStager:
         return False
 
     def _checksum_local_file(self):
-        with ChecksummingSink() as sink:
-            with open(self.file.path(), 'rb') as fh:
-                copyfileobj(fh, sink)
-            return sink.get_checksums()
+        return checksum_cache.checksums(self.file.path(), self._compute_checksums)
+
+    @staticmethod
+    def _compute_checksums(path: str) -> dict:
+        return LocalFileChecksummer(path, part_size=S3Agent._s3_chunk_size(os.path.getsize(path))).checksums()
 
@@ -1,11 +1,13 @@
-import os, uuid, time
+import os, signal, uuid, time
 from datetime import datetime
 
-import boto3
 import requests
 from urllib3.util import Url
 
+from .bundle import StagedBundle
+from .clients import clients
 from .parallel_logger import logger
+from .submission import SubmissionChanged
 from .utils import sizeof_fmt, measure_duration_and_rate
 
 
@@ -17,7 +19,7 @@ class BundleStorer:
         driver = 'rest' if use_rest_api else 'python'
         self.api = DataStoreAPI(driver=driver, endpoint_url=dss_url, report_task_ids=report_task_ids)
 
-    def store_bundle(self):
+    def store_bundle(self) -> bool:
         try:
             logger.output(f"\n{self.bundle.path}:", progress_char="B")
             self._assign_uuids()
@@ -25,9 +27,11 @@ class BundleStorer:
             self._store_files()
             self._register_bundle()
             logger.flush()
-        except DSSAPIError as e:
+            return True
+        except (DSSAPIError, SubmissionChanged) as e:
             logger.output(f"\n\nERROR attempting to store bundle {self.bundle.path}: {str(e)}\n",
                           progress_char="!", flush=True)
+            return False
 
     def _store_files(self):
         for file in self.bundle.files.values():
@@ -57,25 +61,49 @@ class BundleStorer:
         logger.output(version, progress_char='✔︎')
 
 
+# Runs in ProcessPoolExecutor workers, so is a module-level function.
+
+def store_bundle(bundle: tuple, dss_url: str, storer_options: dict, smaller_than_mb: int):
+    """
+    bundle is (bundle URL, its submission info and submission.json ETag from a current StagedBundleIndex entry,
+    or None, None).
+    Returns (submission info, submission.json ETag) once the bundle is stored, True if it was skipped,
+    or False if storing failed.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    bundle_url, info, etag = bundle
+    bundle = StagedBundle(bundle_url, info=info, etag=etag)
+    if not bundle.all_files_are_smaller_than(smaller_than_mb):
+        logger.output(f"\nSkipping {bundle.path} - exceeds sized requirement", progress_char='-', flush=True)
+        return True
+    if BundleStorer(bundle, dss_url, **storer_options).store_bundle():
+        return bundle.submission_info.info, bundle.submission_info.etag
+    return False
+
+
 class StagedBundleFinder:
 
     def __init__(self):
         self.bundle_paths = list()
-        self.s3 = boto3.client('s3')
+        self.s3 = clients.s3client()
 
     def paths_of_bundles_under(self, s3url: Url) -> list:
+        self.bundle_paths = list(self.iter_paths_of_bundles_under(s3url))
+        return self.bundle_paths
+
+    def iter_paths_of_bundles_under(self, s3url: Url):
+        """ Yields the paths of bundles as they are found """
         # Assumption: bundles are stored at **/bundles/bundleX/
         logger.output(f"\nFinding bundles under {str(s3url)}...", flush=True)
-        self._search_for_bundles_in_folder(bucket=s3url.host, root_path=s3url.path.lstrip('/'))
+        yield from self._search_for_bundles_in_folder(bucket=s3url.host, root_path=s3url.path.lstrip('/'))
         logger.output("\n")
-        return self.bundle_paths
 
-    def _search_for_bundles_in_folder(self, bucket: str, root_path: str) -> list:
+    def _search_for_bundles_in_folder(self, bucket: str, root_path: str):
         for folder_path in self._subfolders_in_folder(bucket, root_path):
             if self._is_bundle_home(root_path):
-                self.bundle_paths.append(folder_path.rstrip('/'))
+                yield folder_path.rstrip('/')
             else:
-                self._search_for_bundles_in_folder(bucket, folder_path)
+                yield from self._search_for_bundles_in_folder(bucket, folder_path)
 
     def _subfolders_in_folder(self, bucket: str, folder_path: str):
         paginator = self.s3.get_paginator('list_objects')
@@ -2,25 +2,50 @@ import copy, json, re
 
 from botocore.exceptions import ClientError
 
-from .s3 import S3Agent
+from .clients import clients
 import bundle_tools
 
 
+class SubmissionChanged(RuntimeError):
+    """ submission.json was written by someone else since it was loaded """
+    pass
+
+
 class SubmissionInfo:
 
     SUBMISSION_FILENAME = "submission.json"
+    CONFLICT_ERROR_CODES = ('PreconditionFailed', 'ConditionalRequestConflict')
 
     def __init__(self, bucket_name, bundle):
         self.bucket_name = bucket_name
         self.bundle = bundle
         self.info = None
         self.orig_info = None
-        self.s3_obj = S3Agent().object(f"s3://{self.bucket_name}/{self.bundle.path}/{self.SUBMISSION_FILENAME}")
+        self.etag = None  # of submission.json, as loaded or last saved
+        self._s3_obj = None
+
+    @property
+    def s3_obj(self):
+        if self._s3_obj is None:
+            url = f"s3://{self.bucket_name}/{self.bundle.path}/{self.SUBMISSION_FILENAME}"
+            self._s3_obj = clients.s3_agent().object(url)
+        return self._s3_obj
 
-    def load(self):
+    def __getstate__(self):
+        """ boto3 objects can't be pickled, so SubmissionInfos travel between processes without theirs """
+        return dict(self.__dict__, _s3_obj=None)
+
+    def load(self, info: dict=None, etag: str=None):
+        """
+        Load from submission.json, or from `info` and `etag`, if given: a StagedBundleIndex entry, which the index
+        has found to be current (submission.json still has that ETag).
+        """
         try:
-            submission_json = self.s3_obj.get()['Body'].read()
-            self.info = json.loads(submission_json)
+            if info is not None and etag:
+                self.info, self.etag = info, etag
+            else:
+                response = self.s3_obj.get()
+                self.info, self.etag = json.loads(response['Body'].read()), response['ETag']
             self.orig_info = copy.deepcopy(self.info)
             for file in self.export_files():
                 self.bundle.add_file(file)
@@ -28,9 +53,21 @@ class SubmissionInfo:
             self.info = {}
 
     def save(self) -> bool:
+        """
+        Writes submission.json only if it is unchanged since it was loaded, so newer content is never lost:
+        raises SubmissionChanged otherwise.
+        """
         self.extract_bundle_info()
         if self.info != self.orig_info:
-            self.s3_obj.put(Body=json.dumps(self.info))
+            condition = {'IfMatch': self.etag} if self.etag else {'IfNoneMatch': '*'}
+            try:
+                self.etag = self.s3_obj.put(Body=json.dumps(self.info), **condition)['ETag']
+            except ClientError as e:
+                if e.response['Error']['Code'] in self.CONFLICT_ERROR_CODES:
+                    raise SubmissionChanged(f"{self.bundle.path}/{self.SUBMISSION_FILENAME} was changed by "
+                                            f"another run since it was loaded")
+                raise
+            self.orig_info = copy.deepcopy(self.info)
             return True
         else:
             return False
@@ -41,6 +78,8 @@ class SubmissionInfo:
     def extract_bundle_info(self):
         if hasattr(self.bundle, 'uuid'):
                 self.info['bundle_uuid'] = self.bundle.uuid
+        if getattr(self.bundle, 'fingerprint', None):
+            self.info['bundle_fingerprint'] = self.bundle.fingerprint
         file_entries = self.info.setdefault('files', [])
         for file in self.bundle.files.values():
             try:
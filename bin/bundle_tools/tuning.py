@@ -0,0 +1,148 @@
+import threading, time
+from contextlib import contextmanager
+
+from boto3.s3.transfer import TransferConfig
+
+KB = 1024
+MB = KB * KB
+GB = KB * MB
+
+
+class HillClimber:
+    """
+    Tunes one setting by trying its neighbouring levels, one step at a time.
+
+    Measurements alternate between the accepted level (to keep its baseline rate current) and a probe of
+    the next level in the current direction.  A probe that beats the baseline by MIN_GAIN is accepted, and
+    climbing continues that way.  Otherwise the direction is reversed.
+    """
+
+    MIN_GAIN = 0.05
+    SMOOTHING = 0.5
+
+    def __init__(self, levels: tuple, start: int):
+        self.levels = levels
+        self.index = levels.index(start)
+        self.baseline = None
+        self.probe = None
+        self.direction = 1
+
+    def value(self):
+        return self.levels[self.index if self.probe is None else self.probe]
+
+    def record(self, rate: float) -> bool:
+        """ Returns True when a probe has just been rejected """
+        if self.probe is not None:
+            accepted = rate > self.baseline * (1 + self.MIN_GAIN)
+            if accepted:
+                self.index, self.baseline = self.probe, rate
+            else:
+                self.direction = -self.direction
+            self.probe = None
+            return not accepted
+        if self.baseline is None:
+            self.baseline = rate
+        else:
+            self.baseline = self.SMOOTHING * rate + (1 - self.SMOOTHING) * self.baseline
+        for direction in (self.direction, -self.direction):
+            if 0 <= self.index + direction < len(self.levels):
+                self.direction = direction
+                self.probe = self.index + direction
+                break
+        return False
+
+
+class SizeClassTuner:
+    """
+    Tunes max_concurrency, and io_chunksize if given, for one kind of transfer of one class of file size.
+    """
+
+    def __init__(self, concurrency_levels: tuple, concurrency: int, io_chunksize: int=None):
+        self.climbers = dict(max_concurrency=HillClimber(concurrency_levels, concurrency))
+        if io_chunksize:
+            self.climbers['io_chunksize'] = HillClimber(TransferTuner.IO_CHUNK_SIZES, io_chunksize)
+        self.tuning = 'max_concurrency'
+
+    def settings(self) -> dict:
+        return {name: climber.value() for name, climber in self.climbers.items()}
+
+    def record(self, settings: dict, rate: float):
+        if settings != self.settings():
+            return  # Measured with settings that have since moved on (concurrent transfers).
+        if self.climbers[self.tuning].record(rate):
+            names = list(self.climbers)
+            self.tuning = names[(names.index(self.tuning) + 1) % len(names)]
+
+
+class TransferTuner:
+    """
+    Adaptive boto3 transfer settings, tuned separately for each kind of transfer (upload or copy) and
+    class of file size, from the rates achieved by the transfers made so far in this process.
+
+    Only max_concurrency, io_chunksize and use_threads are tuned.  Part sizes are left as S3Agent sets them,
+    so ETags, and hence checksum tags, are unaffected.  Files below the multipart threshold are sent in a
+    single request, so gain nothing from threads and are sent without them.
+    """
+
+    # (upper bound, max_concurrency, io_chunksize) to start from for each size class
+    SIZE_CLASSES = ((GB, 8, 256 * KB),
+                    (16 * GB, 10, 1 * MB),
+                    (None, 16, 4 * MB))
+    CONCURRENCY_LEVELS = (2, 4, 6, 8, 10, 12, 16, 24, 32, 48, 64)
+    IO_CHUNK_SIZES = (64 * KB, 256 * KB, 1 * MB, 4 * MB, 8 * MB)
+    MIN_DURATION = 1.0  # seconds; quicker transfers are dominated by latency, so say little about settings
+
+    def __init__(self):
+        self.enabled = False
+        self.max_concurrency = None
+        self._tuners = {}
+        self._lock = threading.Lock()
+
+    def configure(self, enabled: bool=False, max_concurrency: int=None):
+        """ max_concurrency should not exceed the S3 client's connection pool size """
+        self.enabled = enabled
+        self.max_concurrency = max_concurrency
+
+    @contextmanager
+    def tuned(self, kind: str, config: TransferConfig, file_size: int):
+        """ Applies tuned settings to `config` for the duration of the context, then learns from the rate achieved """
+        if not self.enabled:
+            yield config
+            return
+        if file_size < config.multipart_threshold:
+            config.use_threads = False
+            yield config
+            return
+        with self._lock:
+            tuner = self._tuner(kind, file_size)
+            settings = tuner.settings()
+        for name, value in settings.items():
+            setattr(config, name, value)
+        start = time.time()
+        yield config
+        duration = time.time() - start
+        if duration >= self.MIN_DURATION:
+            with self._lock:
+                tuner.record(settings, file_size / duration / MB)
+
+    def settings(self) -> dict:
+        """ The settings currently in use, for reporting """
+        with self._lock:
+            return {f"{kind} {size_class}": tuner.settings() for (kind, size_class), tuner in self._tuners.items()}
+
+    def _tuner(self, kind: str, file_size: int) -> SizeClassTuner:
+        for upper_bound, concurrency, io_chunksize in self.SIZE_CLASSES:
+            if upper_bound is None or file_size < upper_bound:
+                break
+        size_class = f"<{upper_bound // MB}MB" if upper_bound else "large"
+        key = (kind, size_class)
+        if key not in self._tuners:
+            levels = tuple(level for level in self.CONCURRENCY_LEVELS
+                           if not self.max_concurrency or level <= self.max_concurrency) or (1,)
+            concurrency = max(level for level in levels if level <= max(concurrency, levels[0]))
+            # Copies are made server-side, so only uploads read local data in io_chunksize pieces.
+            self._tuners[key] = SizeClassTuner(levels, concurrency, io_chunksize if kind == 'upload' else None)
+        return self._tuners[key]
+
+
+transfer_tuner = TransferTuner()
@@ -1,17 +1,17 @@
 from os import stat
 import time
-from ftplib import FTP
 
-import urllib3
 from urllib3.util import parse_url
 
+from .clients import clients
+from .ftp import ftp_sessions
+from .scheduling import origin_scheduler
+
 KB = 1024
 MB = KB * KB
 GB = KB * MB
 TB = KB * GB
 
-http = urllib3.PoolManager()
-
 
 def measure_duration_and_rate(func,  *args, size):
     retval, duration = measure_duration(func, *args)
@@ -39,8 +39,9 @@ def sizeof_fmt(num, suffix='B'):
 
 def file_size(url: str) -> int:
     urlbits = parse_url(url)
-    if urlbits.scheme == 'http':
-        return int(http.request('HEAD', url).headers['Content-Length'])
+    origin_scheduler.throttle(url)
+    if urlbits.scheme in ('http', 'https'):
+        return int(clients.http().request('HEAD', url).headers['Content-Length'])
     elif urlbits.scheme == 'ftp':
         return ftp_file_size(urlbits)
     elif urlbits.scheme == 'file':
@@ -50,8 +51,4 @@ def file_size(url: str) -> int:
 
 
 def ftp_file_size(ftp_url):
-    ftp = FTP(ftp_url.netloc)
-    ftp.login()
-    size = ftp.size(ftp_url.path)
-    ftp.quit()
-    return size
+    return ftp_sessions.size(ftp_url.netloc, ftp_url.path)
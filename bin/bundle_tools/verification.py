@@ -0,0 +1,208 @@
+import asyncio, functools, itertools, json, os, resource
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from .parallel_logger import logger
+from .bundle import LocalBundle
+from .s3 import S3ObjectTagger
+from .catalog import staged_catalog
+from .checksum_cache import checksum_cache
+from .staging import MetadataFileStager
+
+
+class AsyncS3Client:
+    """
+    The few read-only S3 requests that verification makes, as coroutines.
+
+    Each request is made by a boto3 client on a pool of `max_connections` threads, sharing as many pooled
+    connections, so botocore takes care of signing, addressing, retries, and following redirects to a bucket's
+    region.  endpoint_url, if given, is that of an S3 stand-in (e.g. moto_server).
+    """
+
+    MAX_ATTEMPTS = 5
+
+    def __init__(self, max_connections: int, endpoint_url: str=None):
+        session = boto3.session.Session()
+        if session.get_credentials() is None:
+            raise RuntimeError("No AWS credentials found: configure them as for the AWS CLI")
+        config = Config(max_pool_connections=max_connections,
+                        retries={'max_attempts': self.MAX_ATTEMPTS, 'mode': 'standard'})
+        self.s3client = session.client('s3', endpoint_url=endpoint_url, config=config)
+        self._threads = ThreadPoolExecutor(max_workers=max_connections)
+
+    async def head_object(self, bucket: str, key: str):
+        """ Returns the object's metadata (ContentLength, ETag, ...), or None if there is no such object """
+        try:
+            return await self._call(self.s3client.head_object, Bucket=bucket, Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return None
+            raise
+
+    async def get_object(self, bucket: str, key: str) -> tuple:
+        """ Returns (the object's content, its ETag), or (None, None) if there is no such object """
+        try:
+            response = await self._call(self.s3client.get_object, Bucket=bucket, Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return None, None
+            raise
+        return await self._call(response['Body'].read), response['ETag']
+
+    async def get_object_tagging(self, bucket: str, key: str) -> dict:
+        response = await self._call(self.s3client.get_object_tagging, Bucket=bucket, Key=key)
+        return {tag['Key']: tag['Value'] for tag in response['TagSet']}
+
+    def close(self):
+        self._threads.shutdown()
+
+    async def _call(self, method, **kwargs):
+        return await asyncio.get_event_loop().run_in_executor(self._threads, functools.partial(method, **kwargs))
+
+
+class BundleVerifier:
+    """
+    Checks, from a single process, which files of many bundles are already correctly staged.
+
+    This asks S3 the same questions BundleStager does - is the object there, with the right size (data files)
+    or ETag (metadata files), and all of S3ObjectTagger's tags, the ETag tag matching the object - but with
+    many requests in flight at once, rather than one at a time per job.  Concurrency is capped below the
+    process's open file limit, as each request in flight holds a connection.
+
+    Data files are checked against the sizes recorded in submission.json when they were staged, not against
+    their origin servers, so a data file that has since changed at its origin still verifies.
+
+    Each bundle's `verified_files` is set to the names of its files that need no further work.  Bundles
+    whose every file is verified, and listed as staged in its submission.json, need not be staged at all;
+    their path, submission info and submission.json ETag are passed to on_verified(bundle_path, info, etag),
+    if given.
+    Unless `full`, files the staged_catalog records as staged are taken to be so, without asking S3.
+    """
+
+    DEFAULT_CONCURRENCY = 64
+    BATCH_SIZE = 1000  # bundles
+    RESERVED_FILE_DESCRIPTORS = 64
+
+    def __init__(self, target_bucket: str, concurrency: int=DEFAULT_CONCURRENCY, endpoint_url: str=None,
+                 full: bool=False, on_verified=None):
+        self.target_bucket = target_bucket
+        self.concurrency = max(1, min(concurrency, self._connection_limit()))
+        self.endpoint_url = endpoint_url
+        self.full = full
+        self.on_verified = on_verified
+        self.bundles_verified = 0
+        self.bundles_seen = 0
+
+    def verify(self, bundles):
+        """
+        Yields the bundles that still need staging.  bundles may be a generator: they are verified in batches
+        of BATCH_SIZE, as they are found, so staging can start before every bundle has been found.
+        """
+        bundles = iter(bundles)
+        loop = asyncio.new_event_loop()
+        checksummers = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+        loop.set_default_executor(checksummers)
+        client = None
+        try:
+            while True:
+                batch = list(itertools.islice(bundles, self.BATCH_SIZE))
+                if not batch:
+                    break
+                client = client or AsyncS3Client(self.concurrency, endpoint_url=self.endpoint_url)
+                complete = loop.run_until_complete(self._verify_bundles(client, batch))
+                self.bundles_seen += len(batch)
+                self.bundles_verified += sum(complete)
+                logger.flush()
+                for bundle, bundle_complete in zip(batch, complete):
+                    if not bundle_complete:
+                        yield bundle
+        finally:
+            if client:
+                client.close()
+            loop.close()
+            checksummers.shutdown()
+
+    @classmethod
+    def _connection_limit(cls) -> int:
+        soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft_limit == resource.RLIM_INFINITY:
+            return cls.DEFAULT_CONCURRENCY * 16
+        return soft_limit - cls.RESERVED_FILE_DESCRIPTORS
+
+    async def _verify_bundles(self, client: AsyncS3Client, bundles: list) -> list:
+        bundle_slots = asyncio.Semaphore(self.concurrency)
+
+        async def verify_bundle(bundle):
+            async with bundle_slots:
+                try:
+                    return await self._verify_bundle(client, bundle)
+                except Exception as e:
+                    logger.output(f"\nBundle: {bundle.path}: cannot verify: {str(e)}")
+                    return False
+        return await asyncio.gather(*[verify_bundle(bundle) for bundle in bundles])
+
+    async def _verify_bundle(self, client: AsyncS3Client, bundle: LocalBundle) -> bool:
+        local = LocalBundle(bundle.path)
+        local.enumerate_local_metadata_files()
+        data_file_names = self._data_file_names(local)
+        submission_json, submission_etag = await client.get_object(self.target_bucket,
+                                                                   f"{bundle.path}/submission.json")
+        submission = json.loads(submission_json or '{}')
+        entries = {entry['name']: entry for entry in submission.get('files', [])}
+        checks = [self._verify_metadata_file(client, file) for file in local.files.values()]
+        checks += [self._verify_data_file(client, f"{bundle.path}/{name}", entries[name]['size'])
+                   for name in data_file_names if entries.get(name, {}).get('size') is not None]
+        results = await asyncio.gather(*checks)
+        bundle.verified_files = {key.split('/')[-1] for key, verified in results if verified}
+        all_files = set(local.files) | set(data_file_names)
+        complete = bundle.verified_files == all_files and all(
+            entries.get(name, {}).get('staged_url') == f"s3://{self.target_bucket}/{bundle.path}/{name}"
+            for name in all_files)
+        if complete:
+            if self.on_verified:
+                self.on_verified(bundle.path, submission, submission_etag)
+            logger.output(f"\nBundle: {bundle.path} =verified", "V")
+        return complete
+
+    @staticmethod
+    def _data_file_names(bundle: LocalBundle) -> list:
+        if bundle.manifest is None:
+            return []
+        with open(bundle.manifest) as fh:
+            return [fileinfo['name'] for fileinfo in json.load(fh)['files']]
+
+    async def _verify_data_file(self, client: AsyncS3Client, key: str, size: int) -> tuple:
+        url = f"s3://{self.target_bucket}/{key}"
+        if not self.full and staged_catalog.is_staged(url, size):
+            return key, True
+        head = await client.head_object(self.target_bucket, key)
+        if head is None or head['ContentLength'] != size:
+            return key, False
+        return key, await self._tags_are_complete(client, key, head, size)
+
+    async def _verify_metadata_file(self, client: AsyncS3Client, file) -> tuple:
+        key = file.path()
+        url = f"s3://{self.target_bucket}/{key}"
+        local_mtime = os.stat(key).st_mtime
+        if not self.full and staged_catalog.is_staged(url, file.size, local_mtime):
+            return key, True
+        head = await client.head_object(self.target_bucket, key)
+        if head is None:
+            return key, False
+        checksums = await asyncio.get_event_loop().run_in_executor(
+            None, checksum_cache.checksums, key, MetadataFileStager._compute_checksums)
+        if checksums['s3_etag'] != head['ETag'].strip('"'):
+            return key, False
+        return key, await self._tags_are_complete(client, key, head, file.size, local_mtime)
+
+    async def _tags_are_complete(self, client: AsyncS3Client, key: str, head: dict, size: int,
+                                 local_mtime: float=None) -> bool:
+        tags = await client.get_object_tagging(self.target_bucket, key)
+        etag = head['ETag'].strip('"')
+        if any(tag not in tags for tag in S3ObjectTagger.ALL_TAGS) or tags['hca-dss-s3_etag'] != etag:
+            return False
+        staged_catalog.record(f"s3://{self.target_bucket}/{key}", size, etag, tags, local_mtime)
+        return True
@@ -4,7 +4,7 @@
 stage_and_story.py - Stage a bundle and store it in the HCA DSS.
 """
 
-import argparse, glob, os, io, sys, re, time, logging, uuid, json, base64, hashlib, mimetypes
+import argparse, glob, os, io, sys, re, time, logging, uuid, json, base64, hashlib, mimetypes, queue, threading
 from io import BufferedReader
 from datetime import datetime
 
@@ -18,6 +18,11 @@ except ImportError:
           "\n\tpip install boto3 requests crcmod dotmap urllib3\n")
     exit(1)
 
+try:
+    import crc32c  # Much faster than crcmod, but optional.
+except ImportError:
+    crc32c = None
+
 logging.basicConfig()
 logger = logging.getLogger("stage_and_store")
 
@@ -41,15 +46,35 @@ def progress(message):
     sys.stdout.flush()
 
 
+class Crc32c:
+    """ CRC32C using the crc32c package if it is installed, otherwise crcmod.  Same output either way. """
+
+    def __init__(self):
+        self._crc = 0
+        self._crcmod = None if crc32c else crcmod.predefined.Crc("crc-32c")
+
+    def update(self, chunk):
+        if self._crcmod:
+            self._crcmod.update(chunk)
+        else:
+            self._crc = crc32c.crc32c(chunk, self._crc)
+
+    def hexdigest(self):
+        return self._crcmod.hexdigest() if self._crcmod else '%08X' % self._crc
+
+
 class S3Etag:
+    """ The ETag of an upload of etag_stride parts, whose multipart_threshold is also etag_stride """
     etag_stride = 64 * 1024 * 1024
 
     def __init__(self):
+        self._total_bytes = 0
         self._etag_bytes = 0
         self._etag_parts = []
         self._etag_hasher = hashlib.md5()
 
     def update(self, chunk):
+        self._total_bytes += len(chunk)
         if self._etag_bytes + len(chunk) > self.etag_stride:
             chunk_head = chunk[:self.etag_stride - self._etag_bytes]
             chunk_tail = chunk[self.etag_stride - self._etag_bytes:]
@@ -66,7 +91,8 @@ class S3Etag:
         if self._etag_bytes:
             self._etag_parts.append(self._etag_hasher.digest())
             self._etag_bytes = 0
-        if len(self._etag_parts) > 1:
+        # s3transfer uploads anything of at least multipart_threshold bytes in parts, even if only one.
+        if len(self._etag_parts) > 1 or self._total_bytes >= self.etag_stride:
             etag_csum = hashlib.md5(b"".join(self._etag_parts)).hexdigest()
             return '{}-{}'.format(etag_csum, len(self._etag_parts))
         else:
@@ -74,32 +100,67 @@ class S3Etag:
 
 
 class ChecksummingBufferedReader:
+    """
+    Checksums what is read, with each algorithm in its own thread (hashlib releases the GIL).
+    read() blocks once any algorithm falls more than QUEUE_DEPTH chunks behind.
+    If an algorithm fails, read() and get_checksums() raise its exception.
+    """
+
+    QUEUE_DEPTH = 4
 
     def __init__(self, *args, **kwargs):
-        self._hashers = dict(crc32c=crcmod.predefined.Crc("crc-32c"),
+        self._hashers = dict(crc32c=Crc32c(),
                              sha1=hashlib.sha1(),
                              sha256=hashlib.sha256(),
                              s3_etag=S3Etag())
+        self._queues = {name: queue.Queue(maxsize=self.QUEUE_DEPTH) for name in self._hashers}
+        self._errors = []
+        self._workers = [threading.Thread(target=self._hash, args=(name,), daemon=True) for name in self._hashers]
+        for worker in self._workers:
+            worker.start()
         self._reader = BufferedReader(*args, **kwargs)
         self.raw = self._reader.raw
 
     def read(self, size=None):
+        if self._errors:
+            raise self._errors[0]
         chunk = self._reader.read(size)
         if chunk:
-            for hasher in self._hashers.values():
-                hasher.update(chunk)
+            for chunk_queue in self._queues.values():
+                chunk_queue.put(chunk)
         return chunk
 
     def get_checksums(self):
+        self.close()
+        if self._errors:
+            raise self._errors[0]
         checksums = {}
         checksums.update({name: hasher.hexdigest() for name, hasher in self._hashers.items()})
         return checksums
 
+    def close(self):
+        if any(worker.is_alive() for worker in self._workers):
+            for chunk_queue in self._queues.values():
+                chunk_queue.put(None)
+            for worker in self._workers:
+                worker.join()
+
+    def _hash(self, name):
+        failed = False
+        for chunk in iter(self._queues[name].get, None):
+            if failed:
+                continue  # Keep draining, so read() never blocks on a dead worker.
+            try:
+                self._hashers[name].update(chunk)
+            except Exception as e:
+                self._errors.append(e)
+                failed = True
+
     def __enter__(self):
         return self
 
     def __exit__(self, *args, **kwargs):
-        pass
+        self.close()
 
 
 class File(object):
@@ -313,18 +374,19 @@ class S3Agent:
         bucket = self.s3.Bucket(target_bucket)
         with io.open(local_path, 'rb') as fh:
             self.cumulative_bytes_transferred = 0
-            reader = ChecksummingBufferedReader(fh)
-            obj = bucket.Object(target_key)
-            obj.upload_fileobj(reader,
-                               ExtraArgs={
-                                   'ContentType': content_type,
-                                   'ACL': 'bucket-owner-full-control'
-                               },
-                               Callback=self._file_upload_progress_callback,
-                               Config=self.transfer_config(file_size)
-                               )
+            with ChecksummingBufferedReader(fh) as reader:
+                obj = bucket.Object(target_key)
+                obj.upload_fileobj(reader,
+                                   ExtraArgs={
+                                       'ContentType': content_type,
+                                       'ACL': 'bucket-owner-full-control'
+                                   },
+                                   Callback=self._file_upload_progress_callback,
+                                   Config=self.transfer_config(file_size)
+                                   )
+                checksums = reader.get_checksums()
         sys.stdout.write("\n")
-        return reader.get_checksums()
+        return checksums
 
     def add_tagging(self, s3url, tags):
         s3loc = S3Location(s3url)
@@ -15,22 +15,80 @@ Default action is to traverse the import/ folder finding bundles, then for each
         - Checksum it.
         - Upload to S3 unless a files already exists there with this checksum.
 
+Bundles are found by listing the import tree on several threads, without looking inside bundles
+folders, and staging starts with the first bundles found.  --bundle-index saves the folders found,
+so later runs need only stat() the folders of an unchanged tree.
+
 Checking 100,000 files can be a slow process, so you can parallelize with the -j option.
 Try running on an m4.2xlarge with -j16.  This will take under an hour and works well in
-the case where there are no new data-files to be uploaded.  Note however that if there
-are new data-files to be uploaded, you will want to use minimal or no concurrency for
-those bundles to avoid overloading the web server from which they are being downloaded.
+the case where there are no new data-files to be uploaded.  If there are new data-files
+to be uploaded, use --max-downloads-per-host and/or --origin-requests-per-second to avoid
+overloading the web server from which they are being downloaded.  These limits apply across
+all jobs, and only to requests made to origin servers, so checking and S3 work is not slowed.
+
+Re-runs can skip checking files in S3 altogether using --catalog, a local database of files that
+were found to be correctly staged by previous runs.  Entries are trusted for --catalog-ttl hours.
+Similarly --checksum-cache avoids re-checksumming metadata files that are unchanged, or identical
+to ones already checksummed.
+
+The sizes of a bundle's data files are looked up at their origin servers concurrently, reusing FTP logins.
+--size-cache remembers them, for --size-cache-ttl hours, so re-runs need not ask again.
+
+Use --file-jobs to also stage the files within each bundle concurrently (on a pool of threads).
+
+With -j, each job normally stages a whole bundle at a time, so a run can end with one job still working
+through a huge bundle while the others sit idle.  --schedule files instead makes a job of every file of
+a few hundred bundles at a time, starting with the largest, and writes each submission.json once all of its
+files are done.
+
+Data files are normally downloaded to the bundle folder, uploaded, then deleted.  With --stream
+they are instead piped from the origin web or FTP server straight into S3, so no local disk is needed.
+Large downloads can be split into byte ranges fetched over several connections with --connections-per-file.
+FTP transfers reuse logged-in sessions, and resume where they left off if a connection drops.
+
+By default every upload and S3 copy uses boto3's standard concurrency and I/O chunk size.  With
+--adaptive-transfers these are tuned as the run goes, separately for each class of file size, by trying
+neighbouring settings and keeping whichever achieves the better MiB/s.  Part sizes (and so ETags) are unaffected.
+
+Data files being downloaded can take up a lot of local disk, and those being streamed a lot of memory.
+Use --disk-budget and --memory-budget to cap the total, across all jobs.  Transfers that would exceed
+a budget wait for others to finish, so -j can be set high without risk of filling the disk.
+Without a disk budget, a download that fails is kept for a later run to resume; with one, it is deleted.
+
+Total bandwidth, across all jobs, can be capped with --max-ingress (downloads from origin servers) and
+--max-egress (uploads to S3), in MB/s.  To change the caps of a run in progress, run
+    stager.py --adjust-bandwidth --max-ingress <MB/s> --max-egress <MB/s>
+on the same machine, as the same user.  A cap that isn't given is left as it is, and 0 removes a cap.
+Caps last only as long as the run that set them; other runs on the machine share them meanwhile.
+
+With --verify-first, bundles are first checked from a single process that keeps up to --verify-concurrency
+S3 requests in flight at once.  Bundles found to be completely staged are skipped; only the files of other
+bundles that are missing, or lack checksum tags, are then examined and staged by the jobs as usual.
+Bundles are verified in batches as they are found.  Concurrency is capped below the open file limit.
+With --full, files are checked in S3 even if the --catalog has them as staged.
+
+Once a bundle has been completely staged, a fingerprint of its local files (names, sizes and mtimes of its
+JSON files, and the entries of its manifest) is saved in its submission.json.  Later runs skip bundles whose
+fingerprint still matches, at the cost of reading submission.json alone.  Changes at origin servers are not
+noticed this way: use --full to examine every file of every bundle regardless.
+
+Staged bundles are also recorded in a staged_bundles.json next to them, in each bundles folder of the
+target bucket, as they are staged, which storer.py reads instead of every submission.json that is unchanged
+since.  --no-index leaves it alone.
 
 When running parallelized, terse output will be produced.
 
 Terse output key:
 
+    V - a bundle was verified to be completely staged already (--verify-first)
     B - a new bundle is being examined
+    = - a bundle is unchanged since it was last staged, so was skipped
     ✔ - a data file has been checked and is already in place
     ! - a data file could not be found
     C - a data file was copied from another S3 bucket to the target location
     ↻︎ - a data file was copied over itself in S3 (to correct ETAG)
     ↓ - a data file was downloaded from the internet
+    ⇣ - a data file was streamed from the internet straight to the target bucket
     ⬆ - a data file was upload to the target bucket
     + - missing checksums where added to an already uploaded file
     ✓ - a metadata file has been checked and is already in place
@@ -40,12 +98,20 @@ Terse output key:
          this bundle was new:         B↓⬆↑↑↑↑
 
 When running parallelized you can still generate verbose output with the --log option.
+
+CRC32C checksums are computed with the fastest implementation available on the host (the crc32c
+package, crcmod's C extension, numpy, or pure Python, in roughly that order).  Use --checksum-selftest
+to see how fast each checksum algorithm runs here.
 """
 
-import argparse, signal, ssl, sys
+import argparse, os, signal, ssl, sys
 from concurrent.futures import ProcessPoolExecutor
-from bundle_tools import LocalBundle, BundleStager
-from bundle_tools import logger
+from bundle_tools import LocalBundle, BundleStager, FileLevelScheduler, BundleVerifier, BoundedDispatcher
+from bundle_tools import StagedBundleIndex
+from bundle_tools.file_scheduling import stage_bundle
+from bundle_tools import logger, clients, origin_scheduler, staged_catalog, checksum_cache, checksum_selftest
+from bundle_tools import transfer_tuner, bandwidth_limiter, resource_governor, bundle_discovery
+from bundle_tools import file_size_resolver, ftp_sessions
 
 # Executor complains if it is an object attribute, so we make it global.
 executor = None
@@ -57,19 +123,51 @@ class Main:
 
     def __init__(self):
         self._parse_args()
+        if self.args.adjust_bandwidth:
+            limits = bandwidth_limiter.set_limits(self.args.max_ingress, self.args.max_egress)
+            print(f"Bandwidth limits are now: {limits}" if limits else "No run in progress has bandwidth limits")
+            return
+        if self.args.checksum_selftest:
+            self.checksum_selftest()
+            return
         self._setup_ssl_context(self.args.skip_ssl_cert_verification)
-        if self.args.bundle:
-            self.stage_bundle(LocalBundle(self.args.bundle))
-        else:
-            logger.output(f"\nStaging bundles under \"{self.args.bundles}\":\n")
-            bundles = list(LocalBundle.bundles_under(self.args.bundles))
-            bundles.sort()
-            self.stage_bundles(bundles)
+        self.staged_index = None if self.args.no_index else StagedBundleIndex(self.args.target_bucket)
+        try:
+            if self.args.bundle:
+                self.stage_bundle(LocalBundle(self.args.bundle))
+            else:
+                logger.output(f"\nStaging bundles under \"{self.args.bundles}\":\n")
+                bundles = LocalBundle.bundles_under(self.args.bundles)
+                if self.args.verify_first:
+                    bundles = self.verify_bundles(bundles)
+                self.stage_bundles(bundles)
+        finally:
+            if self.staged_index:
+                self.staged_index.save()
+            bandwidth_limiter.release()
+            origin_scheduler.release()
         print("")
 
+    @staticmethod
+    def checksum_selftest():
+        print("\nChecksum speeds on this host:\n")
+        for name, rate, note in checksum_selftest():
+            print(f"    {name:20} {rate:10.1f} MB/s  {note}")
+
+    def verify_bundles(self, bundles):
+        """ Yields the bundles that still need staging, as they are verified """
+        verifier = BundleVerifier(self.args.target_bucket, concurrency=self.args.verify_concurrency,
+                                  endpoint_url=self.args.verify_endpoint, full=self.args.full,
+                                  on_verified=self.record_in_index)
+        yield from verifier.verify(bundles)
+        logger.output(f"\n{verifier.bundles_verified} of {verifier.bundles_seen} bundles were already staged\n")
+
     def stage_bundles(self, bundles):
-        self.total_bundles = len(bundles)
-        if self.args.jobs > 1:
+        """ bundles may be a generator, in which case staging starts before every bundle has been found """
+        self.total_bundles = len(bundles) if isinstance(bundles, list) else None
+        if self.args.jobs > 1 and self.args.schedule == 'files':
+            self.stage_files_of_bundles_in_parallel(bundles)
+        elif self.args.jobs > 1:
             self.stage_bundles_in_parallel(bundles)
         else:
             self.stage_bundles_serially(bundles)
@@ -82,19 +180,37 @@ class Main:
             self.stage_bundle(bundle, bundle_number)
 
     def stage_bundles_in_parallel(self, bundles):
+        """ Bundles are staged as they are found, with a bounded number of tasks queued at once """
         global executor
         signal.signal(signal.SIGINT, self.signal_handler)
         executor = ProcessPoolExecutor(max_workers=self.args.jobs)
-        bundle_number = 0
-        for bundle in bundles:
-            bundle_number += 1
-            executor.submit(self.stage_bundle, bundle, bundle_number)
+        dispatcher = BoundedDispatcher(executor, stage_bundle, (self.args.target_bucket, self.stager_options),
+                                       max_in_flight=2 * self.args.jobs, name_of=lambda bundle: bundle.path,
+                                       on_result=lambda bundle, result: self.record_in_index(bundle.path, *result))
+        summary = dispatcher.run(bundles)
+        executor.shutdown()
+        print(summary.report())
+
+    def stage_files_of_bundles_in_parallel(self, bundles):
+        global executor
+        signal.signal(signal.SIGINT, self.signal_handler)
+        executor = ProcessPoolExecutor(max_workers=self.args.jobs)
+        FileLevelScheduler(executor, self.args.target_bucket, self.stager_options,
+                           staged_index=self.staged_index, max_in_flight=2 * self.args.jobs).stage(bundles)
         executor.shutdown()
 
     def stage_bundle(self, bundle, bundle_number=None):
-        comment = f"({bundle_number}/{self.total_bundles})" if bundle_number else ""
+        if bundle_number and self.total_bundles:
+            comment = f"({bundle_number}/{self.total_bundles})"
+        else:
+            comment = f"({bundle_number})" if bundle_number else ""
         signal.signal(signal.SIGINT, signal.SIG_DFL)
-        BundleStager(bundle, self.args.target_bucket).stage(comment)
+        if BundleStager(bundle, self.args.target_bucket, **self.stager_options).stage(comment):
+            self.record_in_index(bundle.path, bundle.submission_info.info, bundle.submission_info.etag)
+
+    def record_in_index(self, bundle_path, info, submission_etag):
+        if self.staged_index:
+            self.staged_index.record(bundle_path, info, submission_etag)
 
     def _parse_args(self):
         parser = argparse.ArgumentParser(description=__doc__,
@@ -107,6 +223,8 @@ class Main:
                             help="stage single bundle at this path")
         parser.add_argument('--bundles', default='import', metavar="path",
                             help="stage bundles under this path (must not include 'bundles')")
+        parser.add_argument('--bundle-index', default=None, metavar="path/to/index.json",
+                            help="remember the folders of the import tree here, to find bundles faster next time")
         parser.add_argument('-q', '--quiet', action='store_true', default=False,
                             help="silence is golden")
         parser.add_argument('-t', '--terse', action='store_true', default=False,
@@ -115,10 +233,68 @@ class Main:
                             help="log verbose output to this file")
         parser.add_argument('-j', '--jobs', type=int, default=1,
                             help="parallelize with this many jobs")
+        parser.add_argument('--schedule', choices=('bundles', 'files'), default='bundles',
+                            help="give jobs whole bundles, or single files (largest first) to stage")
+        parser.add_argument('--file-jobs', type=int, default=1, metavar="N",
+                            help="stage up to N files of each bundle concurrently (implies --terse)")
+        parser.add_argument('--stream', default=False, action='store_true',
+                            help="stream data files from their origin straight into S3, without a local copy")
+        parser.add_argument('--connections-per-file', type=int, default=1, metavar="N",
+                            help="download large data files over up to N connections, if the origin allows it")
+        parser.add_argument('--max-downloads-per-host', type=int, default=None, metavar="N",
+                            help="allow at most N concurrent connections to each origin host, across all jobs")
+        parser.add_argument('--origin-requests-per-second', type=float, default=None, metavar="R",
+                            help="make at most R requests per second to each origin host, across all jobs")
+        parser.add_argument('--no-index', default=False, action='store_true',
+                            help="don't record staged bundles in the staged bundle index of each bundles folder")
+        parser.add_argument('--full', default=False, action='store_true',
+                            help="examine every file, even of bundles unchanged since they were last staged")
+        parser.add_argument('--verify-first', default=False, action='store_true',
+                            help="check which bundles are already staged, from one process, before staging")
+        parser.add_argument('--verify-concurrency', type=int, default=BundleVerifier.DEFAULT_CONCURRENCY,
+                            metavar="N", help="S3 requests to have in flight at once when verifying")
+        parser.add_argument('--verify-endpoint', default=None, metavar="URL",
+                            help="S3 endpoint to verify against (default: that of boto3)")
+        parser.add_argument('--catalog', default=None, metavar="path/to/catalog.sqlite",
+                            help="record staged files in this local database, and trust it on later runs")
+        parser.add_argument('--catalog-ttl', type=float, default=staged_catalog.DEFAULT_TTL_HOURS, metavar="HOURS",
+                            help="trust catalog entries for this long (default %(default)s hours)")
+        parser.add_argument('--size-cache', default=None, metavar="path/to/sizes.sqlite",
+                            help="remember the sizes of origin files in this database, shared by all jobs and runs")
+        parser.add_argument('--size-cache-ttl', type=float, default=file_size_resolver.DEFAULT_TTL_HOURS,
+                            metavar="HOURS", help="trust remembered origin file sizes for this long")
+        parser.add_argument('--ftp-sessions-per-host', type=int, default=ftp_sessions.DEFAULT_MAX_SESSIONS_PER_HOST,
+                            metavar="N", help="keep up to N logged-in FTP connections open to each host, per job")
+        parser.add_argument('--checksum-cache', default=None, metavar="path/to/checksums.sqlite",
+                            help="cache checksums of local metadata files in this database")
+        parser.add_argument('--checksum-cache-size', type=int, default=checksum_cache.DEFAULT_MAX_ENTRIES,
+                            metavar="N", help="keep at most N entries in the checksum cache")
+        parser.add_argument('--adaptive-transfers', default=False, action='store_true',
+                            help="tune S3 transfer concurrency and I/O chunk size to the rates achieved")
+        parser.add_argument('--max-pool-connections', type=int, default=clients.DEFAULT_MAX_POOL_CONNECTIONS,
+                            metavar="N", help="keep up to N connections open to S3 and to each origin host, per job")
+        parser.add_argument('--disk-budget', type=float, default=None, metavar="GB",
+                            help="let downloaded data files take up at most this much disk at once, across all jobs")
+        parser.add_argument('--memory-budget', type=float, default=None, metavar="GB",
+                            help="let streamed data files take up at most this much memory at once, across all jobs")
+        parser.add_argument('--max-ingress', type=float, default=None, metavar="MB/s",
+                            help="download from origin servers at no more than this rate, across all jobs")
+        parser.add_argument('--max-egress', type=float, default=None, metavar="MB/s",
+                            help="upload to S3 at no more than this rate, across all jobs")
+        parser.add_argument('--adjust-bandwidth', default=False, action='store_true',
+                            help="just change the bandwidth limits of the stagers running on this machine")
+        parser.add_argument('--checksum-selftest', default=False, action='store_true',
+                            help="report the speed of each checksum algorithm on this host, then exit")
         parser.add_argument('--skip-ssl-cert-verification', default=False, action='store_true',
                             help="don't attempt to verify SSL certificates")
         self.args = parser.parse_args()
-        if self.args.jobs > 1:
+        self.stager_options = {
+            'file_jobs': self.args.file_jobs,
+            'stream': self.args.stream,
+            'connections_per_file': self.args.connections_per_file,
+            'full': self.args.full,
+        }
+        if self.args.jobs > 1 or self.args.file_jobs > 1:
             quiet = True
             terse = True
         else:
@@ -126,6 +302,23 @@ class Main:
             terse = self.args.terse
 
         logger.configure(self.args.log, quiet=quiet, terse=terse)
+        clients.configure(max_pool_connections=self.args.max_pool_connections)
+        transfer_tuner.configure(enabled=self.args.adaptive_transfers, max_concurrency=self.args.max_pool_connections)
+        if not self.args.adjust_bandwidth and (self.args.max_ingress is not None or self.args.max_egress is not None):
+            bandwidth_limiter.set_limits(self.args.max_ingress, self.args.max_egress, owner=os.getpid())
+        resource_governor.configure(disk_budget=self._gigabytes(self.args.disk_budget),
+                                    memory_budget=self._gigabytes(self.args.memory_budget))
+        origin_scheduler.configure(max_connections=self.args.max_downloads_per_host,
+                                   requests_per_second=self.args.origin_requests_per_second)
+        bundle_discovery.configure(index_path=self.args.bundle_index)
+        staged_catalog.configure(self.args.catalog, ttl_hours=self.args.catalog_ttl)
+        file_size_resolver.configure(self.args.size_cache, ttl_hours=self.args.size_cache_ttl)
+        ftp_sessions.configure(max_sessions_per_host=self.args.ftp_sessions_per_host)
+        checksum_cache.configure(self.args.checksum_cache, max_entries=self.args.checksum_cache_size)
+
+    @staticmethod
+    def _gigabytes(amount: float):
+        return int(amount * 1024 ** 3) if amount else None
 
     @staticmethod
     def signal_handler(signal, frame):
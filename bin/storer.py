@@ -10,6 +10,11 @@ bundle or bundle hierarchy (hierarchies must have at least one folder named
 bin/storer.py --bundles s3://org-humancellatlas-data-bundle-examples/import/10x
 
 bin/storer.py --bundle s3://org-humancellatlas-data-bundle-examples/import/geo/GSE75478/bundles/bundle145
+
+Bundles are looked up in the staged_bundles.json index that stager.py keeps in each bundles folder, so
+--smaller is applied, and bundles are loaded, without fetching each bundle's submission.json.  Entries are
+used only while submission.json is unchanged since, as found by listing each bundles folder once.
+UUIDs assigned while storing are recorded in the index too.  --no-index ignores it.
 """
 
 import argparse, signal, sys
@@ -17,7 +22,9 @@ from concurrent.futures import ProcessPoolExecutor
 
 from urllib3.util import parse_url, Url
 
-from bundle_tools import logger, StagedBundle, StagedBundleFinder, BundleStorer, DataStoreAPI
+from bundle_tools import logger, clients, StagedBundleFinder, DataStoreAPI, BoundedDispatcher
+from bundle_tools import StagedBundleIndex
+from bundle_tools.storage import store_bundle
 
 # Executor complains if it is an object attribute, so we make it global.
 executor = None
@@ -35,6 +42,8 @@ class Main:
                             help="S3 URL of a single staged bundle")
         parser.add_argument('--smaller', type=int, default=1024*1024,  # 1 TB
                             help="only store bundles with data files smaller than this many MB")
+        parser.add_argument('--no-index', default=False, action='store_true',
+                            help="don't use or update the staged bundle index of each bundles folder")
         parser.add_argument('--dss-endpoint', default=DataStoreAPI.DEFAULT_DSS_URL,
                             help="URL of DSS API endpoint")
         parser.add_argument('-r', '--use-rest-api', action='store_true', default=False,
@@ -49,45 +58,73 @@ class Main:
                             help="when a 202 (ACCEPTED) response is received, print task ID")
         parser.add_argument('-l', '--log', default=None,
                             help="log verbose output to this file")
+        parser.add_argument('--max-pool-connections', type=int, default=clients.DEFAULT_MAX_POOL_CONNECTIONS,
+                            metavar="N", help="keep up to N connections open to S3, per job")
         self.args = parser.parse_args()
         if self.args.jobs > 1:
             self.args.quiet = True
             self.args.terse = True
         logger.configure(self.args.log, quiet=self.args.quiet, terse=self.args.terse)
+        clients.configure(max_pool_connections=self.args.max_pool_connections)
         self.storer_options = {'use_rest_api': self.args.use_rest_api, 'report_task_ids': self.args.report_task_ids}
 
-        if self.args.bundle:
-            self._store_bundle(parse_url(self.args.bundle))
-            print("\n")
-        else:
-            self._store_bundles(parse_url(self.args.bundles))
+        bundles_url = parse_url(self.args.bundle or self.args.bundles)
+        self.staged_index = None if self.args.no_index else StagedBundleIndex(bundles_url.host)
+        try:
+            if self.args.bundle:
+                self._store_bundle(self._with_info(bundles_url))
+                print("\n")
+            else:
+                self._store_bundles(bundles_url)
+        finally:
+            if self.staged_index:
+                self.staged_index.save()
 
     def _store_bundles(self, bundles_url: Url):
-        bundle_paths = StagedBundleFinder().paths_of_bundles_under(bundles_url)
+        bundle_paths = StagedBundleFinder().iter_paths_of_bundles_under(bundles_url)
+        bundle_urls = (Url(scheme=bundles_url.scheme, host=bundles_url.host, path=path.lstrip('/'))
+                       for path in bundle_paths)
+        bundles = (self._with_info(bundle_url) for bundle_url in bundle_urls)
+        bundles = (bundle for bundle in bundles if self._is_small_enough(bundle))
         if self.args.jobs > 1:
-            self.store_bundles_in_parallel(bundles_url, bundle_paths)
+            self.store_bundles_in_parallel(bundles)
         else:
-            for path in bundle_paths:
-                self._store_bundle(Url(scheme=bundles_url.scheme, host=bundles_url.host, path=path.lstrip('/')))
+            for bundle in bundles:
+                self._store_bundle(bundle)
 
-    def store_bundles_in_parallel(self, bundles_url: Url, bundle_paths: list):
+    def store_bundles_in_parallel(self, bundles):
+        """ Bundles are stored as they are found, with a bounded number of tasks queued at once """
         global executor
         signal.signal(signal.SIGINT, self.signal_handler)
         executor = ProcessPoolExecutor(max_workers=self.args.jobs)
-        bundle_number = 0
-        for path in bundle_paths:
-            bundle_number += 1
-            executor.submit(self._store_bundle,
-                            Url(scheme=bundles_url.scheme, host=bundles_url.host, path=path.lstrip('/')))
+        dispatcher = BoundedDispatcher(executor, store_bundle,
+                                       (self.args.dss_endpoint, self.storer_options, self.args.smaller),
+                                       max_in_flight=2 * self.args.jobs, name_of=lambda bundle: bundle[0].path,
+                                       on_result=self._record_in_index)
+        summary = dispatcher.run(bundles)
         executor.shutdown()
-
-    def _store_bundle(self, bundle_url):
-        signal.signal(signal.SIGINT, signal.SIG_DFL)
-        bundle = StagedBundle(bundle_url)
-        if bundle.all_files_are_smaller_than(self.args.smaller):
-            BundleStorer(bundle, self.args.dss_endpoint, **self.storer_options).store_bundle()
-        else:
-            logger.output(f"\nSkipping {bundle.path} - exceeds sized requirement", progress_char='-', flush=True)
+        print(summary.report())
+
+    def _store_bundle(self, bundle: tuple):
+        result = store_bundle(bundle, self.args.dss_endpoint, self.storer_options, self.args.smaller)
+        self._record_in_index(bundle, result)
+
+    def _with_info(self, bundle_url: Url) -> tuple:
+        """ (bundle_url, the bundle's submission info and submission.json ETag from the index, or None, None) """
+        info, etag = self.staged_index.entry(bundle_url.path) if self.staged_index else (None, None)
+        return bundle_url, info, etag
+
+    def _is_small_enough(self, bundle: tuple) -> bool:
+        bundle_url, info, etag = bundle
+        if info is None or StagedBundleIndex.all_files_are_smaller_than(info, self.args.smaller):
+            return True
+        logger.output(f"\nSkipping {bundle_url.path} - exceeds sized requirement", progress_char='-', flush=True)
+        return False
+
+    def _record_in_index(self, bundle: tuple, result):
+        if self.staged_index and isinstance(result, tuple):
+            info, etag = result
+            self.staged_index.record(bundle[0].path, info, etag)
 
     @staticmethod
     def signal_handler(signal, frame):
@@ -0,0 +1,57 @@
+import os, subprocess, sys, tempfile, unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'bin'))
+
+from bundle_tools.bandwidth import BandwidthLimiter  # noqa: E402
+
+
+def dead_pid() -> int:
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+class TestBandwidthLimits(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.limiter = self.limiter_process()
+
+    def limiter_process(self) -> BandwidthLimiter:
+        """ Another process's view of the same state """
+        limiter = BandwidthLimiter()
+        limiter.configure(state_dir=self.tmpdir.name)
+        return limiter
+
+    def test_limits_given_are_merged_with_those_in_force(self):
+        self.limiter.set_limits(10, 20, owner=os.getpid())
+        self.assertEqual({'ingress': 5, 'egress': 20}, self.limiter.set_limits(ingress_mb_per_second=5))
+        self.assertEqual({'ingress': 5}, self.limiter.set_limits(egress_mb_per_second=0))
+        self.assertEqual({'ingress': 5}, self.limiter_process().limits())
+
+    def test_limits_are_dropped_when_their_run_releases_them(self):
+        self.limiter.set_limits(10, 20, owner=os.getpid())
+        self.limiter.release()
+        self.assertEqual({}, self.limiter_process().limits())
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir.name, BandwidthLimiter.LIMITS_FILENAME)))
+
+    def test_limits_of_a_run_that_died_are_ignored(self):
+        self.limiter.set_limits(10, 20, owner=dead_pid())
+        self.assertEqual({}, self.limiter_process().limits())
+
+    def test_limits_cannot_be_adjusted_without_a_run_in_progress(self):
+        self.assertEqual({}, self.limiter.set_limits(10, 20))
+        self.assertEqual({}, self.limiter_process().limits())
+
+    def test_tokens_are_granted_in_batches(self):
+        self.limiter.set_limits(ingress_mb_per_second=1000, owner=os.getpid())
+        with mock.patch('bundle_tools.bandwidth.fcntl.flock') as flock:
+            for _ in range(100):
+                self.limiter.ingress(1024)
+        self.assertEqual(1, flock.call_count)
+
+
+if __name__ == '__main__':
+    unittest.main()
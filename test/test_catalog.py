@@ -0,0 +1,81 @@
+import os, sys, tempfile, time, unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'bin'))
+
+from bundle_tools.catalog import StagedStateCatalog  # noqa: E402
+from bundle_tools.s3 import S3ObjectTagger  # noqa: E402
+
+URL = 's3://target-bucket/import/geo/GSE1/bundle0/sample.json'
+TAGS = dict({tag: 'x' for tag in S3ObjectTagger.ALL_TAGS}, **{'hca-dss-s3_etag': 'etag'})
+
+
+class TestStagedStateCatalog(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.catalog = self.catalog_process()
+
+    def catalog_process(self, ttl_hours: float=1) -> StagedStateCatalog:
+        """ Another process's view of the same database """
+        catalog = StagedStateCatalog()
+        catalog.configure(os.path.join(self.tmpdir.name, 'catalog.sqlite'), ttl_hours=ttl_hours)
+        return catalog
+
+    def age_entries(self, seconds: float):
+        with self.catalog._db() as db:
+            db.execute("UPDATE staged_objects SET checked_at = checked_at - ?", (seconds,))
+
+    def test_recorded_object_is_staged(self):
+        self.catalog.record(URL, 100, 'etag', TAGS, local_mtime=1.0)
+        self.assertTrue(self.catalog_process().is_staged(URL, 100, local_mtime=1.0))
+
+    def test_unrecorded_object_is_not_staged(self):
+        self.assertFalse(self.catalog.is_staged(URL, 100))
+
+    def test_entry_is_not_used_once_the_file_has_changed(self):
+        self.catalog.record(URL, 100, 'etag', TAGS, local_mtime=1.0)
+        self.assertFalse(self.catalog.is_staged(URL, 101, local_mtime=1.0))
+        self.assertFalse(self.catalog.is_staged(URL, 100, local_mtime=2.0))
+
+    def test_forgotten_object_is_not_staged(self):
+        self.catalog.record(URL, 100, 'etag', TAGS)
+        self.catalog.forget(URL)
+        self.assertFalse(self.catalog.is_staged(URL, 100))
+
+    def test_expired_entry_is_not_used(self):
+        self.catalog.record(URL, 100, 'etag', TAGS)
+        self.age_entries(3600)
+        self.assertFalse(self.catalog.is_staged(URL, 100))
+
+    def test_disabled_catalog_records_nothing(self):
+        catalog = StagedStateCatalog()
+        catalog.record(URL, 100, 'etag', TAGS)
+        self.assertFalse(catalog.is_staged(URL, 100))
+
+    def test_entry_half_way_through_its_life_is_used_and_revalidated(self):
+        self.catalog.record(URL, 100, 'etag', TAGS)
+        self.age_entries(2400)
+        s3_agent = mock.Mock()
+        s3_agent.get_object.return_value = mock.Mock(content_length=100, e_tag='"etag"')
+        s3_agent.get_tagging.return_value = TAGS
+        with mock.patch('bundle_tools.catalog.clients.s3_agent', return_value=s3_agent):
+            self.assertTrue(self.catalog.is_staged(URL, 100))
+            self.catalog._background().shutdown(wait=True)
+        checked_at, = self.catalog._db().execute("SELECT checked_at FROM staged_objects").fetchone()
+        self.assertAlmostEqual(time.time(), checked_at, delta=60)
+
+    def test_entry_found_to_be_wrong_on_revalidation_is_dropped(self):
+        self.catalog.record(URL, 100, 'etag', TAGS)
+        self.age_entries(2400)
+        s3_agent = mock.Mock()
+        s3_agent.get_object.return_value = mock.Mock(content_length=100, e_tag='"another-etag"')
+        with mock.patch('bundle_tools.catalog.clients.s3_agent', return_value=s3_agent):
+            self.catalog.is_staged(URL, 100)
+            self.catalog._background().shutdown(wait=True)
+        self.assertFalse(self.catalog.is_staged(URL, 100))
+
+
+if __name__ == '__main__':
+    unittest.main()
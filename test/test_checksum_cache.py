@@ -0,0 +1,67 @@
+import os, shutil, sys, tempfile, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'bin'))
+
+from bundle_tools.checksum_cache import ChecksumCache  # noqa: E402
+
+
+class TestChecksumCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.cache = ChecksumCache()
+        self.cache.configure(os.path.join(self.tmpdir.name, 'checksums.sqlite'))
+        self.computed = []
+
+    def compute(self, path: str) -> dict:
+        self.computed.append(path)
+        with open(path, 'rb') as fh:
+            return {'content': fh.read().decode('utf8')}
+
+    def write(self, name: str, content: str) -> str:
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, 'w') as fh:
+            fh.write(content)
+        return path
+
+    def test_checksums_are_computed_once(self):
+        path = self.write('project.json', '{"a": 1}')
+        self.assertEqual({'content': '{"a": 1}'}, self.cache.checksums(path, self.compute))
+        self.assertEqual({'content': '{"a": 1}'}, self.cache.checksums(path, self.compute))
+        self.assertEqual([path], self.computed)
+
+    def test_file_that_changes_is_checksummed_again(self):
+        path = self.write('project.json', '{"a": 1}')
+        self.cache.checksums(path, self.compute)
+        self.write('project.json', '{"a": 2}')
+        os.utime(path, ns=(0, 0))  # even if its mtime were to go backwards
+        self.assertEqual({'content': '{"a": 2}'}, self.cache.checksums(path, self.compute))
+        self.assertEqual([path, path], self.computed)
+
+    def test_identical_files_are_checksummed_once(self):
+        path = self.write('project.json', '{"a": 1}')
+        self.cache.checksums(path, self.compute)
+        copy = shutil.copy(path, os.path.join(self.tmpdir.name, 'copy.json'))
+        self.assertEqual({'content': '{"a": 1}'}, self.cache.checksums(copy, self.compute))
+        self.assertEqual([path], self.computed)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        self.cache.max_entries = 2
+        self.cache.EVICTION_CHECK_INTERVAL = 1
+        paths = [self.write(f"file{number}.json", str(number)) for number in range(3)]
+        for path in paths:
+            self.cache.checksums(path, self.compute)
+        self.cache.checksums(paths[0], self.compute)
+        self.assertEqual(paths + [paths[0]], self.computed)
+
+    def test_disabled_cache_always_computes(self):
+        path = self.write('project.json', '{"a": 1}')
+        cache = ChecksumCache()
+        cache.checksums(path, self.compute)
+        cache.checksums(path, self.compute)
+        self.assertEqual([path, path], self.computed)
+
+
+if __name__ == '__main__':
+    unittest.main()
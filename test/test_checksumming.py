@@ -0,0 +1,118 @@
+import hashlib, io, os, sys, threading, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'bin'))
+
+from bundle_tools.checksumming import S3EtagHasher, PipelinedChecksummingReader, S3RangedChecksummer, \
+    ReorderBuffer  # noqa: E402
+
+MB = 1024 * 1024
+
+
+class FakeS3Client:
+    """ Serves ranged GETs of one object from memory """
+
+    def __init__(self, data: bytes):
+        self.data = data
+
+    def get_object(self, Bucket, Key, Range, IfMatch):
+        start, end = (int(offset) for offset in Range[len('bytes='):].split('-'))
+        return {'Body': io.BytesIO(self.data[start:end + 1])}
+
+
+def multipart_etag(data: bytes, part_size: int) -> str:
+    part_digests = [hashlib.md5(data[start:start + part_size]).digest() for start in range(0, len(data), part_size)]
+    return f"{hashlib.md5(b''.join(part_digests)).hexdigest()}-{len(part_digests)}"
+
+
+class TestS3RangedChecksummer(unittest.TestCase):
+
+    PART_SIZE = 1 * MB
+
+    def checksums(self, data: bytes) -> dict:
+        checksummer = S3RangedChecksummer(FakeS3Client(data), part_size=self.PART_SIZE, concurrency=4)
+        return checksummer.checksums('bucket', 'key', len(data), '"etag"')
+
+    def test_object_smaller_than_one_part_has_a_plain_md5_etag(self):
+        data = os.urandom(self.PART_SIZE - 1)
+        self.assertEqual(hashlib.md5(data).hexdigest(), self.checksums(data)['s3_etag'])
+
+    def test_object_of_exactly_one_part_has_a_multipart_etag(self):
+        data = os.urandom(self.PART_SIZE)
+        self.assertEqual(multipart_etag(data, self.PART_SIZE), self.checksums(data)['s3_etag'])
+        self.assertTrue(self.checksums(data)['s3_etag'].endswith('-1'))
+
+    def test_object_of_several_parts(self):
+        data = os.urandom(2 * self.PART_SIZE + 1)
+        checksums = self.checksums(data)
+        self.assertEqual(multipart_etag(data, self.PART_SIZE), checksums['s3_etag'])
+        self.assertEqual(hashlib.sha256(data).hexdigest(), checksums['sha256'])
+
+    def test_empty_object(self):
+        self.assertEqual(hashlib.md5().hexdigest(), self.checksums(b'')['s3_etag'])
+
+
+class TestS3EtagHasher(unittest.TestCase):
+
+    PART_SIZE = 1 * MB
+
+    def etag(self, data: bytes, chunk_size: int=100 * 1024) -> str:
+        hasher = S3EtagHasher(part_size=self.PART_SIZE)
+        for start in range(0, len(data), chunk_size):
+            hasher.update(data[start:start + chunk_size])
+        return hasher.hexdigest()
+
+    def test_just_under_one_part(self):
+        data = os.urandom(self.PART_SIZE - 1)
+        self.assertEqual(hashlib.md5(data).hexdigest(), self.etag(data))
+
+    def test_exactly_one_part(self):
+        data = os.urandom(self.PART_SIZE)
+        self.assertEqual(multipart_etag(data, self.PART_SIZE), self.etag(data))
+
+    def test_chunks_spanning_parts(self):
+        data = os.urandom(3 * self.PART_SIZE + 5)
+        self.assertEqual(multipart_etag(data, self.PART_SIZE), self.etag(data, chunk_size=3 * MB // 2))
+
+
+class TestPipelinedChecksummingReader(unittest.TestCase):
+
+    def test_checksums_what_is_read(self):
+        data = os.urandom(3 * MB)
+        with PipelinedChecksummingReader(io.BytesIO(data), part_size=MB) as reader:
+            while reader.read(256 * 1024):
+                pass
+            checksums = reader.get_checksums()
+        self.assertEqual(hashlib.sha1(data).hexdigest(), checksums['sha1'])
+        self.assertEqual(multipart_etag(data, MB), checksums['s3_etag'])
+
+
+class TestReorderBuffer(unittest.TestCase):
+
+    def test_blocks_put_out_of_order_are_got_in_order(self):
+        buffer = ReorderBuffer(max_bytes=100)
+        for offset in (20, 10, 0):
+            buffer.put(offset, bytes([offset]) * 10)
+        self.assertEqual([0, 10, 20], [buffer.get()[0] for _ in range(3)])
+
+    def test_block_next_in_line_is_accepted_when_buffer_is_full(self):
+        buffer = ReorderBuffer(max_bytes=10)
+        buffer.put(10, b'b' * 10)
+        buffer.put(0, b'a' * 10)  # would wait forever, were the buffer's limit applied to it
+        self.assertEqual(b'a' * 10 + b'b' * 10, buffer.get() + buffer.get())
+
+    def test_blocks_out_of_line_wait_for_room(self):
+        buffer = ReorderBuffer(max_bytes=10)
+        buffer.put(10, b'b' * 10)
+        late_put = threading.Thread(target=buffer.put, args=(20, b'c' * 10))
+        late_put.start()
+        late_put.join(timeout=0.2)
+        self.assertTrue(late_put.is_alive())
+        buffer.put(0, b'a' * 10)
+        got = [buffer.get(), buffer.get()]
+        late_put.join(timeout=5)
+        self.assertFalse(late_put.is_alive())
+        self.assertEqual([b'a' * 10, b'b' * 10, b'c' * 10], got + [buffer.get()])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import os, sys, unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'bin'))
+
+from bundle_tools.crc32c import BACKENDS, CHECK_INPUT, CHECK_VALUE, Crc32c, Crc32cBackend, Crc32cRegistry, \
+    PythonBackend, crc32c_combine  # noqa: E402
+
+
+class BrokenBackend(Crc32cBackend):
+
+    name = 'broken'
+
+    def extend(self, crc: int, data) -> int:
+        return 0
+
+
+class TestCrc32cBackends(unittest.TestCase):
+
+    def test_available_backends_agree(self):
+        backends = Crc32cRegistry().available_backends()
+        python = PythonBackend()
+        for length in (0, 1, 1023, 1024, 1024 * 1024 + 7):
+            data = os.urandom(length)
+            expected = python.extend(0, data)
+            for backend in backends:
+                with self.subTest(backend=backend.name, length=length):
+                    self.assertEqual(expected, backend.extend(0, data))
+
+    def test_crc_is_extended_with_more_data(self):
+        data = os.urandom(5000)
+        for backend in Crc32cRegistry().available_backends():
+            with self.subTest(backend=backend.name):
+                self.assertEqual(backend.extend(0, data), backend.extend(backend.extend(0, data[:1234]), data[1234:]))
+
+    def test_crcs_of_parts_are_combined(self):
+        data = os.urandom(5000)
+        python = PythonBackend()
+        self.assertEqual(python.extend(0, data),
+                         crc32c_combine(python.extend(0, data[:1234]), python.extend(0, data[1234:]), 5000 - 1234))
+
+    def test_hexdigest_is_formatted_as_tagged(self):
+        self.assertEqual('%08X' % CHECK_VALUE, Crc32c(CHECK_INPUT, backend=PythonBackend()).hexdigest())
+
+
+class TestCrc32cRegistry(unittest.TestCase):
+
+    def test_backend_giving_wrong_answers_is_not_available(self):
+        with mock.patch('bundle_tools.crc32c.BACKENDS', [BrokenBackend] + BACKENDS):
+            self.assertNotIn('broken', [backend.name for backend in Crc32cRegistry().available_backends()])
+
+    def test_fastest_backend_is_chosen(self):
+        registry = Crc32cRegistry()
+        fastest = registry.available_backends()[-2].name  # the last but the python backend
+        timings = staticmethod(lambda backend, data: 0 if backend.name == fastest else 1)
+        with mock.patch.object(Crc32cRegistry, '_time', timings):
+            self.assertEqual(fastest, registry.backend().name)
+
+    def test_python_backend_is_used_only_if_nothing_else_works(self):
+        with mock.patch('bundle_tools.crc32c.BACKENDS', [BrokenBackend, PythonBackend]):
+            self.assertEqual('python', Crc32cRegistry().backend().name)
+
+    def test_backend_can_be_chosen_by_name(self):
+        registry = Crc32cRegistry()
+        registry.use('python')
+        self.assertEqual('python', registry.backend().name)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import glob, os, sys, tempfile, unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'bin'))
+
+from bundle_tools.discovery import BundleDiscovery  # noqa: E402
+
+BUNDLE_PATHS = ['import/geo/GSE1-extra/bundles/bundle0', 'import/geo/GSE1/bundles/bundle0',
+                'import/geo/GSE1/bundles/bundle1', 'import/geo/GSE1/bundles/bundle10',
+                'import/geo/GSE1/bundles/bundle2', 'import/geo/GSE10/bundles/bundle0',
+                'import/sra/SRP1/nested/bundles/bundle0', 'import/sra/SRP2/bundles/bundle0']
+
+
+class TestBundleDiscovery(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir.name)
+        self.addCleanup(os.chdir, self.cwd)
+        for path in BUNDLE_PATHS:
+            os.makedirs(path)
+        os.makedirs('import/geo/GSE1/bundles/bundle0/bundles/not-a-bundle')
+        os.makedirs('import/geo/.hidden/bundles/bundle0')
+        open('import/geo/GSE1/bundles/not-a-folder', 'w').close()
+
+    def discovery(self, workers: int=BundleDiscovery.DEFAULT_WORKERS, index: bool=False) -> BundleDiscovery:
+        discovery = BundleDiscovery()
+        discovery.configure(index_path='bundle_index.json' if index else None, workers=workers)
+        return discovery
+
+    def test_bundles_are_found_in_the_order_of_a_sorted_listing(self):
+        expected = sorted(path.rstrip('/') for path in glob.glob('import/**/bundles/*/', recursive=True)
+                          if '/bundles/' not in path.split('/bundles/', 1)[1])
+        self.assertEqual(BUNDLE_PATHS, expected)
+        for workers in (1, 2, 8):
+            with self.subTest(workers=workers):
+                self.assertEqual(BUNDLE_PATHS, list(self.discovery(workers).bundle_paths('import')))
+
+    def test_unchanged_folders_are_not_listed_again(self):
+        self.assertEqual(BUNDLE_PATHS, list(self.discovery(index=True).bundle_paths('import')))
+        with mock.patch('bundle_tools.discovery.os.scandir', side_effect=AssertionError("listed")):
+            self.assertEqual(BUNDLE_PATHS, list(self.discovery(index=True).bundle_paths('import')))
+
+    def test_folder_whose_mtime_changed_is_listed_again(self):
+        list(self.discovery(index=True).bundle_paths('import'))
+        os.makedirs('import/geo/GSE1/bundles/bundle3')
+        os.utime('import/geo/GSE1/bundles', (0, 0))  # whatever the file system's mtime resolution
+        bundle_paths = list(self.discovery(index=True).bundle_paths('import'))
+        self.assertEqual(BUNDLE_PATHS[:5] + ['import/geo/GSE1/bundles/bundle3'] + BUNDLE_PATHS[5:], bundle_paths)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import os, sys, unittest
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'bin'))
+
+from bundle_tools.dispatch import BoundedDispatcher  # noqa: E402
+
+
+# Run in ProcessPoolExecutor workers, so are module-level functions.
+
+def square(item: int, offset: int=0):
+    if item == 3:
+        raise ValueError("three")
+    if item == 5:
+        return False
+    return item * item + offset
+
+
+def die(item: int):
+    os._exit(1)
+
+
+class TestBoundedDispatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = ProcessPoolExecutor(max_workers=2)
+        self.addCleanup(self.executor.shutdown)
+        self.results, self.failures = {}, {}
+
+    def dispatcher(self, task, task_args: tuple=()) -> BoundedDispatcher:
+        return BoundedDispatcher(self.executor, task, task_args, max_in_flight=2,
+                                 on_result=lambda item, result: self.results.update({item: result}),
+                                 on_failure=lambda item, error: self.failures.update({item: error}))
+
+    def test_results_and_failures_are_recorded(self):
+        summary = self.dispatcher(square, (1,)).run(range(8))
+        self.assertEqual({0: 1, 1: 2, 2: 5, 4: 17, 6: 37, 7: 50}, self.results)
+        self.assertEqual({3: "ValueError: three", 5: "failed"}, self.failures)
+        self.assertEqual(8, len(summary.outcomes))
+        self.assertEqual([('3', "ValueError: three"), ('5', None)],
+                         sorted((name, error) for name, succeeded, duration, error in summary.failures()))
+        self.assertIn("6 succeeded, 2 failed", summary.report())
+
+    def test_items_are_taken_only_as_room_becomes_free(self):
+        taken = []
+
+        def items():
+            for item in range(100):
+                taken.append(item)
+                self.assertLessEqual(len(taken) - len(self.results) - len(self.failures),
+                                     BoundedDispatcher.MAX_BATCH_SIZE * 2)
+                yield item
+        self.dispatcher(square).run(items())
+        self.assertEqual(100, len(self.results) + len(self.failures))
+
+    def test_dead_worker_is_recorded_as_a_failure(self):
+        summary = self.dispatcher(die).run(range(10))
+        self.assertGreater(len(summary.failures()), 0)
+        self.assertEqual(len(summary.outcomes), len(summary.failures()))
+        self.assertTrue(all("BrokenProcessPool" in error for error in self.failures.values()))
+        self.assertEqual({}, self.results)
+
+
+if __name__ == '__main__':
+    unittest.main()
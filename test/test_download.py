@@ -0,0 +1,174 @@
+import os, sys, tempfile, threading, time, unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'bin'))
+
+from bundle_tools.download import Downloader, DownloadCheckpoint, HTTPDownloader  # noqa: E402
+from bundle_tools.governor import resource_governor  # noqa: E402
+from bundle_tools.scheduling import origin_scheduler  # noqa: E402
+
+URL = 'http://origin.example.org/data.fastq.gz'
+
+
+class FailingDownloader(Downloader):
+    """ Receives half the file, resumably, then fails every time """
+
+    MAX_ATTEMPTS = 2
+    INITIAL_BACKOFF = 0
+
+    def _attempt_download(self, src_url: str, partial_path: str, size: int):
+        with open(partial_path, 'wb') as fh:
+            fh.write(b'x' * (size // 2))
+        DownloadCheckpoint(partial_path, src_url, size, '"etag"', [[0, size - 1, size // 2]]).save()
+        raise ConnectionError("connection dropped")
+
+
+class TestFailedDownloads(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.dest_path = os.path.join(self.tmpdir.name, 'data.fastq.gz')
+        self.partial_path = f"{self.dest_path}.partial"
+
+    def download(self, disk_budget: int=None):
+        with mock.patch.object(resource_governor, 'disk_budget', disk_budget):
+            with self.assertRaises(ConnectionError):
+                FailingDownloader().download(URL, self.dest_path, 1000)
+
+    def test_resumable_download_is_kept_for_a_later_run(self):
+        self.download()
+        self.assertEqual(500, os.path.getsize(self.partial_path))
+        self.assertEqual(500, DownloadCheckpoint.load(self.partial_path).bytes_received())
+
+    def test_resumable_download_is_deleted_when_disk_is_budgeted(self):
+        self.download(disk_budget=10000)
+        self.assertEqual([], os.listdir(self.tmpdir.name))
+
+
+class Origin(BaseHTTPRequestHandler):
+    """
+    An origin web server of one file, which honours Range and If-Range.  The file's ETag changes to
+    `etag_after_head` once it has answered a HEAD request, the first `truncations` responses
+    to GETs are cut off halfway through, and ranges starting at `slow_range_starts` are sent late.
+    """
+
+    content = os.urandom(1000)
+    etag = '"v1"'
+    etag_after_head = None
+    truncations = 0
+    slow_range_starts = ()
+    requests = []  # (method, Range header)
+
+    def do_HEAD(self):
+        self.requests.append(('HEAD', None))
+        self.send_headers(200, len(self.content))
+        if self.etag_after_head:
+            type(self).etag = self.etag_after_head
+
+    def do_GET(self):
+        self.requests.append(('GET', self.headers.get('Range')))
+        byte_range = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if byte_range and if_range in (None, self.etag):
+            start, end = (int(offset) for offset in byte_range[len('bytes='):].split('-'))
+            body = self.content[start:end + 1]
+            if start in self.slow_range_starts:
+                time.sleep(0.5)
+            self.send_headers(206, len(body), content_range=f"bytes {start}-{end}/{len(self.content)}")
+        else:
+            body = self.content
+            self.send_headers(200, len(body))
+        if self.truncations:
+            type(self).truncations -= 1
+            body = body[:len(body) // 2]
+            self.close_connection = True
+        self.wfile.write(body)
+
+    def send_headers(self, status: int, content_length: int, content_range: str=None):
+        self.send_response(status)
+        self.send_header('Content-Length', str(content_length))
+        self.send_header('ETag', self.etag)
+        self.send_header('Accept-Ranges', 'bytes')
+        if content_range:
+            self.send_header('Content-Range', content_range)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestHTTPDownloader(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), Origin)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = f"http://127.0.0.1:{cls.server.server_address[1]}/data.fastq.gz"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        Origin.etag, Origin.etag_after_head, Origin.truncations, Origin.requests = '"v1"', None, 0, []
+        Origin.slow_range_starts = ()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.dest_path = os.path.join(self.tmpdir.name, 'data.fastq.gz')
+        self.partial_path = f"{self.dest_path}.partial"
+        patches = [mock.patch.object(HTTPDownloader, 'INITIAL_BACKOFF', 0),
+                   mock.patch.object(HTTPDownloader, 'BUFFER_SIZE', 100),
+                   mock.patch.object(HTTPDownloader, 'CHECKPOINT_INTERVAL', 100)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def download(self, connections: int=1):
+        HTTPDownloader(connections).download(self.url, self.dest_path, len(Origin.content))
+        with open(self.dest_path, 'rb') as fh:
+            self.assertEqual(Origin.content, fh.read())
+        self.assertFalse(os.path.exists(self.partial_path))
+        self.assertFalse(os.path.exists(DownloadCheckpoint.path_for(self.partial_path)))
+
+    def gets(self) -> list:
+        return [byte_range for method, byte_range in Origin.requests if method == 'GET']
+
+    def test_truncated_response_is_resumed_where_it_left_off(self):
+        Origin.truncations = 1
+        self.download()
+        self.assertEqual(['bytes=0-999', 'bytes=500-999'], self.gets())
+
+    def test_download_is_restarted_if_the_file_changes_after_head(self):
+        Origin.etag_after_head = '"v2"'
+        self.download()
+        self.assertEqual(['bytes=0-999', None], self.gets())  # If-Range "v1" gets all of "v2"
+
+    def test_checkpoint_of_an_earlier_version_is_not_resumed(self):
+        with open(self.partial_path, 'wb') as fh:
+            fh.write(b'x' * len(Origin.content))
+        DownloadCheckpoint(self.partial_path, self.url, len(Origin.content), '"v0"', [[0, 999, 500]]).save()
+        self.download()
+        self.assertEqual(['bytes=0-999'], self.gets())
+
+    def test_checkpoint_of_this_version_is_resumed(self):
+        with open(self.partial_path, 'wb') as fh:
+            fh.write(Origin.content[:500] + b'x' * 500)
+        DownloadCheckpoint(self.partial_path, self.url, len(Origin.content), '"v1"', [[0, 999, 500]]).save()
+        self.download()
+        self.assertEqual(['bytes=500-999'], self.gets())
+
+    def test_ranges_are_downloaded_in_place_whatever_order_they_arrive_in(self):
+        Origin.slow_range_starts = (0, 250)
+        origin_scheduler.configure(max_connections=4, state_dir=self.tmpdir.name)
+        self.addCleanup(origin_scheduler.configure)
+        self.addCleanup(origin_scheduler.release)
+        with mock.patch.object(HTTPDownloader, 'MIN_RANGE_SIZE', 100):
+            self.download(connections=4)
+        self.assertEqual({'bytes=0-249', 'bytes=250-499', 'bytes=500-749', 'bytes=750-999'}, set(self.gets()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import os, signal, sys, threading, unittest
+from concurrent.futures import Future
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'bin'))
+
+from bundle_tools.bundle import Bundle, DataFile, MetadataFile  # noqa: E402
+from bundle_tools.file_scheduling import FileLevelScheduler  # noqa: E402
+from bundle_tools.submission import SubmissionChanged  # noqa: E402
+
+
+class TestFinishingBundles(unittest.TestCase):
+
+    def test_bundle_whose_submission_json_changed_is_failed_and_not_indexed(self):
+        staged_index = mock.Mock()
+        scheduler = FileLevelScheduler(executor=None, target_bucket='bucket', stager_options={},
+                                       staged_index=staged_index)
+        bundle = Bundle('import/bundles/bundle0')
+        with mock.patch('bundle_tools.file_scheduling.BundleStager') as stager:
+            stager.return_value.finish.side_effect = SubmissionChanged("changed")
+            scheduler._finish(bundle)
+        self.assertIn(bundle.path, scheduler._failed)
+        staged_index.record.assert_not_called()
+
+
+HOME = 'import/geo/GSE1/bundles'
+
+
+class InlineExecutor:
+    """ Runs each task as it is submitted, in this process """
+
+    def submit(self, function, *args):
+        future = Future()
+        try:
+            future.set_result(function(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+class TestFileLevelScheduler(unittest.TestCase):
+
+    BUNDLE_SIZES = [[1], [5, 2], [3], [], [4, 6]]  # data file sizes of each bundle
+
+    def setUp(self):
+        previous_handler = signal.getsignal(signal.SIGINT)  # run_batch resets it
+        self.addCleanup(signal.signal, signal.SIGINT, previous_handler)
+        self.events = []
+        self.bundles_held = []  # by the scheduler, as each bundle is prepared
+        self.current_scheduler = None
+        self.finishing_threads = set()
+        self.staged_index = mock.Mock()
+        patches = [mock.patch('bundle_tools.file_scheduling.prepare_bundle', self.prepare_bundle),
+                   mock.patch('bundle_tools.file_scheduling.stage_file', self.stage_file),
+                   mock.patch('bundle_tools.file_scheduling.BundleStager')]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        from bundle_tools import file_scheduling
+        file_scheduling.BundleStager.return_value.finish.side_effect = \
+            lambda: self.finishing_threads.add(threading.current_thread())
+
+    def prepare_bundle(self, bundle, target_bucket: str, stager_options: dict):
+        self.events.append(('prepare', bundle.path))
+        self.bundles_held.append(len(self.current_scheduler._bundles))
+        bundle.submission_info = mock.Mock()
+        bundle.add_file(MetadataFile(name='sample.json', size=0))
+        for number, size in enumerate(self.BUNDLE_SIZES[int(bundle.path[-1])]):
+            bundle.add_file(DataFile(name=f"data{number}", size=size))
+        return bundle
+
+    def stage_file(self, file_task: tuple, target_bucket: str, stager_options: dict) -> tuple:
+        file_class, bundle_path, name, size, origin_url, verified = file_task
+        self.events.append(('stage', size))
+        return f"s3://{target_bucket}/{bundle_path}/{name}", {}
+
+    def scheduler(self, window_size: int) -> FileLevelScheduler:
+        self.current_scheduler = FileLevelScheduler(InlineExecutor(), 'bucket', {}, staged_index=self.staged_index,
+                                                    max_in_flight=1, window_size=window_size)
+        return self.current_scheduler
+
+    def bundles(self) -> list:
+        return [Bundle(f"{HOME}/bundle{number}") for number in range(len(self.BUNDLE_SIZES))]
+
+    def test_bundles_are_prepared_a_window_at_a_time_and_their_files_handed_out_largest_first(self):
+        scheduler = self.scheduler(window_size=2)
+        for file_task in scheduler._file_tasks(self.bundles()):
+            self.events.append(('hand out', file_task[3]))
+        self.assertEqual([('prepare', f"{HOME}/bundle0"), ('prepare', f"{HOME}/bundle1"),
+                          ('hand out', 5), ('hand out', 2), ('hand out', 1), ('hand out', 0), ('hand out', 0),
+                          ('prepare', f"{HOME}/bundle2"), ('prepare', f"{HOME}/bundle3"),
+                          ('hand out', 3), ('hand out', 0), ('hand out', 0),
+                          ('prepare', f"{HOME}/bundle4"),
+                          ('hand out', 6), ('hand out', 4), ('hand out', 0)], self.events)
+
+    def test_bundles_are_finished_off_the_dispatching_thread(self):
+        scheduler = self.scheduler(window_size=2)
+        scheduler.stage(self.bundles())
+        self.assertEqual([5, 2, 1, 0, 0, 3, 0, 0, 6, 4, 0], [size for event, size in self.events if event == 'stage'])
+        self.assertEqual(len(self.BUNDLE_SIZES), self.staged_index.record.call_count)
+        self.assertNotIn(threading.current_thread(), self.finishing_threads)
+        self.assertLessEqual(max(self.bundles_held), 2 * 2)  # a window being staged, and the rest of one before it
+        self.assertEqual({}, scheduler._bundles)
+        self.assertEqual(set(), scheduler._failed)
+
+
+if __name__ == '__main__':
+    unittest.main()
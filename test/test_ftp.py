@@ -0,0 +1,171 @@
+import ftplib, os, sys, tempfile, unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'bin'))
+
+from bundle_tools.download import FTPDownloader  # noqa: E402
+from bundle_tools.ftp import FTPReader, FTPSessionPool  # noqa: E402
+
+URL = 'ftp://ftp.example.org/GSE1/data.fastq.gz'
+
+
+class FakeDataConnection:
+
+    def __init__(self, data: bytes):
+        self.data = data
+
+    def recv_into(self, buffer) -> int:
+        byte_count = min(len(buffer), len(self.data), 100)
+        buffer[:byte_count] = self.data[:byte_count]
+        self.data = self.data[byte_count:]
+        return byte_count
+
+    def close(self):
+        pass
+
+
+class FakeFTP:
+    """
+    An FTP session with a server of one file.  The server drops the data connection of the transfers
+    listed in `drops` once they reach the byte offset given (reporting 426), ends those in `short_transfers`
+    early (reporting success), and may not support MDTM.  Sessions can be made stale, as by a server timeout.
+    """
+
+    content = os.urandom(1000)
+    mdtm_supported = True
+    drops = []
+    short_transfers = []
+    sessions = []
+    retrs = []  # the REST offset of each RETR
+
+    def __init__(self, timeout=None):
+        self.stale = False
+        self.outcome = None
+        self.sessions.append(self)
+
+    def connect(self, host, port):
+        pass
+
+    def login(self):
+        pass
+
+    def voidcmd(self, cmd):
+        return '200 OK'
+
+    def sendcmd(self, cmd):
+        self._check_stale()
+        if cmd.startswith('MDTM') and self.mdtm_supported:
+            return '213 20200101000000'
+        raise ftplib.error_perm('500 Unknown command')
+
+    def transfercmd(self, cmd, rest=None):
+        self._check_stale()
+        self.retrs.append(rest)
+        start = rest or 0
+        end = len(self.content)
+        self.outcome = '226 Transfer complete'
+        if self.drops:
+            end, self.outcome = self.drops.pop(0), '426 Connection closed; transfer aborted'
+        elif self.short_transfers:
+            end = self.short_transfers.pop(0)
+        return FakeDataConnection(self.content[start:end])
+
+    def voidresp(self):
+        if self.outcome.startswith('4'):
+            raise ftplib.error_temp(self.outcome)
+        return self.outcome
+
+    def close(self):
+        pass
+
+    def _check_stale(self):
+        if self.stale:
+            raise EOFError()
+
+
+class TestFTPDownloader(unittest.TestCase):
+
+    def setUp(self):
+        FakeFTP.mdtm_supported, FakeFTP.drops, FakeFTP.short_transfers = True, [], []
+        FakeFTP.sessions, FakeFTP.retrs = [], []
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.dest_path = os.path.join(self.tmpdir.name, 'data.fastq.gz')
+        sessions = FTPSessionPool()
+        patches = [mock.patch('bundle_tools.ftp.ftplib.FTP', FakeFTP),
+                   mock.patch('bundle_tools.ftp.ftp_sessions', sessions),
+                   mock.patch('bundle_tools.download.ftp_sessions', sessions),
+                   mock.patch.object(FTPDownloader, 'INITIAL_BACKOFF', 0),
+                   mock.patch.object(FTPReader, 'INITIAL_BACKOFF', 0)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def download(self):
+        FTPDownloader().download(URL, self.dest_path, len(FakeFTP.content))
+        with open(self.dest_path, 'rb') as fh:
+            self.assertEqual(FakeFTP.content, fh.read())
+
+    def test_dropped_data_connection_is_resumed_with_rest(self):
+        FakeFTP.drops = [400]
+        self.download()
+        self.assertEqual([None, 400], FakeFTP.retrs)
+
+    def test_transfer_ending_early_is_not_taken_as_complete(self):
+        FakeFTP.short_transfers = [600]
+        self.download()
+        self.assertEqual([None, 600], FakeFTP.retrs)
+
+    def test_download_without_mdtm_validator_starts_again(self):
+        FakeFTP.mdtm_supported = False
+        FakeFTP.drops = [400]
+        self.download()
+        self.assertEqual([None, None], FakeFTP.retrs)
+
+    def test_stale_pooled_sessions_are_replaced_without_a_retry(self):
+        self.download()
+        for session in FakeFTP.sessions:
+            session.stale = True  # timed out while in the pool
+        os.remove(self.dest_path)
+        with mock.patch.object(FTPDownloader, 'MAX_ATTEMPTS', 1):
+            self.download()
+        self.assertEqual([None, None], FakeFTP.retrs)
+        self.assertEqual(2, len(FakeFTP.sessions))
+
+    def test_failed_transfers_are_retried_by_the_downloader_alone(self):
+        FakeFTP.drops = [100, 200, 300]
+        with mock.patch.object(FTPDownloader, 'MAX_ATTEMPTS', 2):
+            with self.assertRaises(ftplib.error_temp):
+                FTPDownloader().download(URL, self.dest_path, len(FakeFTP.content))
+        self.assertEqual([None, 100], FakeFTP.retrs)
+
+
+class TestFTPReader(unittest.TestCase):
+
+    def setUp(self):
+        FakeFTP.mdtm_supported, FakeFTP.drops, FakeFTP.short_transfers = True, [], []
+        FakeFTP.sessions, FakeFTP.retrs = [], []
+        patches = [mock.patch('bundle_tools.ftp.ftplib.FTP', FakeFTP),
+                   mock.patch.object(FTPReader, 'INITIAL_BACKOFF', 0)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_stream_is_unbroken_by_dropped_data_connections(self):
+        FakeFTP.drops = [300, 700]
+        with FTPReader(URL, len(FakeFTP.content), sessions=FTPSessionPool()) as in_stream:
+            self.assertEqual(FakeFTP.content, in_stream.read())
+        self.assertEqual([None, 300, 700], FakeFTP.retrs)
+
+    def test_stale_pooled_session_is_replaced_without_a_retry(self):
+        sessions = FTPSessionPool()
+        with sessions.session('ftp.example.org'):
+            pass
+        FakeFTP.sessions[0].stale = True  # timed out while in the pool
+        with FTPReader(URL, len(FakeFTP.content), sessions=sessions, max_attempts=1) as in_stream:
+            self.assertEqual(FakeFTP.content, in_stream.read())
+        self.assertEqual(2, len(FakeFTP.sessions))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+import json, os, subprocess, sys, tempfile, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'bin'))
+
+from bundle_tools.governor import ResourceGovernor  # noqa: E402
+
+
+def dead_pid() -> int:
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+class TestResourceGovernor(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.governor = ResourceGovernor()
+        self.governor.configure(disk_budget=100, state_dir=self.tmpdir.name)
+
+    def reservations(self) -> list:
+        with open(os.path.join(self.tmpdir.name, 'reservations.json')) as fh:
+            return json.load(fh)
+
+    def test_state_is_kept_per_user(self):
+        self.assertTrue(ResourceGovernor.DEFAULT_STATE_DIR.endswith(f"-{os.getuid()}"))
+
+    def test_reservations_are_released(self):
+        with self.governor.reserved(disk=60):
+            self.assertEqual([60], [reservation['disk'] for reservation in self.reservations()])
+        self.assertEqual([], self.reservations())
+
+    def test_reservations_of_processes_that_died_are_dropped(self):
+        with open(os.path.join(self.tmpdir.name, 'reservations.json'), 'w') as fh:
+            json.dump([dict(id='crashed', pid=dead_pid(), disk=100, memory=0)], fh)
+        with self.governor.reserved(disk=60):  # would wait forever, were the dead run's reservation kept
+            self.assertEqual([os.getpid()], [reservation['pid'] for reservation in self.reservations()])
+
+
+if __name__ == '__main__':
+    unittest.main()
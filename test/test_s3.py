@@ -0,0 +1,148 @@
+import os, sys, tempfile, unittest
+from unittest import mock
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'bin'))
+
+from bundle_tools.s3 import S3Agent, S3ObjectStateCache  # noqa: E402
+
+try:
+    from moto.server import ThreadedMotoServer
+except ImportError:
+    ThreadedMotoServer = None
+
+BUCKET = 'target-bucket'
+URL = f"s3://{BUCKET}/import/geo/GSE1/bundle0/sample.json"
+
+
+class TestS3ObjectStateCache(unittest.TestCase):
+
+    def test_absent_objects_are_remembered(self):
+        cache = S3ObjectStateCache()
+        self.assertEqual((False, None), cache.lookup_object(URL))
+        cache.remember_object(URL, None)
+        self.assertEqual((True, None), cache.lookup_object(URL))
+
+    def test_invalidated_entries_are_forgotten(self):
+        cache = S3ObjectStateCache()
+        cache.remember_object(URL, 'object')
+        cache.remember_tags(URL, {'a': '1'})
+        cache.invalidate(URL)
+        self.assertEqual((False, None), cache.lookup_object(URL))
+        self.assertEqual((False, None), cache.lookup_tags(URL))
+
+    def test_tags_looked_up_are_a_copy(self):
+        cache = S3ObjectStateCache()
+        cache.remember_tags(URL, {'a': '1'})
+        cache.lookup_tags(URL)[1]['b'] = '2'
+        self.assertEqual((True, {'a': '1'}), cache.lookup_tags(URL))
+
+    def test_least_recently_used_entries_are_dropped(self):
+        cache = S3ObjectStateCache()
+        cache.MAX_ENTRIES = 2
+        for number in range(3):
+            cache.remember_object(f"{URL}{number}", number)
+        cache.lookup_object(f"{URL}1")
+        cache.remember_object(f"{URL}3", 3)
+        self.assertEqual([False, True, False, True], [cache.lookup_object(f"{URL}{number}")[0] for number in range(4)])
+
+
+@unittest.skipIf(ThreadedMotoServer is None, "moto is not installed")
+class TestS3AgentStateCache(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.environ = dict(os.environ)
+        os.environ.update(AWS_ACCESS_KEY_ID='testing', AWS_SECRET_ACCESS_KEY='testing',
+                          AWS_DEFAULT_REGION='us-east-1')
+        cls.server = ThreadedMotoServer(ip_address='127.0.0.1', port=0, verbose=False)
+        cls.server.start()
+        host, port = cls.server.get_host_and_port()
+        cls.endpoint_url = f"http://{host}:{port}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        os.environ.clear()
+        os.environ.update(cls.environ)
+
+    def setUp(self):
+        session = boto3.session.Session()
+        self.s3 = session.client('s3', endpoint_url=self.endpoint_url)
+        self.agent = S3Agent(resource=session.resource('s3', endpoint_url=self.endpoint_url), client=self.s3)
+        self.s3.create_bucket(Bucket=BUCKET)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def tearDown(self):
+        for obj in self.s3.list_objects_v2(Bucket=BUCKET).get('Contents', []):
+            self.s3.delete_object(Bucket=BUCKET, Key=obj['Key'])
+        self.s3.delete_bucket(Bucket=BUCKET)
+
+    def put(self, url: str, body: bytes, tags: dict={}):
+        key = url[len(f"s3://{BUCKET}/"):]
+        self.s3.put_object(Bucket=BUCKET, Key=key, Body=body,
+                           Tagging='&'.join(f"{k}={v}" for k, v in tags.items()))
+
+    def upload(self, url: str, body: bytes) -> dict:
+        path = os.path.join(self.tmpdir.name, 'upload')
+        with open(path, 'wb') as fh:
+            fh.write(body)
+        return self.agent.upload_and_checksum(path, url, len(body))
+
+    def test_objects_and_tags_are_looked_up_once(self):
+        self.put(URL, b'12345', {'a': '1'})
+        self.assertEqual(5, self.agent.get_object(URL).content_length)
+        self.assertEqual({'a': '1'}, self.agent.get_tagging(URL))
+        self.put(URL, b'123', {'a': '2'})  # changed behind the agent's back
+        self.assertEqual(5, self.agent.get_object(URL).content_length)
+        self.assertEqual({'a': '1'}, self.agent.get_tagging(URL))
+
+    def test_tags_added_are_remembered(self):
+        self.put(URL, b'12345', {'a': '1'})
+        self.agent.get_tagging(URL)
+        self.agent.add_tagging(URL, {'a': '1', 'b': '2'})
+        self.assertEqual({'a': '1', 'b': '2'}, self.agent.get_tagging(URL))
+
+    def test_upload_replaces_what_was_remembered(self):
+        self.assertIsNone(self.agent.get_object(URL))
+        self.upload(URL, b'12345')
+        self.assertEqual(5, self.agent.get_object(URL).content_length)
+        self.agent.get_tagging(URL)
+        self.upload(URL, b'123')
+        self.assertEqual(3, self.agent.get_object(URL).content_length)
+        self.assertEqual({}, self.agent.get_tagging(URL))
+
+    def test_upload_is_checked_against_the_etag_s3_reports(self):
+        with mock.patch.object(S3Agent, 'get_object', side_effect=AssertionError("HEAD")):
+            checksums = self.upload(URL, b'12345')
+        self.assertEqual(self.s3.head_object(Bucket=BUCKET, Key=URL[len(f"s3://{BUCKET}/"):])['ETag'].strip('"'),
+                         checksums['s3_etag'])
+
+    def test_multipart_upload_is_checked_against_the_etag_s3_reports(self):
+        body = os.urandom(6 * 1024 * 1024)
+        with mock.patch.object(S3Agent, 'transfer_config', return_value=TransferConfig(
+                multipart_threshold=5 * 1024 * 1024, multipart_chunksize=5 * 1024 * 1024)), \
+                mock.patch.object(S3Agent, 'get_object', side_effect=AssertionError("HEAD or ETag mismatch")):
+            checksums = self.upload(URL, body)
+        self.assertTrue(checksums['s3_etag'].endswith('-2'))
+
+    def test_copy_replaces_what_was_remembered_of_its_destination(self):
+        copy_url = f"{URL}.copy"
+        self.put(URL, b'12345', {'a': '1'})
+        self.assertIsNone(self.agent.get_object(copy_url))
+        self.agent.copy_between_buckets(URL, copy_url, 5)
+        self.assertEqual(5, self.agent.get_object(copy_url).content_length)
+        self.assertEqual({'a': '1'}, self.agent.get_tagging(copy_url))
+
+    def test_deleted_object_is_not_remembered(self):
+        self.put(URL, b'12345')
+        self.agent.get_object(URL)
+        self.agent.delete_object(URL)
+        self.assertIsNone(self.agent.get_object(URL))
+
+
+if __name__ == '__main__':
+    unittest.main()
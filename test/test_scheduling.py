@@ -0,0 +1,56 @@
+import os, subprocess, sys, tempfile, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'bin'))
+
+from bundle_tools.scheduling import OriginHostScheduler  # noqa: E402
+
+URL = 'http://origin.example.org/data.fastq.gz'
+
+
+def dead_pid() -> int:
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+class TestOriginHostScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.scheduler = OriginHostScheduler()
+        self.scheduler.configure(max_connections=1, state_dir=self.tmpdir.name)
+        self.addCleanup(self.scheduler.release)
+
+    def test_state_is_kept_per_user(self):
+        self.assertTrue(OriginHostScheduler.DEFAULT_STATE_DIR.endswith(f"-{os.getuid()}"))
+
+    def test_connections_are_limited_per_host(self):
+        with self.scheduler.connection(URL):
+            with self.scheduler.extra_connections(URL, 2) as extra_connections:
+                self.assertEqual(0, extra_connections)
+            with self.scheduler.extra_connections('http://other.example.org/', 2) as extra_connections:
+                self.assertEqual(1, extra_connections)
+
+    def test_runs_do_not_share_state(self):
+        other_run_dir = os.path.join(self.tmpdir.name, str(os.getppid()))
+        os.makedirs(other_run_dir)
+        with self.scheduler.connection(URL):
+            self.assertEqual([], os.listdir(other_run_dir))
+
+    def test_state_is_removed_by_release(self):
+        with self.scheduler.connection(URL):
+            pass
+        self.assertTrue(os.path.isdir(self.scheduler.state_dir))
+        self.scheduler.release()
+        self.assertEqual([], os.listdir(self.tmpdir.name))
+
+    def test_state_of_runs_that_died_is_removed(self):
+        stale_run_dir = os.path.join(self.tmpdir.name, str(dead_pid()))
+        os.makedirs(os.path.join(stale_run_dir, 'origin.example.org'))
+        OriginHostScheduler().configure(max_connections=1, state_dir=self.tmpdir.name)
+        self.assertFalse(os.path.exists(stale_run_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
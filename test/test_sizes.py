@@ -0,0 +1,61 @@
+import os, sys, tempfile, unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'bin'))
+
+from bundle_tools.sizes import FileSizeResolver  # noqa: E402
+
+URLS = [f"ftp://ftp.example.org/GSE1/data{number}.fastq.gz" for number in range(4)]
+
+
+class TestFileSizeResolver(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.sized = []
+        patch = mock.patch('bundle_tools.sizes.file_size', side_effect=self.file_size)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def file_size(self, url: str) -> int:
+        if url.endswith('missing'):
+            raise FileNotFoundError(url)
+        self.sized.append(url)
+        return 100 + URLS.index(url)
+
+    def resolver(self, ttl_hours: float=1) -> FileSizeResolver:
+        """ A new process's resolver, sharing the database """
+        resolver = FileSizeResolver()
+        resolver.configure(os.path.join(self.tmpdir.name, 'sizes.sqlite'), ttl_hours=ttl_hours)
+        return resolver
+
+    def age_entries(self, resolver: FileSizeResolver, seconds: float):
+        with resolver._db() as db:
+            db.execute("UPDATE file_sizes SET resolved_at = resolved_at - ?", (seconds,))
+
+    def test_sizes_are_resolved_once_per_process(self):
+        resolver = FileSizeResolver()
+        self.assertEqual({url: 100 + number for number, url in enumerate(URLS)}, resolver.sizes(URLS))
+        self.assertEqual(101, resolver.size(URLS[1]))
+        self.assertEqual(sorted(URLS), sorted(self.sized))
+
+    def test_sizes_are_shared_by_later_runs(self):
+        self.resolver().sizes(URLS)
+        self.assertEqual(103, self.resolver().size(URLS[3]))
+        self.assertEqual(4, len(self.sized))
+
+    def test_expired_sizes_are_resolved_again(self):
+        resolver = self.resolver()
+        resolver.sizes(URLS)
+        self.age_entries(resolver, 3600)
+        self.assertEqual(103, self.resolver().size(URLS[3]))
+        self.assertEqual(5, len(self.sized))
+
+    def test_first_error_is_raised(self):
+        with self.assertRaisesRegex(FileNotFoundError, 'missing'):
+            FileSizeResolver().sizes(URLS[:2] + ['ftp://ftp.example.org/missing'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+import json, os, sys, unittest
+from unittest import mock
+
+import boto3
+from urllib3.util import parse_url
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'bin'))
+
+from bundle_tools.bundle import StagedBundle  # noqa: E402
+from bundle_tools.clients import clients  # noqa: E402
+from bundle_tools.s3 import S3Agent  # noqa: E402
+from bundle_tools.staged_index import StagedBundleIndex  # noqa: E402
+from bundle_tools.submission import SubmissionChanged  # noqa: E402
+
+try:
+    from moto.server import ThreadedMotoServer
+except ImportError:
+    ThreadedMotoServer = None
+
+BUCKET = 'target-bucket'
+HOME = 'import/geo/GSE1/bundles'
+
+
+@unittest.skipIf(ThreadedMotoServer is None, "moto is not installed")
+class TestStagedBundleIndex(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.environ = dict(os.environ)
+        os.environ.update(AWS_ACCESS_KEY_ID='testing', AWS_SECRET_ACCESS_KEY='testing',
+                          AWS_DEFAULT_REGION='us-east-1')
+        cls.server = ThreadedMotoServer(ip_address='127.0.0.1', port=0, verbose=False)
+        cls.server.start()
+        host, port = cls.server.get_host_and_port()
+        cls.endpoint_url = f"http://{host}:{port}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        os.environ.clear()
+        os.environ.update(cls.environ)
+
+    def setUp(self):
+        session = boto3.session.Session()
+        self.s3 = session.client('s3', endpoint_url=self.endpoint_url)
+        s3agent = S3Agent(resource=session.resource('s3', endpoint_url=self.endpoint_url), client=self.s3)
+        patches = [mock.patch.object(clients, 's3client', return_value=self.s3),
+                   mock.patch.object(clients, 's3_agent', return_value=s3agent)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.s3.create_bucket(Bucket=BUCKET)
+
+    def tearDown(self):
+        for obj in self.s3.list_objects_v2(Bucket=BUCKET).get('Contents', []):
+            self.s3.delete_object(Bucket=BUCKET, Key=obj['Key'])
+        self.s3.delete_bucket(Bucket=BUCKET)
+
+    def put_submission(self, name: str, info: dict) -> str:
+        response = self.s3.put_object(Bucket=BUCKET, Key=f"{HOME}/{name}/submission.json", Body=json.dumps(info))
+        return response['ETag']
+
+    def staged_bundle(self, name: str, index: StagedBundleIndex) -> StagedBundle:
+        info, etag = index.entry(f"{HOME}/{name}")
+        return StagedBundle(parse_url(f"s3://{BUCKET}/{HOME}/{name}"), info=info, etag=etag)
+
+    def test_saved_entries_are_read_back(self):
+        info = {'files': [{'name': 'a.json', 'size': 1}]}
+        etag = self.put_submission('bundle0', info)
+        index = StagedBundleIndex(BUCKET)
+        index.record(f"{HOME}/bundle0", info, etag)
+        self.assertEqual(1, index.save())
+        self.assertEqual((info, etag), StagedBundleIndex(BUCKET).entry(f"{HOME}/bundle0"))
+        self.assertEqual((None, None), StagedBundleIndex(BUCKET).entry(f"{HOME}/bundle1"))
+
+    def test_entries_are_saved_as_they_are_recorded(self):
+        index = StagedBundleIndex(BUCKET)
+        index.SAVE_EVERY = 2
+        etags = [self.put_submission(f"bundle{number}", {'files': []}) for number in range(3)]
+        for number in range(3):
+            index.record(f"{HOME}/bundle{number}", {'files': []}, etags[number])
+        fresh_index = StagedBundleIndex(BUCKET)
+        self.assertEqual(etags[1], fresh_index.entry(f"{HOME}/bundle1")[1])
+        self.assertEqual((None, None), fresh_index.entry(f"{HOME}/bundle2"))
+
+    def test_concurrent_runs_updates_are_merged(self):
+        etags = [self.put_submission(f"bundle{number}", {'files': []}) for number in range(2)]
+        one_run, another_run = StagedBundleIndex(BUCKET), StagedBundleIndex(BUCKET)
+        another_run.entry(f"{HOME}/bundle0")  # has read the index before one_run saves it
+        one_run.record(f"{HOME}/bundle0", {'files': []}, etags[0])
+        one_run.save()
+        another_run.record(f"{HOME}/bundle1", {'files': []}, etags[1])
+        another_run.save()
+        fresh_index = StagedBundleIndex(BUCKET)
+        self.assertEqual(etags[0], fresh_index.entry(f"{HOME}/bundle0")[1])
+        self.assertEqual(etags[1], fresh_index.entry(f"{HOME}/bundle1")[1])
+
+    def test_entry_is_used_only_while_submission_json_is_unchanged(self):
+        info = {'files': [{'name': 'a.json', 'size': 1}]}
+        indexed_info = dict(info, indexed=True)  # tells the entry from submission.json
+        index = StagedBundleIndex(BUCKET)
+        index.record(f"{HOME}/bundle0", indexed_info, self.put_submission('bundle0', info))
+        index.save()
+        self.assertEqual(indexed_info, self.staged_bundle('bundle0', index).submission_info.info)
+        newer_info = {'bundle_uuid': 'b', 'files': [{'name': 'a.json', 'size': 1, 'uuid': 'f'}]}
+        self.put_submission('bundle0', newer_info)
+        next_run_index = StagedBundleIndex(BUCKET)
+        self.assertEqual((None, None), next_run_index.entry(f"{HOME}/bundle0"))
+        self.assertEqual(newer_info, self.staged_bundle('bundle0', next_run_index).submission_info.info)
+
+    def test_submission_json_is_not_saved_over_newer_content(self):
+        info = {'files': [{'name': 'a.json', 'size': 1}]}
+        self.put_submission('bundle0', info)
+        bundle = self.staged_bundle('bundle0', StagedBundleIndex(BUCKET))
+        self.put_submission('bundle0', dict(info, bundle_uuid='written-meanwhile'))
+        bundle.uuid = 'b'
+        with self.assertRaises(SubmissionChanged):
+            bundle.submission_info.save()
+        submission_json = self.s3.get_object(Bucket=BUCKET, Key=f"{HOME}/bundle0/submission.json")['Body'].read()
+        self.assertEqual('written-meanwhile', json.loads(submission_json)['bundle_uuid'])
+
+
+if __name__ == '__main__':
+    unittest.main()
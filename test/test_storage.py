@@ -0,0 +1,24 @@
+import os, signal, sys, unittest
+from unittest import mock
+
+from urllib3.util import parse_url
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'bin'))
+
+from bundle_tools.storage import store_bundle  # noqa: E402
+
+
+class TestStoreBundle(unittest.TestCase):
+
+    def test_interrupts_are_left_to_kill_the_process(self):
+        previous_handler = signal.signal(signal.SIGINT, lambda signal_number, frame: None)
+        self.addCleanup(signal.signal, signal.SIGINT, previous_handler)
+        with mock.patch('bundle_tools.storage.StagedBundle') as staged_bundle:
+            staged_bundle.return_value.all_files_are_smaller_than.return_value = False
+            bundle = (parse_url('s3://bucket/import/geo/GSE1/bundles/bundle0'), None, None)
+            self.assertIs(True, store_bundle(bundle, 'https://dss.example.org/v1', {}, 1))
+        self.assertEqual(signal.SIG_DFL, signal.getsignal(signal.SIGINT))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+import hashlib, json, os, sys, tempfile, unittest
+from unittest import mock
+
+import boto3
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'bin'))
+
+from bundle_tools.bundle import LocalBundle  # noqa: E402
+from bundle_tools.verification import AsyncS3Client, BundleVerifier  # noqa: E402
+
+try:
+    from moto.server import ThreadedMotoServer
+except ImportError:
+    ThreadedMotoServer = None
+
+BUCKET = 'target-bucket'
+BUNDLE_PATH = 'import/geo/GSE1/bundle0'
+
+
+class TestCredentials(unittest.TestCase):
+
+    def test_missing_credentials_are_reported_before_any_request(self):
+        no_credentials = {'AWS_SHARED_CREDENTIALS_FILE': '/nonexistent', 'AWS_CONFIG_FILE': '/nonexistent',
+                          'AWS_EC2_METADATA_DISABLED': 'true', 'PATH': os.environ.get('PATH', '')}
+        with mock.patch.dict(os.environ, no_credentials, clear=True):
+            with self.assertRaisesRegex(RuntimeError, "No AWS credentials"):
+                AsyncS3Client(max_connections=1)
+
+
+class TestConcurrency(unittest.TestCase):
+
+    def test_concurrency_is_capped_below_the_open_file_limit(self):
+        verifier = BundleVerifier(BUCKET, concurrency=10 ** 9)
+        self.assertLess(verifier.concurrency, 10 ** 9)
+        self.assertGreater(verifier.concurrency, 0)
+
+
+@unittest.skipIf(ThreadedMotoServer is None, "moto is not installed")
+class TestBundleVerifier(unittest.TestCase):
+    """ Verifies bundles against moto_server, as with stager.py --verify-first --verify-endpoint """
+
+    METADATA = b'{"describedBy": "sample"}'
+    DATA = b'some data' * 1000
+
+    @classmethod
+    def setUpClass(cls):
+        cls.environ = dict(os.environ)
+        os.environ.update(AWS_ACCESS_KEY_ID='testing', AWS_SECRET_ACCESS_KEY='testing',
+                          AWS_DEFAULT_REGION='us-east-1')
+        os.environ.pop('AWS_ENDPOINT_URL', None)
+        cls.server = ThreadedMotoServer(ip_address='127.0.0.1', port=0, verbose=False)
+        cls.server.start()
+        host, port = cls.server.get_host_and_port()
+        cls.endpoint_url = f"http://{host}:{port}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        os.environ.clear()
+        os.environ.update(cls.environ)
+
+    def setUp(self):
+        self.s3 = boto3.client('s3', endpoint_url=self.endpoint_url)
+        self.s3.create_bucket(Bucket=BUCKET)
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        os.chdir(self.tmpdir.name)
+        os.makedirs(BUNDLE_PATH)
+        with open(f"{BUNDLE_PATH}/sample.json", 'wb') as fh:
+            fh.write(self.METADATA)
+        with open(f"{BUNDLE_PATH}/manifest.json", 'w') as fh:
+            json.dump({'dir': 'ftp://ftp.example.org/GSE1', 'files': [{'name': 'data.fastq.gz'}]}, fh)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmpdir.cleanup()
+        for obj in self.s3.list_objects_v2(Bucket=BUCKET).get('Contents', []):
+            self.s3.delete_object(Bucket=BUCKET, Key=obj['Key'])
+        self.s3.delete_bucket(Bucket=BUCKET)
+
+    def stage(self, name: str, body: bytes, tagged: bool=True):
+        key = f"{BUNDLE_PATH}/{name}"
+        self.s3.put_object(Bucket=BUCKET, Key=key, Body=body)
+        if tagged:
+            etag = hashlib.md5(body).hexdigest()
+            tags = {'hca-dss-s3_etag': etag, 'hca-dss-sha1': 'x', 'hca-dss-sha256': 'x', 'hca-dss-crc32c': 'x',
+                    'hca-dss-content-type': 'application/json'}
+            self.s3.put_object_tagging(Bucket=BUCKET, Key=key,
+                                       Tagging={'TagSet': [{'Key': k, 'Value': v} for k, v in tags.items()]})
+
+    def stage_bundle(self, data_tagged: bool=True):
+        self.stage('sample.json', self.METADATA)
+        self.stage('data.fastq.gz', self.DATA, tagged=data_tagged)
+        files = [{'name': name, 'size': size, 'staged_url': f"s3://{BUCKET}/{BUNDLE_PATH}/{name}"}
+                 for name, size in (('sample.json', len(self.METADATA)), ('data.fastq.gz', len(self.DATA)))]
+        self.s3.put_object(Bucket=BUCKET, Key=f"{BUNDLE_PATH}/submission.json", Body=json.dumps({'files': files}))
+
+    def verify(self, bundles) -> tuple:
+        verified = {}
+        verifier = BundleVerifier(BUCKET, endpoint_url=self.endpoint_url,
+                                  on_verified=lambda path, info, etag: verified.update({path: (info, etag)}))
+        return list(verifier.verify(iter(bundles))), verified
+
+    def test_completely_staged_bundle_is_verified(self):
+        self.stage_bundle()
+        unfinished, verified = self.verify([LocalBundle(BUNDLE_PATH)])
+        self.assertEqual([], unfinished)
+        self.assertEqual([BUNDLE_PATH], list(verified))
+        info, etag = verified[BUNDLE_PATH]
+        self.assertEqual(self.s3.head_object(Bucket=BUCKET, Key=f"{BUNDLE_PATH}/submission.json")['ETag'], etag)
+        self.assertEqual(2, len(info['files']))
+
+    def test_file_lacking_tags_is_left_to_be_staged(self):
+        self.stage_bundle(data_tagged=False)
+        bundle = LocalBundle(BUNDLE_PATH)
+        unfinished, verified = self.verify([bundle])
+        self.assertEqual([bundle], unfinished)
+        self.assertEqual({'sample.json'}, bundle.verified_files)
+        self.assertEqual({}, verified)
+
+    def test_unstaged_bundle_is_left_to_be_staged(self):
+        bundle = LocalBundle(BUNDLE_PATH)
+        unfinished, verified = self.verify([bundle])
+        self.assertEqual([bundle], unfinished)
+        self.assertEqual(set(), bundle.verified_files)
+
+    def test_bundle_that_cannot_be_verified_is_left_to_be_staged(self):
+        self.stage_bundle()
+        bundle = LocalBundle(BUNDLE_PATH)
+        verifier = BundleVerifier('no-such-bucket', endpoint_url=self.endpoint_url)
+        self.assertEqual([bundle], list(verifier.verify(iter([bundle]))))
+        self.assertEqual(0, verifier.bundles_verified)
+
+
+if __name__ == '__main__':
+    unittest.main()